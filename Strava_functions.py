@@ -1,124 +1,413 @@
+import io
 import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import requests
+from requests.adapters import HTTPAdapter
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 
+import metrics
+
+
+# Size of the process-wide pool of connections to the postGRE Strava database
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 5
+
+# Base url of the Strava API - can be pointed to a local stand-in server (see fake_strava.py)
+STRAVA_API_URL = os.environ.get("STRAVA_API_URL", "https://www.strava.com/api/v3")
+
+# Settings of the HTTP requests to the Strava API
+HTTP_TIMEOUT_SECONDS = 30
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_SECONDS = 1
+HTTP_POOL_SIZE = 16
+
+# Paging of the backfill - number of pages which are requested in parallel
+BACKFILL_PAGE_SIZE = 200
+BACKFILL_MAX_PARALLEL_PAGES = 4
+
+# Number of activities written per batch during a backfill and number of downloaded pages which may wait
+# for the database - together they bound the memory used by a backfill
+BACKFILL_BATCH_SIZE = 1000
+BACKFILL_QUEUE_SIZE = 2 * BACKFILL_MAX_PARALLEL_PAGES
+
+# Access tokens are refreshed when they expire within this number of seconds
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+
+# Paging of the incremental sync - the watermark is moved back by the overlap to catch late uploads
+SYNC_PAGE_SIZE = 200
+SYNC_OVERLAP_SECONDS = 2 * 24 * 3600
+
+# Writes of at least this number of activities are streamed with COPY instead of a multi-row INSERT
+BULK_LOAD_MIN_ROWS = int(os.environ.get("STRAVADASH_BULK_LOAD_MIN_ROWS", "1000"))
+
+# Number of rows fetched per round trip by the streaming reads of ConnectToDB.stream_query
+STREAM_CHUNK_SIZE = 5000
+
+# Columns of the activities table with the dtype and the default used when Strava leaves a field out.
+# A default of None is stored as NULL
+ACTIVITY_SCHEMA = [('id', 'int64', None),
+                   ('user_id', 'object', None),
+                   ('name', 'object', ''),
+                   ('distance', 'float64', 0.0),
+                   ('moving_time', 'int64', 0),
+                   ('total_elevation_gain', 'float64', 0.0),
+                   ('type', 'object', 'Workout'),
+                   ('start_date_local', 'object', None),
+                   ('location_city', 'object', None),
+                   ('location_state', 'object', None),
+                   ('location_country', 'object', None),
+                   ('achievement_count', 'int64', 0),
+                   ('kudos_count', 'int64', 0),
+                   ('comment_count', 'int64', 0),
+                   ('athlete_count', 'int64', 1),
+                   ('trainer', 'bool', False),
+                   ('commute', 'bool', False),
+                   ('manual', 'bool', False),
+                   ('private', 'bool', False),
+                   ('gear_id', 'object', None),
+                   ('average_speed', 'float64', 0.0),
+                   ('max_speed', 'float64', 0.0),
+                   ('has_heartrate', 'bool', False),
+                   ('average_heartrate', 'float64', None),
+                   ('max_heartrate', 'float64', None),
+                   ('elev_high', 'float64', None),
+                   ('elev_low', 'float64', None),
+                   ('pr_count', 'int64', 0),
+                   ('total_photo_count', 'int64', 0),
+                   ('average_watts', 'float64', None),
+                   ('kilojoules', 'float64', None),
+                   ('start_epoch', 'int64', None),
+                   ('year_month', 'datetime64[ns]', None),
+                   ('distance_in_km', 'float64', None)]
+
+ACTIVITY_COLUMNS = [column for column, _, _ in ACTIVITY_SCHEMA]
+
+# Columns which are computed during the normalization instead of being read from the Strava response
+DERIVED_COLUMNS = ('user_id', 'start_epoch', 'year_month', 'distance_in_km')
+
+_db_config = None
+_session = None
+_session_lock = threading.Lock()
+_pool = None
+_pool_slots = None
+_pool_lock = threading.RLock()
+
+
+def read_db_config():
+
+    """ Function to read the config parameters of the postGRE Strava database - the file is only read once
+        per process"""
+
+    global _db_config
+
+    if _db_config is None:
+        with open('neon_DB_config.json', 'r') as configfile:
+            _db_config = json.load(configfile)
+
+    return _db_config
+
+
+def configure_connection_pool(min_connections=POOL_MIN_CONNECTIONS, max_connections=POOL_MAX_CONNECTIONS):
+
+    """ Function to (re)create the process-wide connection pool with the given minimum and maximum size"""
+
+    global _pool, _pool_slots
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+
+        _pool = ThreadedConnectionPool(min_connections, max_connections, **read_db_config())
+
+        # The semaphore makes a thread wait for a free connection instead of raising a PoolError
+        _pool_slots = threading.BoundedSemaphore(max_connections)
+
+
+def get_connection_pool():
+
+    """ Function to get the process-wide connection pool and its semaphore - the pool is created on first use"""
+
+    with _pool_lock:
+        if _pool is None:
+            configure_connection_pool()
+
+        return _pool, _pool_slots
+
+
+def close_connection_pool():
+
+    """ Function to close all the connections in the process-wide connection pool"""
+
+    global _pool, _pool_slots
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _pool_slots = None
+
+
+def reset_after_fork():
+
+    """ Function to call in a forked child process - the pool and the HTTP session of the parent are dropped
+        without closing them, as their sockets still belong to the parent. New ones are created on first use"""
+
+    global _pool, _pool_slots, _session
+
+    _pool = None
+    _pool_slots = None
+    _session = None
+
+
+def _connection_is_healthy(conn):
+
+    """ Function to check if a connection taken out of the pool is still usable"""
+
+    if conn.closed:
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return True
+
+    except (Exception, psycopg2.DatabaseError):
+        return False
+
 
 class ConnectToDB:
     """ This Class creates a connection object to the postGRE Strava database and allows
-        to perform queries on this database"""
+        to perform queries on this database. The connection is borrowed from a process-wide
+        connection pool and a new cursor is used for every operation"""
 
     # Initialize an object of the class
     def __init__(self):
         self.status = "Not Connected"
         self.conn_string = ""
         self.conn = None
-        self.cur = None
+        self.pool = None
+        self.pool_slots = None
+        self.description = None
         self.query_result = None
 
     def initialize_connection(self):
 
-        """ Method to connect the object to the postGRE Strava Database"""
+        """ Method to borrow a connection to the postGRE Strava Database from the connection pool"""
 
-        with open('neon_DB_config.json', 'r') as configfile:
-            db_config_params = json.load(configfile)
+        self.pool_slots = None
 
         try:
-            # Read in the configuration parameters to connect to the strava database
-            strava_config_params = db_config_params
+            self.pool, self.pool_slots = get_connection_pool()
+            self.pool_slots.acquire()
 
-            # Connect to the PostGRE SQL - Strava database
-            self.conn = psycopg2.connect(**strava_config_params)
+            # Take a connection out of the pool - replace it when the server closed it in the meantime
+            self.conn = self.pool.getconn()
+            while not _connection_is_healthy(self.conn):
+                self.pool.putconn(self.conn, close=True)
+                self.conn = self.pool.getconn()
 
             self.conn_string = self.conn.info
 
-            # Create a cursor to execute SQL commands
-            self.cur = self.conn.cursor()
-
             # Set the status to Connected
             self.status = "Connected"
 
         except (Exception, psycopg2.DatabaseError) as error:
+            if self.pool_slots is not None:
+                self.pool_slots.release()
+            self.conn = None
             print(error)
 
+    @metrics.DB_SECONDS.time(operation='query')
     def query_data(self, query, parameter):
 
         """ Method to let the object query to the postGRE Strava database """
 
         try:
-            # Execute the query
-            self.cur.execute(query, parameter)
+            with self.conn.cursor() as cur:
+                # Execute the query
+                cur.execute(query, parameter)
 
-            # Get the Result
-            self.query_result = self.cur.fetchall()
+                # Get the Result and the description of the columns
+                self.query_result = cur.fetchall()
+                self.description = cur.description
 
-            # Close the cursor
-            self.cur.close()
+            metrics.DB_ROWS.inc(len(self.query_result), operation='query')
 
         except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='query')
+            self._rollback()
             print(error)
 
-    def insert_data(self, query, parameters):
+    def stream_query(self, query, parameter, columns=None, chunk_size=STREAM_CHUNK_SIZE):
 
-        """Method to let the object insert data in the postGRE Strava database"""
+        """ Method to stream the result of a query from the postGRE Strava database in chunks of at most
+            chunk_size rows. The rows stay on the server in a named cursor and are fetched chunk by chunk, so the
+            full result is never held in memory. With columns only those columns of the query are sent.
+            Yields lists of tuples - the description of the columns is set after the first chunk. An error rolls
+            back the transaction and is raised again, so a caller never mistakes a broken stream for the end"""
+
+        if columns is not None:
+            query = "SELECT {} FROM ({}) AS streamed".format(', '.join(columns), query)
 
         try:
-            # Execute the query
-            execute_values(self.cur, query, parameters)
+            # A named cursor lives on the server - it needs a unique name within the transaction
+            with self.conn.cursor(name="stream_{}".format(uuid.uuid4().hex)) as cur:
+                cur.itersize = chunk_size
+
+                # Execute the query
+                cur.execute(query, parameter)
+
+                while True:
+                    # Only the round trips are timed - not the work of the caller between two chunks
+                    with metrics.DB_SECONDS.time(operation='stream'):
+                        rows = cur.fetchmany(chunk_size)
+                    self.description = cur.description
+
+                    if not rows:
+                        break
+
+                    metrics.DB_ROWS.inc(len(rows), operation='stream')
+                    yield rows
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='stream')
+            self._rollback()
+            print(error)
+            raise
+
+    @metrics.DB_SECONDS.time(operation='insert')
+    def insert_data(self, query, parameters, page_size=100):
+
+        """Method to let the object insert data in the postGRE Strava database - returns True when the
+           insert has been committed"""
+
+        try:
+            with self.conn.cursor() as cur:
+                # Execute the query - page_size rows are sent per INSERT statement
+                execute_values(cur, query, parameters, page_size=page_size)
 
             # Commit the changes to the database
             self.conn.commit()
 
-            # Close the cursor
-            self.cur.close()
+            metrics.DB_ROWS.inc(len(parameters), operation='insert')
+
+            return True
 
             # Check if something went wrong - print the error
         except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='insert')
+            self._rollback()
             print(error)
+            return False
 
+    @metrics.DB_SECONDS.time(operation='update')
     def update_data(self, query, parameter):
 
-        """Method to let the object update data in the postGRE Strava database"""
+        """Method to let the object update data in the postGRE Strava database - returns True when the update
+           has been committed"""
 
         try:
-            # Execute the query
-            self.cur.execute(query, parameter)
+            with self.conn.cursor() as cur:
+                # Execute the query
+                cur.execute(query, parameter)
 
             # Commit the changes to the database
             self.conn.commit()
 
-            # Close the cursor
-            self.cur.close()
+            return True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='update')
+            self._rollback()
+            print(error)
+            return False
+
+    @metrics.DB_SECONDS.time(operation='transaction')
+    def execute_transaction(self, statements):
+
+        """Method to execute several statements in one transaction on the postGRE Strava database. The statements
+           are (method, query, parameters) tuples where the method is 'execute', 'execute_values', 'copy' or
+           'query' - for 'copy' the parameters are a file-like object which is streamed with COPY ... FROM STDIN,
+           the rows returned by a 'query' are kept in query_result.
+           Returns True when the transaction has been committed - on an error nothing is changed"""
+
+        try:
+            with self.conn.cursor() as cur:
+                for method, query, parameters in statements:
+                    if method == 'execute_values':
+                        execute_values(cur, query, parameters, page_size=max(len(parameters), 1))
+                    elif method == 'copy':
+                        cur.copy_expert(query, parameters)
+                    elif method == 'query':
+                        cur.execute(query, parameters)
+                        self.query_result = cur.fetchall()
+                    else:
+                        cur.execute(query, parameters)
+
+                    if cur.rowcount > 0:
+                        metrics.DB_ROWS.inc(cur.rowcount, operation='transaction')
+
+            # Commit all the changes at once
+            self.conn.commit()
+
+            return True
 
+            # Check if something went wrong - print the error
         except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='transaction')
+            self._rollback()
             print(error)
+            return False
 
+    @metrics.DB_SECONDS.time(operation='delete')
     def delete_data(self, query, parameter):
 
         """Method to delete data from the postGRE Strava database"""
 
         try:
-            # Execute the query
-            self.cur.executemany(query, parameter)
+            with self.conn.cursor() as cur:
+                # Execute the query
+                cur.executemany(query, parameter)
 
             # Commit the changes to the database
             self.conn.commit()
 
-            # Close the cursor
-            self.cur.close()
-
             # Check if something went wrong - print the error
         except (Exception, psycopg2.DatabaseError) as error:
+            metrics.DB_ERRORS.inc(operation='delete')
+            self._rollback()
             print(error)
 
+    def _rollback(self):
+
+        """Method to end a failed transaction so the connection can be used again"""
+
+        if self.conn is not None and not self.conn.closed:
+            self.conn.rollback()
+
     def close_connection(self):
 
-        """Method to close the object's connection to the database """
+        """Method to give the object's connection back to the connection pool """
 
-        self.conn.close()
+        if self.conn is not None:
+            # End an open (read) transaction so the connection goes back to the pool clean
+            if not self.conn.closed:
+                self.conn.rollback()
+            self.pool.putconn(self.conn, close=bool(self.conn.closed))
+            self.pool_slots.release()
+
+        self.conn = None
+        self.pool = None
+        self.pool_slots = None
         self.status = "Not Connected"
 
 
@@ -132,6 +421,186 @@ def read_api_secrets():
     return api_config_params
 
 
+def get_strava_session():
+
+    """ Function to get the process-wide HTTP session to the Strava API - the session keeps the connections
+        alive and pools them so parallel requests do not each open a new TLS connection"""
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+
+    return _session
+
+
+class RateLimiter:
+    """ This Class keeps track of the Strava API rate limits. Strava reports the limits and the usage of the
+        15-minute window and of the day in the X-RateLimit-Limit and X-RateLimit-Usage headers
+        (e.g. "100,1000" and "12,250"). A request waits when the usage comes within the safety margin
+        of one of the limits"""
+
+    # Initialize an object of the class
+    def __init__(self, safety_margin=BACKFILL_MAX_PARALLEL_PAGES):
+        self.safety_margin = safety_margin
+        self.short_limit = None
+        self.long_limit = None
+        self.short_usage = 0
+        self.long_usage = 0
+        self.lock = threading.Lock()
+
+    def update(self, headers):
+
+        """ Method to update the limits and the usage with the headers of a Strava response"""
+
+        limit = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+
+        if not limit or not usage:
+            return
+
+        try:
+            short_limit, long_limit = [int(x) for x in limit.split(",")[:2]]
+            short_usage, long_usage = [int(x) for x in usage.split(",")[:2]]
+        except ValueError:
+            return
+
+        with self.lock:
+            self.short_limit, self.long_limit = short_limit, long_limit
+            self.short_usage, self.long_usage = short_usage, long_usage
+
+    def remaining(self, share=1.0):
+
+        """ Method to get the number of requests left in the tighter of the two windows when only the given share of
+            the limits may be used, as reported by the last response. Returns None before the first response"""
+
+        with self.lock:
+            if self.short_limit is None or self.long_limit is None:
+                return None
+
+            return min(int(self.short_limit * share) - self.short_usage,
+                       int(self.long_limit * share) - self.long_usage) - self.safety_margin
+
+    def seconds_to_wait(self, now=None):
+
+        """ Method to get the number of seconds to wait before a new request can be made - the 15-minute
+            windows reset at every quarter of an hour and the daily window at midnight UTC"""
+
+        now = now or datetime.now(timezone.utc)
+
+        with self.lock:
+            if self.long_limit is not None and self.long_usage >= self.long_limit - self.safety_margin:
+                midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+                return (midnight - now).total_seconds()
+
+            if self.short_limit is not None and self.short_usage >= self.short_limit - self.safety_margin:
+                quarter = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0) + \
+                          timedelta(minutes=15)
+                return (quarter - now).total_seconds()
+
+        return 0
+
+    def wait(self):
+
+        """ Method to block until a new request fits in the rate limits"""
+
+        seconds = self.seconds_to_wait()
+        if seconds > 0:
+            print("Strava rate limit reached - waiting {:.0f} seconds".format(seconds))
+            time.sleep(seconds)
+
+            # A new window has started - the usage is unknown until the next response
+            with self.lock:
+                self.short_usage = 0
+                if seconds > 15 * 60:
+                    self.long_usage = 0
+
+
+def strava_get(url, params, rate_limiter=None):
+
+    """ Function to perform a GET request on the Strava API with the shared session. The request waits for the
+        rate limits, and is retried with an exponential backoff when Strava answers with a 429 or a server error"""
+
+    session = get_strava_session()
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        start = time.perf_counter()
+        response = session.get(url=url, params=params, timeout=HTTP_TIMEOUT_SECONDS)
+        metrics.STRAVA_SECONDS.observe(time.perf_counter() - start, endpoint=metrics.strava_endpoint(url),
+                                       status=response.status_code)
+        metrics.record_rate_limit(response.headers)
+
+        if rate_limiter is not None:
+            rate_limiter.update(response.headers)
+
+        # Retry on too many requests or on a server error - give up after the last attempt
+        if (response.status_code == 429 or response.status_code >= 500) and attempt < HTTP_MAX_RETRIES:
+            backoff = HTTP_BACKOFF_SECONDS * 2 ** attempt
+            if response.status_code == 429 and rate_limiter is not None:
+                backoff = max(backoff, rate_limiter.seconds_to_wait())
+            time.sleep(backoff)
+            continue
+
+        # Check to be sure no wrong request was send
+        response.raise_for_status()
+
+        return response
+
+
+def fetch_activity_pages(access_token, rate_limiter=None, before=None, per_page=BACKFILL_PAGE_SIZE,
+                         max_parallel=BACKFILL_MAX_PARALLEL_PAGES):
+
+    """ Generator which gets the pages of the activities of an athlete from the Strava API, from new to old, and
+        yields them in order as (page, activities). With before (epoch in UTC) only the activities which started
+        earlier are paged through. The next max_parallel pages are requested speculatively in parallel, and no new
+        pages are requested once the first empty page has been found"""
+
+    activities_url = STRAVA_API_URL + "/athlete/activities"
+    rate_limiter = rate_limiter or RateLimiter()
+
+    def get_page(page):
+        auth_params = {"access_token": access_token,
+                       "page": page,
+                       "per_page": per_page}
+        if before is not None:
+            auth_params["before"] = before
+
+        return strava_get(activities_url, auth_params, rate_limiter).json()
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        # Start the first window of pages
+        futures = {page: executor.submit(get_page, page) for page in range(1, 1 + max_parallel)}
+        next_page = 1 + max_parallel
+        page = 1
+
+        try:
+            while True:
+                page_activities = futures.pop(page).result()
+
+                # The first empty page means all the activities have been retrieved
+                if len(page_activities) == 0:
+                    break
+
+                yield page, page_activities
+
+                # Slide the window - request the next page while the following ones are still running
+                futures[next_page] = executor.submit(get_page, next_page)
+                next_page += 1
+                page += 1
+
+        finally:
+            # Do not start the speculative requests which are no longer needed
+            for future in futures.values():
+                future.cancel()
+
+
 def get_current_auth_info(user_id):
 
     """ Function to retrieve the current authentication information from the postGRE Strava database"""
@@ -159,19 +628,51 @@ def get_current_auth_info(user_id):
     return auth_info
 
 
-def update_auth_key(user_id, response):
+def user_exists(user_id):
+
+    """ Function to check if a user has connected the app - has authentication information in the postGRE Strava
+        database"""
+
+    query = """SELECT 1 FROM auth_info WHERE user_id = %s"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(query, (user_id,))
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return bool(conn_obj.query_result)
+
+
+# Query to store new authentication information of a user
+AUTH_UPDATE_QUERY = """ UPDATE auth_info
+                        SET auth_key = %s,
+                            recovery_key = %s,
+                            expiration_date = %s
+                        WHERE user_id = %s """
+
 
-    """ Function to update the authentication key and recovery key in the postGRE Strava database"""
+def update_auth_key(user_id, response, conn_obj=None):
+
+    """ Function to update the authentication key and recovery key in the postGRE Strava database. The update runs
+        on the given connection - e.g. the one holding the lock of the refresh - or on a new one.
+        Returns True when the keys have been committed"""
 
     # Build the query to update the authentication information
-    query = """ UPDATE auth_info 
-                SET auth_key = %s,
-                    recovery_key = %s,
-                    expiration_date = %s
-                WHERE user_id = %s """
+    query = AUTH_UPDATE_QUERY
+
     # Make tuple of parameters to perform the update
     params = (response['access_token'], response['refresh_token'], response['expires_at'], user_id)
 
+    if conn_obj is not None:
+        return conn_obj.update_data(query, params)
+
     # Make an object from the ConnectToDB class
     conn_obj = ConnectToDB()
 
@@ -179,137 +680,510 @@ def update_auth_key(user_id, response):
     conn_obj.initialize_connection()
 
     # Perform the update in the database
-    conn_obj.update_data(query, params)
+    updated = conn_obj.update_data(query, params)
 
     # Close the connection
     conn_obj.close_connection()
 
+    return updated
 
-def get_new_recovery_key(user_id):
 
-    """Function to get a new recovery token when the authentication token has expired """
+def get_new_recovery_key(user_id, margin=0):
 
-    token_url = "https://www.strava.com/api/v3/oauth/token"
-    auth_params = read_api_secrets()
-    auth_params['refresh_token'] = get_current_auth_info(user_id)['recovery_key']
-    auth_params['grant_type'] = 'refresh_token'
+    """Function to get a new recovery token when the authentication token has expired. The refresh holds an
+       advisory lock on the user in the postGRE Strava database, so only one process refreshes the token of a user
+       at a time - a process which waited for the lock finds the new token and does not refresh again.
+       Returns the authentication information after the refresh, None when the refresh failed or the new keys
+       could not be stored. Raises the HTTPError when Strava refuses the recovery token"""
+
+    token_url = STRAVA_API_URL + "/oauth/token"
+    lock_query = """SELECT pg_advisory_xact_lock(hashtext(%s))"""
+    auth_query = """SELECT auth_key, recovery_key, expiration_date FROM auth_info WHERE user_id = %s"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
 
     try:
+        # Wait for a refresh of another process - the lock is released at the end of the transaction
+        conn_obj.query_data(lock_query, ('strava_token:{}'.format(user_id),))
+        conn_obj.query_data(auth_query, (user_id,))
+
+        auth_info = {}
+        auth_info['auth_key'], auth_info['recovery_key'], auth_info['expiration_date'] = conn_obj.query_result[0]
+
+        # Another process has refreshed the token in the meantime
+        if auth_info['expiration_date'] - margin > time.time():
+            return auth_info
+
+        auth_params = read_api_secrets()
+        auth_params['refresh_token'] = auth_info['recovery_key']
+        auth_params['grant_type'] = 'refresh_token'
+
         # Perform a post request to request new a new authentication token and recovery token
-        response = requests.post(url=token_url, params=auth_params)
-        print(response.url)
+        start = time.perf_counter()
+        response = get_strava_session().post(url=token_url, params=auth_params, timeout=HTTP_TIMEOUT_SECONDS)
+        metrics.STRAVA_SECONDS.observe(time.perf_counter() - start, endpoint=metrics.strava_endpoint(token_url),
+                                       status=response.status_code)
 
         # Check if an HTTP error has occurred - invalid request
         response.raise_for_status()
 
-        # Update the new received authentication key and recovery token in the postGRE Strava database
-        update_auth_key(user_id=user_id, response=response.json())
+        # Update the new received authentication key and recovery token in the postGRE Strava database - the commit
+        # releases the lock. Strava may have replaced the recovery token, a token which is not stored can not be used
+        token = response.json()
+        if not update_auth_key(user_id, token, conn_obj):
+            print("The new tokens of user {} could not be stored".format(user_id))
+            return None
+
+        return {'auth_key': token['access_token'],
+                'recovery_key': token['refresh_token'],
+                'expiration_date': token['expires_at']}
 
     except requests.exceptions.HTTPError as err:
         print(err)
 
+        # Strava refuses the recovery token of an athlete who revoked the access of the app - raised, so a caller
+        # can tell it from an outage
+        if err.response is not None and err.response.status_code in (400, 401):
+            raise
+        return None
+
+    finally:
+        # Close the connection
+        conn_obj.close_connection()
+
+
+class TokenProvider:
+    """ This Class caches the access tokens of the users in memory until shortly before they expire. A token which
+        comes within margin seconds of its expiration is refreshed before it is handed out. Only one thread per user
+        refreshes at a time - the other threads wait for it and get the refreshed token - and across processes the
+        refresh is guarded by an advisory lock in the postGRE Strava database"""
+
+    # Initialize an object of the class
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        self.margin = margin
+        self.hits = 0
+        self.loads = 0
+        self.refreshes = 0
+        self._tokens = {}
+        self._user_locks = {}
+        self._lock = threading.Lock()
+
+    def _is_valid(self, auth_info):
+        return auth_info is not None and auth_info['expiration_date'] - self.margin > time.time()
+
+    def _user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def get_access_token(self, user_id):
+
+        """ Method to get a valid access token of a user - waits when the token of the user is being refreshed"""
+
+        auth_info = self._tokens.get(user_id)
+        if self._is_valid(auth_info):
+            self.hits += 1
+            return auth_info['auth_key']
+
+        # Single flight - the first thread loads or refreshes the token, the others wait and find it in the cache
+        with self._user_lock(user_id):
+            auth_info = self._tokens.get(user_id)
+            if self._is_valid(auth_info):
+                self.hits += 1
+                return auth_info['auth_key']
+
+            auth_info = get_current_auth_info(user_id)
+            self.loads += 1
+
+            if not self._is_valid(auth_info):
+                auth_info = get_new_recovery_key(user_id, margin=self.margin)
+                self.refreshes += 1
+
+            if auth_info is None:
+                raise RuntimeError("No valid access token for user {}".format(user_id))
+
+            self._tokens[user_id] = auth_info
+
+            return auth_info['auth_key']
+
+    def invalidate(self, user_id):
+
+        """ Method to forget the token of a user - e.g. when Strava did not accept it"""
+
+        self._tokens.pop(user_id, None)
+
+    def stats(self):
+
+        """ Method to get the counters of the token provider"""
+
+        return {'users': len(self._tokens), 'hits': self.hits, 'loads': self.loads, 'refreshes': self.refreshes}
+
+
+# Process-wide token provider
+token_provider = TokenProvider()
+
+
+def get_access_token(user_id):
+
+    """ Function to get a valid access token of a user out of the process-wide token provider"""
+
+    return token_provider.get_access_token(user_id)
+
+
+def insert_activities(activities, upsert=False, bulk=None):
+
+    """Function to upload a pandas dataframe containing activities into the postGRE Strava database.
+       With upsert=True activities which are already known are updated in place with one single
+       INSERT ... ON CONFLICT (user_id, id) DO UPDATE statement - unchanged activities are left alone. Large
+       writes - BULK_LOAD_MIN_ROWS activities or more, or bulk=True - are streamed with COPY. Returns True when the
+       rows have been committed"""
+
+    return _write_activities(activities, upsert, bulk) is not None
+
+
+def _write_activities(activities, upsert=False, bulk=None):
+
+    """ Function to write the activities like insert_activities - returns the ids of the activities which have
+        actually been inserted or changed, None when the write failed"""
+
+    # An upsert can not touch the same row twice in one statement - keep the most recent version of an activity
+    if upsert:
+        activities = activities.drop_duplicates(subset='id', keep='last')
+
+    if bulk is None:
+        bulk = len(activities) >= BULK_LOAD_MIN_ROWS
+
+    # Prepare the statements for loading the data table in the postGRE Strava database
+    if bulk:
+        write_statements = _copy_activities_statements(activities, upsert)
+    else:
+        write_statements = _insert_activities_statements(activities, upsert)
+
+    # Write the activities and refresh the monthly totals of the affected months in the same transaction
+    ids = [int(x) for x in activities.id]
+    statements = _with_rollup_refresh(activities.user_id.unique(), ids, write_statements)
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the insert in the database - all rows in one statement
+    inserted = conn_obj.execute_transaction(statements)
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    if not inserted:
+        return None
+
+    return [row[0] for row in conn_obj.query_result]
+
+
+def _upsert_clause(columns):
+
+    # The key of an activity is (user_id, id) - the activities table can be hash partitioned on user_id, see schema.py.
+    # A row which would not change is not updated, so it does not show up as written
+    columns = [column for column in columns if column not in ('user_id', 'id')]
+
+    return " ON CONFLICT (user_id, id) DO UPDATE SET " + \
+           ', '.join("{0} = EXCLUDED.{0}".format(column) for column in columns) + \
+           " WHERE ({}) IS DISTINCT FROM ({})".format(', '.join("activities." + column for column in columns),
+                                                     ', '.join("EXCLUDED." + column for column in columns))
+
+
+def _record_written(query):
+
+    # The keys of the rows which are actually inserted or updated are kept in the written_activities table
+    return "WITH written AS ({} RETURNING user_id, id) " \
+           "INSERT INTO written_activities SELECT user_id, id FROM written".format(query)
+
 
-def insert_activities(activities):
+def _insert_activities_statements(activities, upsert):
 
-    """Function to upload a pandas dataframe containing activities into the postGRE Strava database"""
+    """ Function to get the statement which writes the activities with one multi-row INSERT"""
 
-    # Prepare query for loading the data table in the postGRE Strava database
     columns = ','.join(list(activities.columns))
-    tuples = [tuple(x) for x in activities.to_numpy()]
+    tuples = [tuple(x) for x in activities.to_numpy(dtype=object, na_value=None)]
 
     query = "INSERT INTO activities({}) VALUES %s".format(columns)
 
+    if upsert:
+        query += _upsert_clause(activities.columns)
+
+    return [('execute_values', _record_written(query), tuples)]
+
+
+def activities_to_csv(activities):
+
+    """ Function to write the activities as CSV in an in-memory buffer in the format read by COPY - the columns
+        are formatted by pandas column by column, missing values are written as \\N"""
+
+    buffer = io.StringIO()
+    activities.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+
+    return buffer
+
+
+def _copy_activities_statements(activities, upsert):
+
+    """ Function to get the statements which stream the activities with COPY. COPY can not resolve conflicts,
+        so an upsert copies the rows into a staging table first and merges them with one INSERT ... SELECT"""
+
+    columns = ','.join(list(activities.columns))
+    copy_options = "WITH (FORMAT csv, NULL '\\N')"
+    buffer = activities_to_csv(activities)
+
+    # Without an upsert a conflict fails the COPY - every row is written
+    if not upsert:
+        return [('copy', "COPY activities({}) FROM STDIN {}".format(columns, copy_options), buffer),
+                ('execute', """INSERT INTO written_activities SELECT user_id, id FROM activities
+                               WHERE id = ANY(%s)""", ([int(x) for x in activities.id],))]
+
+    create_staging = """CREATE TEMP TABLE activities_staging (LIKE activities INCLUDING DEFAULTS)
+                        ON COMMIT DROP"""
+    merge = "INSERT INTO activities({0}) SELECT {0} FROM activities_staging".format(columns) + \
+            _upsert_clause(activities.columns)
+
+    return [('execute', create_staging, None),
+            ('copy', "COPY activities_staging({}) FROM STDIN {}".format(columns, copy_options), buffer),
+            ('execute', _record_written(merge), None)]
+
+
+# Writes of the activities of a user take turns - the first statement of every write transaction of a user. The
+# rollup of a month is recomputed from the activities, two transactions writing the same month at the same time
+# would not see each other's rows and the one committing last would overwrite the total of the other. The users are
+# locked in order, so two transactions of several users can not deadlock
+LOCK_USERS_QUERY = """SELECT pg_advisory_xact_lock(hashtext('activities:' || user_id))
+                      FROM (SELECT DISTINCT user_id FROM unnest(%s::bigint[]) AS users(user_id)
+                            ORDER BY user_id) AS locked"""
+
+# Every write which changed activities bumps the dataset version of the users involved - caches of the dashboard are
+# keyed on it. A write which changed nothing leaves affected_months empty and the version as it is
+BUMP_VERSION_QUERY = """INSERT INTO sync_state (user_id, data_version, updated_at)
+                        SELECT DISTINCT user_id, 1, now() FROM affected_months
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET data_version = COALESCE(sync_state.data_version, 0) + 1,
+                            updated_at = now()"""
+
+
+def _with_rollup_refresh(user_ids, activity_ids, write_statements):
+
+    """ Function to wrap the statements which write the given activities of the given users with the statements
+        which keep the monthly_totals rollup up to date. The writes of the users are serialized with
+        LOCK_USERS_QUERY. The write statements record the keys of the rows they change in the written_activities
+        table - the months of those rows before and after the write are collected, and only the totals of those
+        (user_id, year_month) combinations are recomputed. The ids of the written rows are the result of the last
+        statement"""
+
+    lock_users = ('execute', LOCK_USERS_QUERY, ([int(x) for x in user_ids],))
+
+    track_written = """CREATE TEMP TABLE written_activities ON COMMIT DROP AS
+                       SELECT user_id, id FROM activities WITH NO DATA"""
+
+    track_before = """CREATE TEMP TABLE activities_before ON COMMIT DROP AS
+                      SELECT user_id, id, year_month FROM activities WHERE id = ANY(%s)"""
+
+    track_after = """CREATE TEMP TABLE affected_months ON COMMIT DROP AS
+                     SELECT b.user_id, b.year_month
+                     FROM activities_before b JOIN written_activities w USING (user_id, id)
+                     UNION
+                     SELECT a.user_id, a.year_month
+                     FROM activities a JOIN written_activities w USING (user_id, id)"""
+
+    upsert_totals = """INSERT INTO monthly_totals (user_id, type, year_month, distance, distance_in_km,
+                                                   activity_count, moving_time, total_elevation_gain)
+                       SELECT a.user_id, a.type, a.year_month, SUM(a.distance), SUM(a.distance_in_km),
+                              COUNT(*), SUM(a.moving_time), SUM(a.total_elevation_gain)
+                       FROM activities a
+                       JOIN (SELECT DISTINCT user_id, year_month FROM affected_months) m
+                         ON a.user_id = m.user_id AND a.year_month = m.year_month
+                       GROUP BY a.user_id, a.type, a.year_month
+                       ON CONFLICT (user_id, type, year_month) DO UPDATE
+                       SET distance = EXCLUDED.distance,
+                           distance_in_km = EXCLUDED.distance_in_km,
+                           activity_count = EXCLUDED.activity_count,
+                           moving_time = EXCLUDED.moving_time,
+                           total_elevation_gain = EXCLUDED.total_elevation_gain"""
+
+    # Sport types which no longer have activities in an affected month are removed from the rollup
+    delete_empty_totals = """DELETE FROM monthly_totals t
+                             USING (SELECT DISTINCT user_id, year_month FROM affected_months) m
+                             WHERE t.user_id = m.user_id AND t.year_month = m.year_month
+                               AND NOT EXISTS (SELECT 1 FROM activities a
+                                               WHERE a.user_id = t.user_id AND a.year_month = t.year_month
+                                                 AND a.type = t.type)"""
+
+    return [lock_users, ('execute', track_before, (activity_ids,)), ('execute', track_written, None)] + \
+           write_statements + \
+           [('execute', track_after, None),
+            ('execute', upsert_totals, None),
+            ('execute', delete_empty_totals, None),
+            ('execute', BUMP_VERSION_QUERY, None),
+            ('query', "SELECT id FROM written_activities", None)]
+
+
+def delete_activities(user_id, activity_ids):
+
+    """ Function to delete activities of a user from the postGRE Strava database - the monthly totals of their months
+        are refreshed in the same transaction. Returns True when the delete has been committed"""
+
+    ids = [int(x) for x in activity_ids]
+    if len(ids) == 0:
+        return True
+
+    statements = _with_rollup_refresh([user_id], ids,
+                                      [('execute',
+                                        _record_written("DELETE FROM activities WHERE user_id = %s AND id = ANY(%s)"),
+                                        (user_id, ids))])
+
     # Make an object from the ConnectToDB class
     conn_obj = ConnectToDB()
 
     # Initialize the connection to the database
     conn_obj.initialize_connection()
 
-    # Perform the insert in the database
-    conn_obj.insert_data(query, tuples)
+    # Perform the delete in the database
+    deleted = conn_obj.execute_transaction(statements)
 
     # Close the connection
     conn_obj.close_connection()
 
+    return deleted
 
-def initialize_activities(user_id):
 
-    """ Function to get all activities for a new user and upload them in the postGRE Strava database"""
-    activities = []
-    activities_url = "https://www.strava.com/api/v3/athlete/activities"
-    page = 1
-    user_auth_info = get_current_auth_info(user_id)
+def delete_user_data(user_id):
 
-    # Check if the current authentication key is still valid - get an updated one if necessary
-    if user_auth_info['expiration_date'] < time.time():
-        get_new_recovery_key(user_id)
-        user_auth_info = get_current_auth_info(user_id)
+    """ Function to remove a user who deauthorized the app - the activities, the monthly totals, the tokens and the
+        sync progress are removed in one transaction. The dataset version is kept and bumped, so caches keyed on
+        it do not serve the removed data. Returns True when the delete has been committed"""
 
-    # Write a loop to get all the activities of an athlete - retrieve 50 activities per page
-    while True:
-        # Create the parameters to build the API request query
-        auth_params = {"access_token": user_auth_info['auth_key'],
-                       "page": page,
-                       "per_page": 50}
+    statements = [('execute', LOCK_USERS_QUERY, ([int(user_id)],)),
+                  ('execute', """CREATE TEMP TABLE affected_months ON COMMIT DROP AS
+                                 SELECT DISTINCT user_id, year_month FROM activities WHERE user_id = %s""",
+                   (user_id,)),
+                  ('execute', "DELETE FROM activities WHERE user_id = %s", (user_id,)),
+                  ('execute', "DELETE FROM monthly_totals WHERE user_id = %s", (user_id,)),
+                  ('execute', BUMP_VERSION_QUERY, None),
+                  ('execute', "DELETE FROM auth_info WHERE user_id = %s", (user_id,)),
+                  ('execute', """UPDATE sync_state
+                                 SET last_start_epoch = NULL, last_activity_id = NULL,
+                                     backfill_before = NULL, backfill_completed = FALSE, updated_at = now()
+                                 WHERE user_id = %s""", (user_id,))]
 
-        try:
-            # Build the query to get the activities
-            response = requests.get(url=activities_url, params=auth_params)
-            # Check to be sure no wrong request was send
-            response.raise_for_status()
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
 
-            # Check if the response still has data - if so continue loop
-            if len(response.json()) > 0:
-                # Append the results to the activities list
-                activities.append(response.json())
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
 
-                # Increase the page for a new query and continue the loop
-                page += 1
-                continue
+    # Perform the delete in the database
+    deleted = conn_obj.execute_transaction(statements)
 
-            # Break the loop if no results are found anymore
-            else:
-                print("The number of pages is {}".format(page))
-                break
+    # Close the connection
+    conn_obj.close_connection()
 
-        except requests.exceptions.HTTPError as err:
-            print(err)
-            break
+    # The token of the user is no longer valid
+    token_provider.invalidate(user_id)
+
+    return deleted
+
+
+def verify_monthly_totals(user_id=None):
+
+    """ Function to compare the monthly_totals rollup with the totals computed from the activities table -
+        for one user or for all users. Returns a dataframe with the (user_id, type, year_month) combinations
+        which do not match"""
+
+    query = """WITH fresh AS (
+                   SELECT user_id, type, year_month, SUM(distance) AS distance, COUNT(*) AS activity_count,
+                          SUM(moving_time) AS moving_time, SUM(total_elevation_gain) AS total_elevation_gain
+                   FROM activities
+                   WHERE %(user_id)s IS NULL OR user_id = %(user_id)s
+                   GROUP BY user_id, type, year_month),
+               rollup AS (
+                   SELECT user_id, type, year_month, distance, activity_count, moving_time, total_elevation_gain
+                   FROM monthly_totals
+                   WHERE %(user_id)s IS NULL OR user_id = %(user_id)s)
+               SELECT user_id, type, year_month,
+                      fresh.activity_count AS expected_count, rollup.activity_count AS rollup_count,
+                      fresh.distance::double precision AS expected_distance,
+                      rollup.distance::double precision AS rollup_distance
+               FROM fresh
+               FULL OUTER JOIN rollup USING (user_id, type, year_month)
+               WHERE fresh.activity_count IS DISTINCT FROM rollup.activity_count
+                  OR fresh.moving_time IS DISTINCT FROM rollup.moving_time
+                  OR ABS(COALESCE(fresh.distance, 0) - COALESCE(rollup.distance, 0)) > 0.01
+                  OR ABS(COALESCE(fresh.total_elevation_gain, 0) - COALESCE(rollup.total_elevation_gain, 0)) > 0.01
+               ORDER BY user_id, year_month, type"""
 
-    # Create a dataframe from the activities out of Strava - create / transform necessary columns
-    data = pd.DataFrame([dct for lst in activities for dct in lst])
-    data['user_id'] = user_id
-    data['start_epoch'] = [datetime.strptime(d['start_date_local'], "%Y-%m-%dT%H:%M:%SZ").timestamp()
-                           for lst in activities for d in lst]
-    data['year_month'] = pd.to_datetime(data.start_epoch.astype(int), unit='s').dt.to_period("M").dt.to_timestamp()
-    data['distance_in_km'] = data['distance'].div(1000)
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
 
-    # Keep only relevant columns
-    data = data[['id', 'user_id', 'name', 'distance', 'moving_time', 'total_elevation_gain', 'type', 'start_date_local',
-                 'location_city', 'location_state', 'location_country', 'achievement_count', 'kudos_count',
-                 'comment_count',
-                 'athlete_count', 'trainer', 'commute', 'manual', 'private', 'gear_id', 'average_speed', 'max_speed',
-                 'has_heartrate', 'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low', 'pr_count',
-                 'total_photo_count', 'average_watts', 'kilojoules', 'start_epoch', 'year_month', 'distance_in_km']]
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
 
-    # Update the activities in the postGRE strava database
-    insert_activities(data)
+    # Perform the query
+    conn_obj.query_data(query, {'user_id': user_id})
 
+    # Close the connection
+    conn_obj.close_connection()
 
-def update_strava_activity(user_id):
+    return pd.DataFrame.from_records(columns=['user_id', 'type', 'year_month', 'expected_count', 'rollup_count',
+                                              'expected_distance', 'rollup_distance'],
+                                     data=conn_obj.query_result or [])
 
-    """ Function to perform an update of the most recent activities of user in the postGRE Strava database
-        In order to do this easy - a request of the last 50 activities is made from the strava API.
-        To keep it simple - corresponding activities in the postGRE Strava database are removed and
-        re-uploaded."""
 
-    select_query = """SELECT DISTINCT id FROM activities WHERE user_id = %s
-                       ORDER BY id DESC LIMIT 50"""
+def rebuild_monthly_totals(user_id=None):
 
-    delete_query = """DELETE FROM activities where id IN (%s)"""
-    activities = []
-    activities_url = "https://www.strava.com/api/v3/athlete/activities"
-    user_auth_info = get_current_auth_info(user_id)
+    """ Function to rebuild the monthly_totals rollup from the activities table - for one user or for all users.
+        Returns True when the rebuild has been committed"""
+
+    delete_query = """DELETE FROM monthly_totals WHERE %(user_id)s IS NULL OR user_id = %(user_id)s"""
+
+    insert_query = """INSERT INTO monthly_totals (user_id, type, year_month, distance, distance_in_km,
+                                                  activity_count, moving_time, total_elevation_gain)
+                      SELECT user_id, type, year_month, SUM(distance), SUM(distance_in_km),
+                             COUNT(*), SUM(moving_time), SUM(total_elevation_gain)
+                      FROM activities
+                      WHERE %(user_id)s IS NULL OR user_id = %(user_id)s
+                      GROUP BY user_id, type, year_month"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    bump_query = """UPDATE sync_state SET data_version = COALESCE(data_version, 0) + 1, updated_at = now()
+                     WHERE %(user_id)s IS NULL OR user_id = %(user_id)s"""
+
+    # Keep the writers out while the rollup is replaced - the writes of the user, or all writes for all the users
+    lock = ('execute', LOCK_USERS_QUERY, ([int(user_id)],)) if user_id is not None else \
+        ('execute', "LOCK TABLE activities IN SHARE MODE", None)
+
+    # Replace the rollup in one transaction - readers see the old or the new totals
+    rebuilt = conn_obj.execute_transaction([lock,
+                                            ('execute', delete_query, {'user_id': user_id}),
+                                            ('execute', insert_query, {'user_id': user_id}),
+                                            ('execute', bump_query, {'user_id': user_id})])
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return rebuilt
+
+
+def get_dataset_version(user_id):
+
+    """ Function to get the version of the data of a user - the version is bumped by every write of activities"""
+
+    query = """SELECT data_version FROM sync_state WHERE user_id = %s"""
 
     # Make an object from the ConnectToDB class
     conn_obj = ConnectToDB()
@@ -318,77 +1192,113 @@ def update_strava_activity(user_id):
     conn_obj.initialize_connection()
 
     # Perform the query
-    conn_obj.query_data(select_query, (user_id,))
+    conn_obj.query_data(query, (user_id,))
 
     # Close the connection
     conn_obj.close_connection()
 
-    # Make a list of activities we already know
-    known_activity_ids = [t[0] for t in conn_obj.query_result]
+    if not conn_obj.query_result or conn_obj.query_result[0][0] is None:
+        return 0
 
-    # Check if the current authentication key is still valid - get an updated one if necessary
-    if user_auth_info['expiration_date'] < time.time():
-        get_new_recovery_key(user_id)
-        user_auth_info = get_current_auth_info(user_id)
+    return conn_obj.query_result[0][0]
 
-    # Create the parameters to build the API request query - just request the last 50 activities
-    auth_params = {"access_token": user_auth_info['auth_key'],
-                   "page": 1,
-                   "per_page": 50}
-    try:
-        # Build the query to get the activities
-        response = requests.get(url=activities_url, params=auth_params)
-        # Check to be sure no wrong request was send
-        response.raise_for_status()
 
-        # Get the result from the query
-        activities.append(response.json())
+def get_sync_watermark(user_id):
+
+    """ Function to get the high-water mark (latest start_epoch and activity id) of the last sync of a user.
+        When no watermark has been recorded yet - no sync state, or a state written by a delete or a version bump
+        only - the watermark is derived from the activities table"""
+
+    watermark = {'last_start_epoch': None, 'last_activity_id': None}
+
+    # Both MAX are answered by the indexes on (user_id, start_epoch) and (user_id, id)
+    query = """SELECT COALESCE(s.last_start_epoch, a.max_start_epoch),
+                      CASE WHEN s.last_start_epoch IS NULL THEN a.max_id ELSE s.last_activity_id END
+               FROM (SELECT MAX(start_epoch) AS max_start_epoch, MAX(id) AS max_id
+                     FROM activities WHERE user_id = %s) a
+               LEFT JOIN sync_state s ON s.user_id = %s"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(query, (user_id, user_id))
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    if conn_obj.query_result:
+        watermark['last_start_epoch'], watermark['last_activity_id'] = conn_obj.query_result[0]
+
+    return watermark
 
-    except requests.exceptions.HTTPError as err:
-        print(err)
 
-    # Create a dataframe from the activities out of Strava - create / transform necessary columns
-    data = pd.DataFrame([dct for lst in activities for dct in lst])
+def update_sync_watermark(user_id, last_start_epoch, last_activity_id):
+
+    """ Function to store the high-water mark of a user after a successful sync - the watermark never moves back"""
+
+    query = """ INSERT INTO sync_state (user_id, last_start_epoch, last_activity_id, updated_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (user_id) DO UPDATE
+                SET last_start_epoch = GREATEST(sync_state.last_start_epoch, EXCLUDED.last_start_epoch),
+                    last_activity_id = GREATEST(sync_state.last_activity_id, EXCLUDED.last_activity_id),
+                    updated_at = now() """
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the update in the database
+    conn_obj.update_data(query, (user_id, int(last_start_epoch), int(last_activity_id)))
+
+    # Close the connection
+    conn_obj.close_connection()
+
+
+def normalize_activities(activities, user_id):
+
+    """ Function to turn a list of Strava activities (dicts) into a dataframe with the columns of ACTIVITY_SCHEMA.
+        Missing fields get the default of the schema, and all the derived columns are computed per column.
+        The start_date_local is the wall clock time of the activity - the start_epoch and year_month are
+        computed from it as if it were UTC, so they do not depend on the timezone of the machine"""
+
+    raw_columns = [column for column in ACTIVITY_COLUMNS if column not in DERIVED_COLUMNS]
+
+    # Only the fields of the schema are taken out of the response - unknown keys are left behind, missing keys are NaN
+    data = pd.DataFrame.from_records(activities, columns=raw_columns) if len(activities) > 0 \
+        else pd.DataFrame(columns=raw_columns)
+
+    # Parse the local start time (YYYY-MM-DDTHH:MM:SSZ) in one go with numpy and derive the epoch and the month
+    # of the activity from it
+    start_local = data['start_date_local'].astype(str).str.slice(0, 19).to_numpy().astype('datetime64[s]')
     data['user_id'] = user_id
-    data['start_epoch'] = [datetime.strptime(d['start_date_local'], "%Y-%m-%dT%H:%M:%SZ").timestamp()
-                           for lst in activities for d in lst]
-    data['year_month'] = pd.to_datetime(data.start_epoch.astype(int), unit='s').dt.to_period("M").dt.to_timestamp()
-    data['distance_in_km'] = data['distance'].div(1000)
-
-    # Keep only relevant columns
-    data = data[['id', 'user_id', 'name', 'distance', 'moving_time', 'total_elevation_gain', 'type', 'start_date_local',
-                 'location_city', 'location_state', 'location_country', 'achievement_count', 'kudos_count',
-                 'comment_count',
-                 'athlete_count', 'trainer', 'commute', 'manual', 'private', 'gear_id', 'average_speed', 'max_speed',
-                 'has_heartrate', 'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low', 'pr_count',
-                 'total_photo_count', 'average_watts', 'kilojoules', 'start_epoch', 'year_month', 'distance_in_km']]
-
-    # Get the intersection of the last 50 activities on Strava vs last 50 activities in the postGRE Strava database
-    intersect = [(x, ) for x in list(data.loc[data.id.isin(known_activity_ids), "id"])]
-
-    # Delete the activities which are in the intersect tuple out of the activities table for the user in the postGRE
-    # Strava database
-    if len(intersect) > 0:
-        # Initialize the connection to the database
-        conn_obj.initialize_connection()
-
-        # Perform the deletion of the rows
-        conn_obj.delete_data(delete_query, intersect)
+    data['start_epoch'] = start_local.astype('int64')
+    data['year_month'] = start_local.astype('datetime64[M]').astype('datetime64[ns]')
+    data['distance_in_km'] = data['distance'].fillna(0).div(1000)
 
-        # Close the connection
-        conn_obj.close_connection()
+    # Fill in the defaults and cast every column to the type of the schema
+    for column, dtype, default in ACTIVITY_SCHEMA:
+        if default is not None:
+            data[column] = data[column].fillna(default)
+        if dtype == 'object':
+            data[column] = data[column].astype(object).where(data[column].notna(), None)
+        else:
+            data[column] = data[column].astype(dtype)
 
-    # If data contains actual data - do the upload
-    if len(data) > 0:
-        insert_activities(data)
+    return data[ACTIVITY_COLUMNS]
 
 
-def get_strava_activities(user_id):
+def get_backfill_progress(user_id):
 
-    """ Function to get the strava activities of a user in a pandas dataframe used for making the graphs
-        in the Dash app"""
+    """ Function to get the start (epoch in UTC) of the oldest activity of a backfill which has been committed to
+        the postGRE Strava database. Returns None when no backfill is running for the user"""
 
-    select_query = "SELECT * FROM activities WHERE user_id = %s"
+    query = """SELECT backfill_before, backfill_completed FROM sync_state WHERE user_id = %s"""
 
     # Make an object from the ConnectToDB class
     conn_obj = ConnectToDB()
@@ -397,20 +1307,291 @@ def get_strava_activities(user_id):
     conn_obj.initialize_connection()
 
     # Perform the query
-    conn_obj.query_data(select_query, (user_id,))
+    conn_obj.query_data(query, (user_id,))
 
     # Close the connection
     conn_obj.close_connection()
 
-    # Get the column names and the actual data in a pandas data frame
-    columnames = [t[0] for t in conn_obj.cur.description]
-    query_result = conn_obj.query_result
+    if not conn_obj.query_result:
+        return None
+
+    backfill_before, backfill_completed = conn_obj.query_result[0]
+
+    # A completed backfill starts again from the newest activity
+    if backfill_completed:
+        return None
+
+    return backfill_before
 
-    data = pd.DataFrame.from_records(columns=columnames, data=query_result)
 
-    # Group the data by type and year_month so we have aggregated data on this level
+def update_backfill_progress(user_id, before, completed=False):
 
-    data_grouped = data.groupby(['year_month', 'type'], as_index=False).agg({'distance': 'sum', 'distance_in_km': 'sum'})
+    """ Function to store the start (epoch in UTC) of the oldest activity of a backfill which has been committed to
+        the postGRE Strava database"""
+
+    query = """ INSERT INTO sync_state (user_id, backfill_before, backfill_completed, updated_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (user_id) DO UPDATE
+                SET backfill_before = EXCLUDED.backfill_before,
+                    backfill_completed = EXCLUDED.backfill_completed,
+                    updated_at = now() """
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the update in the database
+    conn_obj.update_data(query, (user_id, before, completed))
+
+    # Close the connection
+    conn_obj.close_connection()
+
+
+def _start_date_epoch(activity):
+
+    """ Function to get the start of a Strava activity as epoch in UTC - the time the before and after parameters
+        of the Strava API are compared with"""
+
+    return int(datetime.strptime(activity['start_date'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+               .timestamp())
+
+
+def _download_pages(access_token, before, page_queue, stop_event):
+
+    """ Function run in a background thread which puts the downloaded pages of activities on the page queue.
+        The queue ends with None, or with the exception which stopped the download"""
+
+    def put(item):
+        # Wait for room in the queue - give up when the consumer has stopped
+        while not stop_event.is_set():
+            try:
+                page_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for page, page_activities in fetch_activity_pages(access_token, before=before):
+            if not put((page, page_activities)):
+                return
+        put(None)
+
+    except Exception as error:
+        put(error)
+
+
+def initialize_activities(user_id, batch_size=BACKFILL_BATCH_SIZE):
+
+    """ Function to get all activities for a new user and upload them in the postGRE Strava database.
+        The pages are downloaded in a background thread while the activities of the previous pages are normalized
+        and written in batches of batch_size rows, so the memory use does not grow with the history of the athlete.
+        The pages go from new to old - after every batch the start of its oldest activity is stored, and an
+        interrupted backfill resumes with the activities which started before it"""
+
+    # Get a valid access token - refreshed when it is about to expire
+    access_token = get_access_token(user_id)
+
+    # Continue with the activities older than the last committed batch of an interrupted backfill. The pages
+    # shift when activities are added during the backfill, the start time does not. One second more than the
+    # oldest start gets the activities which started at the same second again - they are upserted
+    committed_before = get_backfill_progress(user_id)
+    before = None if committed_before is None else committed_before + 1
+    if committed_before is not None:
+        print("Resuming the backfill before {}".format(datetime.fromtimestamp(committed_before, timezone.utc)))
+
+    # Start downloading the pages in the background - the queue bounds the number of pages waiting in memory
+    page_queue = queue.Queue(maxsize=BACKFILL_QUEUE_SIZE)
+    stop_event = threading.Event()
+    downloader = threading.Thread(target=_download_pages,
+                                  args=(access_token, before, page_queue, stop_event),
+                                  daemon=True)
+    downloader.start()
+
+    batch = []
+    batch_rows = 0
+    page_count = 0
+    oldest_start = None
+    watermark = None
+    completed = False
+
+    try:
+        while True:
+            item = page_queue.get()
+
+            # Flush the batch when it is full or when all the pages have been downloaded
+            if item is not None and not isinstance(item, Exception):
+                _, page_activities = item
+                page_count += 1
+                oldest_start = min([_start_date_epoch(activity) for activity in page_activities] +
+                                   ([oldest_start] if oldest_start is not None else []))
+                with metrics.SYNC_STAGE_SECONDS.time(sync='backfill', stage='normalize'):
+                    batch.append(normalize_activities(page_activities, user_id))
+                batch_rows += len(page_activities)
+
+                if batch_rows < batch_size:
+                    continue
+
+            if batch:
+                data = pd.concat(batch, ignore_index=True)
+
+                # Stop when the batch could not be written - the backfill resumes after the last committed batch
+                with metrics.SYNC_STAGE_SECONDS.time(sync='backfill', stage='write'):
+                    if not insert_activities(data, upsert=True):
+                        break
+
+                    committed_before = oldest_start
+                    update_backfill_progress(user_id, committed_before)
+
+                metrics.SYNC_ACTIVITIES.inc(len(data), sync='backfill')
+
+                batch_watermark = (data.start_epoch.max(), data.id.max())
+                watermark = batch_watermark if watermark is None else \
+                    (max(watermark[0], batch_watermark[0]), max(watermark[1], batch_watermark[1]))
+
+                batch = []
+                batch_rows = 0
+
+            if item is None:
+                completed = True
+                break
+
+            if isinstance(item, Exception):
+                print(item)
+                break
+
+    finally:
+        stop_event.set()
+
+    print("The number of pages is {}".format(page_count))
+
+    # Let the incremental sync continue from the newest activity of the backfill
+    if watermark is not None:
+        update_sync_watermark(user_id, *watermark)
+
+    if completed:
+        update_backfill_progress(user_id, committed_before, completed=True)
+
+
+def update_strava_activity(user_id, rate_limiter=None):
+
+    """ Function to perform an incremental update of the activities of a user in the postGRE Strava database.
+        Only the activities started after the stored high-water mark are requested from the Strava API - page by
+        page until we are caught up - and they are upserted in one statement. A rate limiter can be shared by the
+        syncs of several users. Returns the activities which have been inserted or changed"""
+
+    activities = []
+    activities_url = STRAVA_API_URL + "/athlete/activities"
+    page = 1
+    rate_limiter = rate_limiter or RateLimiter()
+
+    stage_start = time.perf_counter()
+
+    # Get the high-water mark of the previous sync - step back a bit to also catch late uploads and the
+    # difference between the local start time we store and the UTC start time Strava filters on
+    watermark = get_sync_watermark(user_id)
+    after = 0
+    if watermark['last_start_epoch'] is not None:
+        after = max(int(watermark['last_start_epoch']) - SYNC_OVERLAP_SECONDS, 0)
+
+    # Get a valid access token - refreshed when it is about to expire
+    access_token = get_access_token(user_id)
+
+    metrics.SYNC_STAGE_SECONDS.observe(time.perf_counter() - stage_start, sync='incremental', stage='prepare')
+    stage_start = time.perf_counter()
+
+    # Request the activities after the watermark until an empty or incomplete page is returned
+    while True:
+        # Create the parameters to build the API request query
+        auth_params = {"access_token": access_token,
+                       "after": after,
+                       "page": page,
+                       "per_page": SYNC_PAGE_SIZE}
+
+        try:
+            # Build the query to get the activities
+            page_activities = strava_get(activities_url, auth_params, rate_limiter).json()
+
+        except requests.exceptions.HTTPError as err:
+            # Strava no longer accepts the token - get a new one on the next sync
+            if err.response is not None and err.response.status_code == 401:
+                token_provider.invalidate(user_id)
+            print(err)
+            break
+
+        if len(page_activities) > 0:
+            activities.append(page_activities)
+
+        # Strava returns the activities after the watermark in ascending order - a short page is the last one
+        if len(page_activities) < SYNC_PAGE_SIZE:
+            break
+
+        page += 1
+
+    metrics.SYNC_STAGE_SECONDS.observe(time.perf_counter() - stage_start, sync='incremental', stage='fetch')
+
+    # Nothing new since the last sync - nothing has to be written
+    if len(activities) == 0:
+        return pd.DataFrame()
+
+    # Create a dataframe from the activities out of Strava
+    with metrics.SYNC_STAGE_SECONDS.time(sync='incremental', stage='normalize'):
+        data = normalize_activities([dct for lst in activities for dct in lst], user_id)
+
+    # Upsert the activities and only move the watermark forward when they are safely stored
+    with metrics.SYNC_STAGE_SECONDS.time(sync='incremental', stage='write'):
+        written = _write_activities(data, upsert=True)
+        if written is not None:
+            update_sync_watermark(user_id, data.start_epoch.max(), data.id.max())
+            metrics.SYNC_ACTIVITIES.inc(len(written), sync='incremental')
+
+    # The overlap with the previous sync returns activities which are already stored - only the written ones are new
+    return data[data.id.isin(written or [])]
+
+
+def get_strava_activities(user_id, aggregate_in_db=True):
+
+    """ Function to get the strava activities of a user in a pandas dataframe used for making the graphs
+        in the Dash app. The dataframe has a row with the monthly distance for every month and every sport type
+        between the first and the last activity - months without activities have a distance of 0.
+        By default the monthly totals are read from the monthly_totals rollup and the gaps are filled by the
+        postGRE Strava database. With aggregate_in_db=False the activities are aggregated in pandas"""
+
+    if aggregate_in_db:
+        return _get_monthly_distance_from_db(user_id)
+
+    select_query = "SELECT * FROM activities WHERE user_id = %s"
+    columns = ['year_month', 'type', 'distance', 'distance_in_km']
+
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Stream the activities and fold every chunk into the monthly totals per type - only one chunk of rows
+    # is in memory at a time
+    data_grouped = pd.DataFrame(columns=columns).set_index(['year_month', 'type'])
+
+    try:
+        for rows in conn_obj.stream_query(select_query, (user_id,), columns=columns):
+            chunk = pd.DataFrame.from_records(rows, columns=columns)
+            chunk_grouped = chunk.groupby(['year_month', 'type']).agg({'distance': 'sum', 'distance_in_km': 'sum'})
+            data_grouped = chunk_grouped if data_grouped.empty else data_grouped.add(chunk_grouped, fill_value=0)
+
+    finally:
+        # Close the connection
+        conn_obj.close_connection()
+
+    return build_monthly_grid(data_grouped.reset_index())
+
+
+def build_monthly_grid(data_grouped):
+
+    """ Function to turn the monthly distance per sport type into the grid used for making the graphs - a row for
+        every month and every sport type between the first and the last month, missing months get a distance of 0"""
 
     # In order to generate the Bar Chart we need data for each time point for each sport type a data point
     # Get the start and the end point
@@ -442,4 +1623,48 @@ def get_strava_activities(user_id):
     return cart
 
 
+def _get_monthly_distance_from_db(user_id):
+
+    """ Function to get the monthly distance per sport type of a user out of the monthly_totals rollup, gap-filled
+        by the postGRE Strava database - the result has the same columns as the grid built in pandas"""
+
+    select_query = """WITH monthly AS (
+                          SELECT year_month, type,
+                                 distance::double precision AS distance,
+                                 distance_in_km::double precision AS distance_in_km
+                          FROM monthly_totals
+                          WHERE user_id = %(user_id)s),
+                      bounds AS (
+                          SELECT MIN(year_month)::timestamp AS first_month,
+                                 MAX(year_month)::timestamp AS last_month
+                          FROM monthly),
+                      months AS (
+                          SELECT generate_series(first_month, last_month, interval '1 month') AS year_month
+                          FROM bounds),
+                      types AS (
+                          SELECT DISTINCT type FROM monthly)
+                      SELECT months.year_month, types.type,
+                             COALESCE(monthly.distance, 0) AS distance,
+                             COALESCE(monthly.distance_in_km, 0) AS distance_in_km
+                      FROM months
+                      CROSS JOIN types
+                      LEFT JOIN monthly ON monthly.year_month = months.year_month AND monthly.type = types.type
+                      ORDER BY months.year_month, types.type"""
 
+    # Make an object from the ConnectToDB class
+    conn_obj = ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(select_query, {'user_id': user_id})
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    cart = pd.DataFrame.from_records(columns=['year_month', 'type', 'distance', 'distance_in_km'],
+                                     data=conn_obj.query_result or [])
+    cart['year_month'] = cart.year_month.astype('datetime64[ns]')
+
+    return cart
@@ -0,0 +1,416 @@
+""" Detailed time series of the activities (streams) - the GPS track, heart rate, power, altitude and distance per
+    sample, as served by /activities/<id>/streams of the Strava API. They are stored in the activity_streams table
+    of the postGRE Strava database as compact binary typed arrays:
+
+    * every stream is quantized to an integer type (coordinates in 1e-7 degree, altitude and distance in dm,
+      heart rate in uint8, power in uint16), the monotone ones are delta encoded, and the block is compressed
+    * next to the full resolution, downsampled levels of detail are stored: 'route' levels keep the points of the
+      GPS track picked by Douglas-Peucker, 'series' levels keep the minimum and maximum of every metric per bucket
+      of samples, so peaks of the effort charts survive the downsampling
+
+    A chart asks for the number of points it can show and gets the smallest level which has at least that many.
+    The streams of the newest activities without streams are fetched by the sync of a user - at most
+    STREAMS_PER_SYNC activities per sync, and only while the usage reported by Strava stays below
+    STREAMS_RATE_SHARE of the 15-minute and the daily limit, so the backlog of an athlete is worked off without
+    eating the rate budget of the sync."""
+
+import heapq
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+import psycopg2
+import requests
+
+import Strava_functions
+import metrics
+
+
+# Activities per sync of a user of which the streams are fetched - 0 switches the streams off
+STREAMS_PER_SYNC = int(os.environ.get("STRAVADASH_STREAMS_PER_SYNC", "10"))
+
+# Share of the 15-minute and daily rate limits the stream fetches may use - the rest is left for the activities
+STREAMS_RATE_SHARE = float(os.environ.get("STRAVADASH_STREAMS_RATE_SHARE", "0.5"))
+
+# Streams requested from the Strava API - latlng is split into lat and lng
+STREAM_KEYS = ('time', 'distance', 'latlng', 'altitude', 'heartrate', 'watts')
+
+# How every stream is stored - (dtype, scale, delta encoded). The values are multiplied by the scale and rounded
+STREAM_ENCODINGS = {'time': ('int32', 1, True),
+                    'distance': ('int32', 10, True),
+                    'lat': ('int32', 10 ** 7, True),
+                    'lng': ('int32', 10 ** 7, True),
+                    'altitude': ('int32', 10, True),
+                    'heartrate': ('uint8', 1, False),
+                    'watts': ('uint16', 1, False)}
+
+# Levels of detail stored next to the full resolution - (kind, maximum number of points)
+LEVELS = [('route', 1000), ('route', 250), ('series', 2000), ('series', 500)]
+
+# Metrics of which the minimum and maximum per bucket are kept by the 'series' levels
+SERIES_METRICS = ('heartrate', 'watts', 'altitude')
+
+# Header of a stored block - magic, version and the length of the JSON description of the arrays
+BLOCK_MAGIC = b'SDS'
+BLOCK_HEADER = struct.Struct('<3sBI')
+
+
+def streams_from_response(body):
+
+    """ Function to turn the streams of an activity as returned by the Strava API (key_by_type=true) into a dict
+        of numpy arrays - missing samples are NaN"""
+
+    streams = {}
+
+    for key, stream in body.items():
+        data = stream.get('data') if isinstance(stream, dict) else None
+        if not data:
+            continue
+
+        if key == 'latlng':
+            coordinates = np.array([point if point else (np.nan, np.nan) for point in data], dtype=np.float64)
+            streams['lat'], streams['lng'] = coordinates[:, 0], coordinates[:, 1]
+        elif key in STREAM_ENCODINGS:
+            streams[key] = np.array([np.nan if value is None else value for value in data], dtype=np.float64)
+
+    return streams
+
+
+def _fill_gaps(values):
+
+    """ Function to fill the missing samples of a stream with the last known sample - missing samples at the start
+        get the first known sample. A stream without any known sample stays NaN"""
+
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    if not missing.any() or missing.all():
+        return values
+
+    known = np.where(missing, np.argmin(missing), np.arange(len(values)))
+
+    return values[np.maximum.accumulate(known)]
+
+
+def encode_streams(streams):
+
+    """ Function to pack the streams of an activity into one compressed binary block"""
+
+    arrays = []
+    description = []
+
+    for name, values in streams.items():
+        dtype, scale, delta = STREAM_ENCODINGS[name]
+        info = np.iinfo(dtype)
+
+        quantized = np.rint(np.nan_to_num(_fill_gaps(values)) * scale)
+        quantized = np.clip(quantized, info.min, info.max).astype(dtype)
+
+        # Small steps between neighbouring samples compress much better than the values
+        if delta:
+            quantized = np.diff(quantized, prepend=quantized.dtype.type(0))
+
+        arrays.append(quantized.tobytes())
+        description.append([name, len(quantized)])
+
+    header = json.dumps(description).encode()
+
+    return BLOCK_HEADER.pack(BLOCK_MAGIC, 1, len(header)) + header + zlib.compress(b''.join(arrays), 6)
+
+
+def decode_streams(block):
+
+    """ Function to unpack a block written by encode_streams - returns a dict of float64 numpy arrays"""
+
+    magic, version, header_length = BLOCK_HEADER.unpack_from(block)
+    if magic != BLOCK_MAGIC or version != 1:
+        raise ValueError("Not a block of activity streams")
+
+    offset = BLOCK_HEADER.size
+    description = json.loads(bytes(block[offset:offset + header_length]))
+    payload = zlib.decompress(bytes(block[offset + header_length:]))
+
+    streams = {}
+    position = 0
+
+    for name, length in description:
+        dtype, scale, delta = STREAM_ENCODINGS[name]
+        values = np.frombuffer(payload, dtype=dtype, count=length, offset=position)
+        position += values.nbytes
+
+        # The sums wrap around like the differences did
+        if delta:
+            values = np.cumsum(values, dtype=values.dtype)
+
+        streams[name] = values / scale if scale != 1 else values.astype(np.float64)
+
+    return streams
+
+
+def route_order(lat, lng, points):
+
+    """ Function to rank the points of a GPS track with Douglas-Peucker, up to the given number of points. The
+        segment with the point furthest from its chord is split first, so the first n points of the ranking are the
+        Douglas-Peucker simplification of the track to n points - one ranking serves every level of detail"""
+
+    # Local flat projection in meters - good enough for the length of an activity
+    x = np.radians(lng) * 6371000 * np.cos(np.radians(np.mean(lat)))
+    y = np.radians(lat) * 6371000
+
+    def furthest(first, last):
+
+        # Distance of the points between first and last to the line through them
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        distance = np.abs(dx * py - dy * px) / length if length > 0 else np.hypot(px, py)
+
+        split = int(np.argmax(distance))
+        return -distance[split], first, last, first + 1 + split
+
+    order = [0, len(x) - 1]
+    segments = [furthest(0, len(x) - 1)] if len(x) > 2 else []
+
+    while segments and len(order) < points:
+        _, first, last, split = heapq.heappop(segments)
+        order.append(split)
+
+        for segment in ((first, split), (split, last)):
+            if segment[1] - segment[0] > 1:
+                heapq.heappush(segments, furthest(*segment))
+
+    return np.array(order)
+
+
+def minmax_indices(streams, points):
+
+    """ Function to get the indices of the samples kept by min-max bucketing - the samples are split in buckets
+        and the minimum and the maximum of every metric in a bucket are kept, next to the first and last sample"""
+
+    length = len(next(iter(streams.values())))
+    series = [np.asarray(streams[name], dtype=np.float64) for name in SERIES_METRICS if name in streams]
+    if not series:
+        series = [np.arange(length, dtype=np.float64)]
+
+    buckets = max((points - 2) // (2 * len(series)), 1)
+    size = -(-length // buckets)
+    indices = [np.array([0, length - 1])]
+
+    for values in series:
+        # Pad the samples to a whole number of buckets - the padding is never picked
+        padded = np.full(buckets * size, np.nan)
+        padded[:length] = values
+        padded = padded.reshape(buckets, size)
+
+        valid = ~np.all(np.isnan(padded), axis=1)
+        offsets = np.arange(buckets)[valid] * size
+        indices.append(offsets + np.nanargmin(padded[valid], axis=1))
+        indices.append(offsets + np.nanargmax(padded[valid], axis=1))
+
+    return np.unique(np.concatenate(indices))
+
+
+def build_levels(streams):
+
+    """ Function to build the levels of detail of the streams of an activity - a list of (kind, max_points, streams).
+        The full resolution has kind 'full' and max_points 0, the levels are only built when they are smaller"""
+
+    length = len(next(iter(streams.values()))) if streams else 0
+    levels = [('full', 0, streams)]
+    order = None
+
+    for kind, max_points in LEVELS:
+        if length <= max_points:
+            continue
+
+        if kind == 'route':
+            if 'lat' not in streams or np.isnan(streams['lat']).all():
+                continue
+            if order is None:
+                order = route_order(_fill_gaps(streams['lat']), _fill_gaps(streams['lng']),
+                                    max(points for level_kind, points in LEVELS if level_kind == 'route'))
+            indices = np.sort(order[:max_points])
+        else:
+            indices = minmax_indices(streams, max_points)
+
+        levels.append((kind, max_points, {name: values[indices] for name, values in streams.items()}))
+
+    return levels
+
+
+def fetch_streams(access_token, activity_id, rate_limiter=None):
+
+    """ Function to get the streams of an activity from the Strava API - returns an empty dict for an activity
+        without streams, e.g. a manual activity"""
+
+    url = "{}/activities/{}/streams".format(Strava_functions.STRAVA_API_URL, activity_id)
+    params = {"access_token": access_token, "keys": ",".join(STREAM_KEYS), "key_by_type": "true"}
+
+    try:
+        body = Strava_functions.strava_get(url, params, rate_limiter).json()
+
+    except requests.exceptions.HTTPError as err:
+        if err.response is not None and err.response.status_code == 404:
+            return {}
+        raise
+
+    return streams_from_response(body)
+
+
+def store_streams(user_id, activity_id, levels):
+
+    """ Function to write the levels of detail of an activity into the activity_streams table. An activity without
+        streams gets an empty full level, so it is not fetched again. Returns True when the rows are committed"""
+
+    query = """INSERT INTO activity_streams (user_id, activity_id, kind, max_points, points, data) VALUES %s
+               ON CONFLICT (user_id, activity_id, kind, max_points) DO UPDATE
+               SET points = EXCLUDED.points, data = EXCLUDED.data, fetched_at = now()"""
+
+    rows = [(user_id, activity_id, kind, max_points, len(next(iter(streams.values()))) if streams else 0,
+             psycopg2.Binary(encode_streams(streams)))
+            for kind, max_points, streams in levels]
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Write all the levels of the activity in one transaction
+    stored = conn_obj.execute_transaction([('execute_values', query, rows)])
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return stored
+
+
+def get_activities_without_streams(user_id, limit=STREAMS_PER_SYNC):
+
+    """ Function to get the ids of the newest activities of a user of which the streams have not been fetched -
+        manual activities have no streams and private activities are never served, both are left out"""
+
+    query = """SELECT a.id FROM activities a
+               WHERE a.user_id = %(user_id)s AND NOT a.manual AND NOT a.private
+                 AND NOT EXISTS (SELECT 1 FROM activity_streams s
+                                 WHERE s.user_id = a.user_id AND s.activity_id = a.id)
+               ORDER BY a.start_epoch DESC
+               LIMIT %(limit)s"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(query, {'user_id': user_id, 'limit': limit})
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return [row[0] for row in conn_obj.query_result or []]
+
+
+def sync_streams(user_id, rate_limiter=None, limit=STREAMS_PER_SYNC):
+
+    """ Function to fetch and store the streams of the newest activities of a user which have none yet. The rate
+        limiter should be the one shared with the sync - the fetches stop when the usage of the last response comes
+        within STREAMS_RATE_SHARE of a limit, and at the first request which fails. The next sync carries on.
+        Returns the number of activities stored"""
+
+    rate_limiter = rate_limiter or Strava_functions.RateLimiter()
+
+    # Nothing is fetched when the sync has already used the share of the streams
+    remaining = rate_limiter.remaining(STREAMS_RATE_SHARE)
+    if remaining is not None:
+        limit = min(limit, remaining)
+
+    activity_ids = get_activities_without_streams(user_id, limit) if limit > 0 else []
+    if not activity_ids:
+        return 0
+
+    access_token = Strava_functions.get_access_token(user_id)
+    stored = 0
+
+    for activity_id in activity_ids:
+        # The usage is updated by every response - also by the requests of other threads on the same limiter
+        remaining = rate_limiter.remaining(STREAMS_RATE_SHARE)
+        if remaining is not None and remaining <= 0:
+            break
+
+        try:
+            with metrics.SYNC_STAGE_SECONDS.time(sync='streams', stage='fetch'):
+                streams = fetch_streams(access_token, activity_id, rate_limiter)
+
+        except requests.exceptions.RequestException as error:
+            if getattr(error, 'response', None) is not None and error.response.status_code == 401:
+                Strava_functions.token_provider.invalidate(user_id)
+            print(error)
+            break
+
+        with metrics.SYNC_STAGE_SECONDS.time(sync='streams', stage='normalize'):
+            levels = build_levels(streams)
+
+        with metrics.SYNC_STAGE_SECONDS.time(sync='streams', stage='write'):
+            if not store_streams(user_id, activity_id, levels):
+                break
+
+        stored += 1
+
+    metrics.SYNC_ACTIVITIES.inc(stored, sync='streams')
+
+    return stored
+
+
+def load_streams(user_id, activity_id, kind='series', points=None):
+
+    """ Function to load the streams of an activity at the smallest level of detail of the given kind with at least
+        the given number of points - the full resolution when there is no such level or no points are given.
+        Only the streams of a public activity of the user are loaded. Returns (kind, max_points, streams), or None
+        when the activity is not a public activity of the user or its streams are not stored"""
+
+    query = """SELECT s.kind, s.max_points, s.data FROM activity_streams s
+               JOIN activities a ON a.user_id = s.user_id AND a.id = s.activity_id
+               WHERE s.user_id = %(user_id)s AND s.activity_id = %(activity_id)s AND NOT a.private
+                 AND (s.kind = 'full' OR (s.kind = %(kind)s AND s.max_points >= %(points)s))
+               ORDER BY s.kind = 'full', s.max_points
+               LIMIT 1"""
+
+    # Without a number of points only the full resolution matches
+    parameters = {'user_id': user_id, 'activity_id': activity_id, 'kind': kind,
+                  'points': points if points else np.iinfo(np.int32).max}
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(query, parameters)
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    if not conn_obj.query_result:
+        return None
+
+    level_kind, max_points, data = conn_obj.query_result[0]
+
+    return level_kind, max_points, decode_streams(data)
+
+
+def streams_payload(activity_id, level):
+
+    """ Function to turn a level of detail returned by load_streams into the JSON sent to the charts"""
+
+    kind, max_points, streams = level
+
+    return {'activity_id': activity_id,
+            'kind': kind,
+            'max_points': max_points,
+            'points': len(next(iter(streams.values()))) if streams else 0,
+            'streams': {name: np.round(values, 7 if name in ('lat', 'lng') else 1).tolist()
+                        for name, values in streams.items()}}
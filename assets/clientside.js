@@ -0,0 +1,140 @@
+/* Clientside callbacks of the Strava Dashboard - they filter the monthly grid of the athlete which the server sent
+   into the grid-store, so a change of a dropdown does not need a request to the server.
+
+   The grid is columnar: month holds month ordinals (months since January 1970), type holds codes into types and
+   km holds the distance in km of the month. */
+
+(function () {
+
+    var BACKGROUND = '#385448';
+
+    // Year of a month ordinal
+    function yearOf(month) {
+        return Math.floor(month / 12) + 1970;
+    }
+
+    // First day of the month of a month ordinal - e.g. 2020-03-01
+    function monthDate(month) {
+        var monthOfYear = (month % 12) + 1;
+        return yearOf(month) + '-' + (monthOfYear < 10 ? '0' : '') + monthOfYear + '-01';
+    }
+
+    // Sorted unique years in the grid
+    function gridYears(grid) {
+        var years = [];
+        for (var i = 0; i < grid.month.length; i++) {
+            var year = yearOf(grid.month[i]);
+            if (years.indexOf(year) === -1) {
+                years.push(year);
+            }
+        }
+        return years.sort(function (a, b) { return a - b; });
+    }
+
+    function noUpdate(count) {
+        var result = [];
+        for (var i = 0; i < count; i++) {
+            result.push(window.dash_clientside.no_update);
+        }
+        return result;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        stravadash: {
+
+            // Fill in the sport types and years of the athlete - keep the selection when there is data for it
+            dropdowns: function (grid, sportType, year) {
+                if (!grid) {
+                    return noUpdate(4);
+                }
+
+                var years = gridYears(grid);
+
+                if (grid.types.indexOf(sportType) === -1) {
+                    sportType = grid.types.indexOf('Run') !== -1 ? 'Run' : (grid.types.length ? grid.types[0] : null);
+                }
+                if (years.indexOf(year) === -1) {
+                    year = years.length ? years[years.length - 1] : null;
+                }
+
+                return [
+                    grid.types.map(function (t) { return {label: t, value: t}; }),
+                    sportType,
+                    years.map(function (y) { return {label: y, value: y}; }),
+                    year
+                ];
+            },
+
+            // Bar chart of the monthly distance of a sport type in a year
+            barchart: function (grid, sportType, year) {
+                if (!grid) {
+                    return window.dash_clientside.no_update;
+                }
+
+                var code = grid.types.indexOf(sportType);
+                var x = [];
+                var y = [];
+                var ticks = [];
+
+                for (var i = 0; i < grid.month.length; i++) {
+                    if (yearOf(grid.month[i]) !== year) {
+                        continue;
+                    }
+                    var date = monthDate(grid.month[i]);
+                    if (ticks.indexOf(date) === -1) {
+                        ticks.push(date);
+                    }
+                    if (grid.type[i] === code) {
+                        x.push(date);
+                        y.push(grid.km[i]);
+                    }
+                }
+
+                return {
+                    data: [{
+                        type: 'bar',
+                        x: x,
+                        y: y,
+                        marker: {color: '#636efa'},
+                        hovertemplate: 'year_month=%{x}<br>distance_in_km=%{y}<extra></extra>'
+                    }],
+                    layout: {
+                        xaxis: {tickvals: ticks.sort(), tickformat: '%b', title: {text: ''}, color: 'white',
+                                range: [(year - 1) + '-12-01', year + '-12-31']},
+                        yaxis: {ticksuffix: ' km', title: {text: ''}, color: 'white'},
+                        plot_bgcolor: BACKGROUND,
+                        paper_bgcolor: BACKGROUND
+                    }
+                };
+            },
+
+            // Indicators with the total km of every sport in a year
+            indicators: function (grid, year, sports) {
+                if (!grid) {
+                    return noUpdate(sports.length);
+                }
+
+                var totals = {};
+                for (var i = 0; i < grid.month.length; i++) {
+                    if (yearOf(grid.month[i]) === year) {
+                        var sportType = grid.types[grid.type[i]];
+                        totals[sportType] = (totals[sportType] || 0) + grid.km[i];
+                    }
+                }
+
+                return sports.map(function (sport) {
+                    return {
+                        data: [{
+                            type: 'indicator',
+                            mode: 'number',
+                            value: totals[sport[0]] || 0,
+                            title: {text: sport[1].replace('{}', year)},
+                            number: {font: {size: 56}}
+                        }],
+                        layout: {height: 200, font: {color: 'white'}, paper_bgcolor: BACKGROUND}
+                    };
+                });
+            }
+        }
+    });
+})();
@@ -0,0 +1,116 @@
+""" Benchmark of the writes of activities to the postGRE Strava database. Compares the multi-row INSERT built with
+    execute_values with the COPY path of Strava_functions.insert_activities.
+
+    Without --db only the preparation of the rows on the client is measured - the SQL text execute_values would
+    send is rebuilt with the psycopg2 adapters, next to the CSV text sent by COPY. With --db the rows are also
+    written to the database configured in neon_DB_config.json - into a temporary copy of the activities table,
+    in a transaction which is rolled back, so the database is left untouched.
+
+    Run with `python benchmarks/bench_bulk_load.py --activities 100000 [--db]`"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from psycopg2.extensions import adapt  # noqa: E402
+
+import Strava_functions  # noqa: E402
+from fake_strava import make_activities  # noqa: E402
+
+
+def prepare_insert(activities):
+
+    """ Function to build the VALUES list of the multi-row INSERT the way execute_values does - returns its size"""
+
+    tuples = [tuple(x) for x in activities.to_numpy(dtype=object, na_value=None)]
+    return len(b','.join(b'(' + b','.join(adapt(value).getquoted() for value in row) + b')' for row in tuples))
+
+
+def prepare_copy(activities):
+
+    """ Function to build the CSV buffer streamed by COPY - returns its size"""
+
+    return len(Strava_functions.activities_to_csv(activities).getvalue().encode())
+
+
+def best_of(function, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def write_to_database(activities, repeat, upsert):
+
+    """ Function to time both write paths against the database - every run writes into a fresh temporary table
+        and is rolled back"""
+
+    statements = {'execute_values': Strava_functions._insert_activities_statements,
+                  'copy': Strava_functions._copy_activities_statements}
+    timings = {}
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    try:
+        for name, make_statements in statements.items():
+            timings[name] = []
+
+            for _ in range(repeat):
+                with conn_obj.conn.cursor() as cur:
+                    # Shadow the activities table with an empty temporary copy for the duration of the transaction
+                    cur.execute("CREATE TEMP TABLE activities (LIKE public.activities INCLUDING ALL) ON COMMIT DROP")
+
+                    start = time.perf_counter()
+                    for method, query, parameters in make_statements(activities, upsert):
+                        if method == 'execute_values':
+                            Strava_functions.execute_values(cur, query, parameters,
+                                                            page_size=max(len(parameters), 1))
+                        elif method == 'copy':
+                            cur.copy_expert(query, parameters)
+                        else:
+                            cur.execute(query, parameters)
+                    timings[name].append(time.perf_counter() - start)
+
+                conn_obj.conn.rollback()
+    finally:
+        # Close the connection
+        conn_obj.close_connection()
+
+    return {name: min(values) for name, values in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the writes of activities")
+    parser.add_argument("--activities", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--upsert", action="store_true", help="write with upsert semantics")
+    parser.add_argument("--db", action="store_true", help="also write the rows to the database")
+    args = parser.parse_args()
+
+    activities = Strava_functions.normalize_activities(make_activities(args.activities), "1")
+
+    insert = best_of(prepare_insert, args.repeat, activities)
+    copy = best_of(prepare_copy, args.repeat, activities)
+
+    print("{} activities".format(args.activities))
+    print("build INSERT   : {:.3f} s ({:,.0f} activities/s) - {:.1f} MB".format(
+        insert, args.activities / insert, prepare_insert(activities) / 1e6))
+    print("build COPY     : {:.3f} s ({:,.0f} activities/s) - {:.1f} MB".format(
+        copy, args.activities / copy, prepare_copy(activities) / 1e6))
+
+    if args.db:
+        written = write_to_database(activities, args.repeat, args.upsert)
+        print("execute_values : {:.3f} s ({:,.0f} activities/s)".format(
+            written['execute_values'], args.activities / written['execute_values']))
+        print("copy           : {:.3f} s ({:,.0f} activities/s)".format(
+            written['copy'], args.activities / written['copy']))
+        print("speedup        : {:.1f}x".format(written['execute_values'] / written['copy']))
@@ -0,0 +1,59 @@
+""" Benchmark of the normalization of Strava activities into the dataframe written to the activities table.
+    Compares the former per-row strptime normalization with Strava_functions.normalize_activities.
+
+    Run with `python benchmarks/bench_normalize.py --activities 100000`"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Strava_functions  # noqa: E402
+from fake_strava import make_activities  # noqa: E402
+
+
+def legacy_normalize(activities, user_id):
+
+    """ Normalization as it was done before - a per-row strptime and a round trip over epoch integers"""
+
+    data = pd.DataFrame(activities)
+    data['user_id'] = user_id
+    data['start_epoch'] = [datetime.strptime(d['start_date_local'], "%Y-%m-%dT%H:%M:%SZ").timestamp()
+                           for d in activities]
+    data['year_month'] = pd.to_datetime(data.start_epoch.astype(int), unit='s').dt.to_period("M").dt.to_timestamp()
+    data['distance_in_km'] = data['distance'].div(1000)
+
+    return data[Strava_functions.ACTIVITY_COLUMNS]
+
+
+def best_of(function, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the normalization of Strava activities")
+    parser.add_argument("--activities", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Power and heart rate fields are only present on part of the activities, like in real Strava responses -
+    # the legacy normalization needs every field to be present at least once
+    activities = make_activities(args.activities)
+
+    legacy = best_of(legacy_normalize, args.repeat, activities, "1")
+    vectorized = best_of(Strava_functions.normalize_activities, args.repeat, activities, "1")
+
+    print("{} activities".format(args.activities))
+    print("legacy     : {:.3f} s ({:,.0f} activities/s)".format(legacy, args.activities / legacy))
+    print("vectorized : {:.3f} s ({:,.0f} activities/s)".format(vectorized, args.activities / vectorized))
+    print("speedup    : {:.1f}x".format(legacy / vectorized))
@@ -0,0 +1,368 @@
+""" Benchmark suite of the sync and the dashboard on synthetic athletes, with local stand-ins for Strava and the
+    database, so the hot paths can be measured without a Strava account or the hosted database:
+
+    * the athletes are generated by fake_strava.make_activities - their activity counts, sport mix and date span are
+      set on the command line - and served by the FakeStrava server on /athlete/activities and /oauth/token
+    * initialize_activities, update_strava_activity and get_strava_activities run against a throwaway Postgres
+      cluster which is created with initdb in a temporary directory and removed afterwards (or against the
+      throwaway database given with --dsn), with the schema of schema.py. Without Postgres binaries these
+      benchmarks are skipped
+    * every server callback of the dashboard is timed on its own, by posting it to the app like the Dash renderer
+
+    The throughput, the latencies and the peak memory (resident set size) of every part are written as JSON with the
+    commit they were measured on, so the results of two commits can be compared.
+
+    Run with `python benchmarks/bench_suite.py --athletes 3 --activities 2000 --output results.json`"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Strava_functions  # noqa: E402
+import dashboard_data  # noqa: E402
+import main  # noqa: E402
+import schema  # noqa: E402
+from fake_strava import FakeStrava, SPORT_MIX, make_activities  # noqa: E402
+from load_test import Browser  # noqa: E402
+from local_postgres import LocalPostgres, find_postgres_bindir  # noqa: E402
+
+
+# Athletes of the benchmark get ids far away from real Strava athletes
+FIRST_USER_ID = 900000001
+
+
+def parse_sport_mix(text):
+
+    """ Function to parse a sport mix like Run=0.6,Ride=0.3,Swim=0.1"""
+
+    return {sport: float(weight) for sport, weight in (item.split("=") for item in text.split(","))}
+
+
+def make_athletes(activity_counts, sport_mix=None, years=6, end=datetime(2021, 1, 1)):
+
+    """ Function to generate synthetic athletes - one per activity count. Returns a dict of user_id -> activities"""
+
+    start = end - timedelta(days=365 * years)
+
+    return {str(FIRST_USER_ID + number): make_activities(count, start=start, end=end, sport_mix=sport_mix,
+                                                         first_id=(number + 1) * 10 ** 9, seed=number)
+            for number, count in enumerate(activity_counts)}
+
+
+def add_new_activities(athletes, count, seed=0):
+
+    """ Function to add count new activities to the newest end of the history of every athlete - the activities
+        an incremental sync has to fetch"""
+
+    for number, (user_id, activities) in enumerate(athletes.items()):
+        newest = datetime.strptime(activities[0]['start_date_local'], "%Y-%m-%dT%H:%M:%SZ")
+        new = make_activities(count, start=newest + timedelta(hours=1), end=newest + timedelta(days=30),
+                              first_id=activities[0]['id'] + 1, seed=seed + number)
+        athletes[user_id][:0] = new
+
+
+def latency_summary(durations):
+
+    """ Function to summarize a list of durations in seconds"""
+
+    if not durations:
+        return {'calls': 0}
+
+    values = np.asarray(durations)
+    return {'calls': len(values),
+            'mean_ms': round(float(values.mean()) * 1000, 3),
+            'p50_ms': round(float(np.percentile(values, 50)) * 1000, 3),
+            'p95_ms': round(float(np.percentile(values, 95)) * 1000, 3),
+            'max_ms': round(float(values.max()) * 1000, 3)}
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+
+    # No procfs - fall back to the peak of the process
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    """ This Class samples the resident set size of the process in a background thread while a block of code runs,
+        so the memory taken by numpy and pandas is counted as well"""
+
+    # Initialize an object of the class
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __enter__(self):
+        self.baseline = self.peak = _rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+    @property
+    def report(self):
+        return {'peak_rss_mb': round(self.peak / 2 ** 20, 1),
+                'peak_rss_growth_mb': round((self.peak - self.baseline) / 2 ** 20, 1)}
+
+
+def prepare_database(db_config, user_ids, partitions=0):
+
+    """ Function to point Strava_functions to the benchmark database, migrate its schema and add the athletes with
+        an expired token - the first request of a sync refreshes it on /oauth/token of the stand-in"""
+
+    Strava_functions.close_connection_pool()
+    Strava_functions._db_config = db_config
+    for user_id in user_ids:
+        Strava_functions.token_provider.invalidate(user_id)
+
+    schema.migrate(partitions=partitions)
+    if schema.get_schema_version() < schema.MIGRATIONS[-1][0]:
+        raise RuntimeError("The schema of the benchmark database could not be created")
+
+    # Remove what an earlier run left behind in a database given with --dsn
+    statements = [('execute', "DELETE FROM {} WHERE user_id = ANY(%s)".format(table), ([int(u) for u in user_ids],))
+                  for table in ('activities', 'monthly_totals', 'sync_state', 'auth_info')]
+    statements.append(('execute_values',
+                       "INSERT INTO auth_info (user_id, auth_key, recovery_key, expiration_date) VALUES %s",
+                       [(int(user_id), "expired-{}".format(user_id), "refresh-{}".format(user_id), 0)
+                        for user_id in user_ids]))
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    ok = conn_obj.execute_transaction(statements)
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    if not ok:
+        raise RuntimeError("The athletes could not be added to the benchmark database")
+
+
+def run_sync_benchmarks(fake, athletes, new_activities, repeat):
+
+    """ Function to run the backfill, the incremental sync and the reads of every athlete against the database"""
+
+    results = {}
+    activity_count = sum(len(activities) for activities in athletes.values())
+
+    # Backfill of the full history of every athlete
+    requests_before = fake.request_count
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        for user_id in athletes:
+            Strava_functions.initialize_activities(user_id)
+        duration = time.perf_counter() - start
+
+    results['backfill'] = dict({'activities': activity_count,
+                                'seconds': round(duration, 3),
+                                'activities_per_second': round(activity_count / duration, 1),
+                                'requests': fake.request_count - requests_before}, **memory.report)
+
+    # Incremental sync after new activities have been uploaded
+    add_new_activities(athletes, new_activities)
+    requests_before = fake.request_count
+    durations = []
+    with PeakMemory() as memory:
+        for user_id in athletes:
+            start = time.perf_counter()
+            Strava_functions.update_strava_activity(user_id)
+            durations.append(time.perf_counter() - start)
+
+    results['incremental'] = dict({'new_activities': new_activities * len(athletes),
+                                   'requests': fake.request_count - requests_before,
+                                   'latency': latency_summary(durations)}, **memory.report)
+
+    # Reads of the monthly grid of the dashboard - out of the rollup and aggregated in pandas
+    for name, aggregate_in_db in (('read_rollup', True), ('read_pandas', False)):
+        durations = []
+        with PeakMemory() as memory:
+            for _ in range(repeat):
+                for user_id in athletes:
+                    start = time.perf_counter()
+                    Strava_functions.get_strava_activities(user_id, aggregate_in_db=aggregate_in_db)
+                    durations.append(time.perf_counter() - start)
+
+        results[name] = dict({'latency': latency_summary(durations)}, **memory.report)
+
+    return results
+
+
+def athlete_loader(athletes):
+
+    """ Function to get a loader of the snapshots of the synthetic athletes - used when there is no database"""
+
+    def load(user_id):
+        activities = Strava_functions.normalize_activities(athletes[user_id], user_id)
+        data_grouped = activities.groupby(['year_month', 'type'], as_index=False).agg(
+            {'distance': 'sum', 'distance_in_km': 'sum'})
+        grid = dashboard_data.compact_grid(Strava_functions.build_monthly_grid(data_grouped))
+
+        return dashboard_data.DatasetSnapshot(user_id, 1, grid, dashboard_data.ActivityIndex(grid), time.time())
+
+    return load
+
+
+def run_callback_benchmarks(athletes, interactions, loader, seed=0):
+
+    """ Function to time every server callback of the dashboard - with the callbacks on the server and with the
+        clientside callbacks, where only the grid is sent by the server"""
+
+    results = {}
+    rnd = random.Random(seed)
+
+    for mode, clientside in (('server', False), ('clientside', True)):
+        app = main.create_app(default_user_id=next(iter(athletes)), clientside=clientside, loader=loader,
+                              known_users=lambda user_id: user_id in athletes)
+        browser = Browser(app, app.server.test_client())
+
+        with PeakMemory() as memory:
+            for user_id in athletes:
+                browser.open_page('/athlete/{}'.format(user_id))
+
+                index = app.snapshot_cache.peek(user_id).index
+                for _ in range(interactions):
+                    if rnd.random() < 0.5:
+                        browser.set_props({('graph-type', 'value'): rnd.choice(index.types)})
+                    else:
+                        browser.set_props({('year-select', 'value'): rnd.choice(index.years)})
+
+        results[mode] = dict({'requests': browser.requests,
+                              'bytes': browser.bytes,
+                              'callbacks': {name: latency_summary(durations)
+                                            for name, durations in sorted(browser.callback_seconds.items())}},
+                             **memory.report)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+
+    """ Function to run all the benchmarks - returns the results as a dict"""
+
+    sport_mix = parse_sport_mix(args.sport_mix) if args.sport_mix else SPORT_MIX
+    activity_counts = [int(count) for count in args.activities.split(",")]
+    activity_counts = (activity_counts * args.athletes)[:max(args.athletes, len(activity_counts))]
+    athletes = make_athletes(activity_counts, sport_mix=sport_mix, years=args.years)
+
+    results = {'commit': git_commit(),
+               'measured_at': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'settings': dict(vars(args), sport_mix=sport_mix, activity_counts=activity_counts)}
+
+    # The sync writes its token and snapshot files relative to the working directory - keep them out of the repo
+    work_dir = tempfile.mkdtemp(prefix="stravadash-bench-")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    with open("strava_API_config.json", 'w') as configfile:
+        json.dump({'client_id': 'benchmark', 'client_secret': 'benchmark'}, configfile)
+
+    fake = FakeStrava(athletes, short_limit=10 ** 6, long_limit=10 ** 7, latency=args.latency).start()
+    Strava_functions.STRAVA_API_URL = fake.url
+    main.SYNC_IN_APP = False
+    postgres = None
+    loader = athlete_loader(athletes)
+
+    try:
+        db_config = {'dsn': args.dsn} if args.dsn else None
+        bindir = find_postgres_bindir()
+
+        if db_config is None and bindir is not None:
+            postgres = LocalPostgres(bindir)
+            try:
+                db_config = postgres.start()
+            except (RuntimeError, subprocess.CalledProcessError) as error:
+                print("No throwaway database: {}".format(getattr(error, 'stderr', None) or error))
+                postgres.stop()
+
+        if db_config is None:
+            print("Postgres is not available - the benchmarks of the sync are skipped")
+            results['sync'] = None
+        else:
+            prepare_database(db_config, list(athletes), args.partitions)
+            results['sync'] = run_sync_benchmarks(fake, athletes, args.new_activities, args.repeat)
+
+            # The dashboard reads the athletes out of the database as it does in production
+            loader = dashboard_data.load_snapshot
+
+        results['callbacks'] = run_callback_benchmarks(athletes, args.interactions, loader)
+
+    finally:
+        fake.stop()
+        Strava_functions.close_connection_pool()
+        if postgres is not None:
+            postgres.stop()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark suite of the sync and the dashboard")
+    parser.add_argument("--athletes", type=int, default=3)
+    parser.add_argument("--activities", default="500,2000,5000",
+                        help="activities per athlete - a comma separated list is cycled over the athletes")
+    parser.add_argument("--sport-mix", help="weights of the sport types, e.g. Run=0.6,Ride=0.3,Swim=0.1")
+    parser.add_argument("--years", type=float, default=6, help="years of history of every athlete")
+    parser.add_argument("--new-activities", type=int, default=20, help="new activities per incremental sync")
+    parser.add_argument("--repeat", type=int, default=5, help="reads of the monthly grid per athlete")
+    parser.add_argument("--interactions", type=int, default=20, help="dropdown changes per athlete")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay in seconds of the Strava stand-in")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="hash partitions of the activities table of the throwaway database")
+    parser.add_argument("--dsn", help="throwaway database to use instead of a local Postgres cluster")
+    parser.add_argument("--output", help="file to write the results to - printed when left out")
+    args = parser.parse_args()
+
+    suite_results = run_suite(args)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(suite_results, output_file, indent=2)
+        print("Results written to {}".format(args.output))
+    else:
+        print(json.dumps(suite_results, indent=2))
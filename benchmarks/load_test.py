@@ -0,0 +1,186 @@
+""" Load test of the callbacks of the dashboard. Simulates browser sessions - opening the page of an athlete and
+    changing the dropdowns - against the app with the callbacks on the server and with the clientside callbacks,
+    and reports the requests, the bytes and the server time of both.
+
+    The requests are sent the way the Dash renderer sends them: every server callback which has a changed property
+    as input is a POST to /_dash-update-component, and the properties it returns can trigger further callbacks.
+    Clientside callbacks run in the browser and only count as handled interactions. The athletes are synthetic,
+    so no database is needed.
+
+    Run with `python benchmarks/load_test.py --sessions 50 --interactions 20`"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Strava_functions  # noqa: E402
+import dashboard_data  # noqa: E402
+import main  # noqa: E402
+from fake_strava import make_activities  # noqa: E402
+
+
+def synthetic_loader(activity_count):
+
+    """ Function to get a loader of snapshots of synthetic athletes - used in place of the database"""
+
+    def load(user_id):
+        activities = Strava_functions.normalize_activities(
+            make_activities(activity_count, seed=int(user_id)), user_id)
+        data_grouped = activities.groupby(['year_month', 'type'], as_index=False).agg(
+            {'distance': 'sum', 'distance_in_km': 'sum'})
+        grid = dashboard_data.compact_grid(Strava_functions.build_monthly_grid(data_grouped))
+
+        return dashboard_data.DatasetSnapshot(user_id, 1, grid, dashboard_data.ActivityIndex(grid), time.time())
+
+    return load
+
+
+def _parse_outputs(output):
+    specs = output.strip('.').split('...') if output.startswith('..') else [output]
+    return [dict(zip(('id', 'property'), spec.rsplit('.', 1))) for spec in specs]
+
+
+class Browser:
+    """ This Class plays the part of the Dash renderer in a browser - it keeps the properties of the components and
+        fires the callbacks which depend on a changed property"""
+
+    # Initialize an object of the class
+    def __init__(self, app, client):
+        self.client = client
+        self.callbacks = list(app._callback_list)
+        self.props = {}
+        self.storage = {}
+        self.requests = 0
+        self.bytes = 0
+        self.server_seconds = 0.0
+        self.clientside_calls = 0
+
+        # Durations of the requests per server callback - keyed on the first output of the callback
+        self.callback_seconds = {}
+
+    def _run_server_callback(self, callback):
+        outputs = _parse_outputs(callback['output'])
+        payload = {'output': callback['output'],
+                   'outputs': outputs if len(outputs) > 1 else outputs[0],
+                   'inputs': [dict(item, value=self.props.get((item['id'], item['property'])))
+                              for item in callback['inputs']],
+                   'state': [dict(item, value=self.props.get((item['id'], item['property'])))
+                             for item in callback.get('state', [])],
+                   'changedPropIds': ["{}.{}".format(item['id'], item['property']) for item in callback['inputs']]}
+
+        start = time.perf_counter()
+        response = self.client.post('/_dash-update-component', json=payload)
+        duration = time.perf_counter() - start
+        self.server_seconds += duration
+        self.callback_seconds.setdefault("{id}.{property}".format(**outputs[0]), []).append(duration)
+        self.requests += 1
+        self.bytes += len(response.data)
+
+        # All the outputs are no_update
+        if response.status_code == 204:
+            return []
+
+        body = json.loads(response.data)
+        changed = []
+        for component_id, props in body['response'].items():
+            for prop, value in props.items():
+                key = (component_id, prop)
+                if key == ('props', prop):
+                    key = (outputs[0]['id'], prop)
+                self.props[key] = value
+                changed.append(key)
+
+        return changed
+
+    def _run_clientside_callback(self, callback):
+
+        # The browser computes the outputs - they are marked as changed without a request
+        self.clientside_calls += 1
+        return [(output['id'], output['property']) for output in _parse_outputs(callback['output'])]
+
+    def set_props(self, changes):
+
+        """ Method to change properties like a user does and run the callbacks which depend on them"""
+
+        changed = list(changes)
+        self.props.update(changes)
+
+        # The renderer runs the callbacks of the changed properties, then those of the properties they changed
+        while changed:
+            pending = [callback for callback in self.callbacks
+                       if any((item['id'], item['property']) in changed for item in callback['inputs'])]
+            changed = []
+            for callback in pending:
+                if callback.get('clientside_function'):
+                    changed.extend(self._run_clientside_callback(callback))
+                else:
+                    changed.extend(self._run_server_callback(callback))
+
+    def open_page(self, pathname):
+
+        """ Method to open a page - the stores in the session storage of the tab keep the data of an earlier visit"""
+
+        self.props.update(self.storage)
+        self.set_props({('url', 'pathname'): pathname})
+        self.storage = {key: value for key, value in self.props.items() if key[0] in ('grid-store', 'grid-version')}
+
+
+def run_sessions(clientside, sessions, interactions, athletes, activity_count, seed=0):
+
+    """ Function to run browser sessions against a new app - returns the counters of all the browsers"""
+
+    # Every athlete of the url is known - the synthetic loader makes up the data of any athlete
+    app = main.create_app(default_user_id="1", clientside=clientside, loader=synthetic_loader(activity_count),
+                          known_users=lambda user_id: True)
+    client = app.server.test_client()
+    rnd = random.Random(seed)
+    totals = {'requests': 0, 'bytes': 0, 'server_seconds': 0.0, 'clientside_calls': 0, 'interactions': 0}
+
+    browsers = {}
+    for _ in range(sessions):
+        user_id = str(rnd.randint(1, athletes))
+
+        # A returning visitor reloads the tab of its last visit - the grid is still in the session storage of the tab
+        browser = browsers.setdefault(user_id, Browser(app, client))
+        browser.open_page('/athlete/{}'.format(user_id))
+
+        index = app.snapshot_cache.peek(user_id).index
+        for _ in range(interactions):
+            if rnd.random() < 0.5:
+                browser.set_props({('graph-type', 'value'): rnd.choice(index.types)})
+            else:
+                browser.set_props({('year-select', 'value'): rnd.choice(index.years)})
+            totals['interactions'] += 1
+
+    for browser in browsers.values():
+        totals['requests'] += browser.requests
+        totals['bytes'] += browser.bytes
+        totals['server_seconds'] += browser.server_seconds
+        totals['clientside_calls'] += browser.clientside_calls
+
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the callbacks of the dashboard")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--interactions", type=int, default=20, help="dropdown changes per session")
+    parser.add_argument("--athletes", type=int, default=10)
+    parser.add_argument("--activities", type=int, default=2000, help="activities per athlete")
+    args = parser.parse_args()
+
+    results = {}
+    for mode, clientside in (('server', False), ('clientside', True)):
+        results[mode] = run_sessions(clientside, args.sessions, args.interactions, args.athletes, args.activities)
+        print("{:10s}: {requests} requests, {bytes:,} bytes, {server_seconds:.2f} s server time, "
+              "{clientside_calls} clientside callbacks for {interactions} interactions".format(mode, **results[mode]))
+
+    saved = results['server']['requests'] - results['clientside']['requests']
+    print("Requests saved: {} ({:.0%}) - bytes saved: {:,}".format(
+        saved, saved / max(results['server']['requests'], 1),
+        results['server']['bytes'] - results['clientside']['bytes']))
@@ -0,0 +1,76 @@
+""" Throwaway Postgres cluster of the benchmark suite and of the database tests - created with initdb in a temporary
+    directory and removed when it is stopped"""
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from glob import glob
+
+
+def find_postgres_bindir():
+
+    """ Function to find the directory of the Postgres server binaries - None when Postgres is not installed"""
+
+    if shutil.which("initdb"):
+        return os.path.dirname(shutil.which("initdb"))
+
+    if shutil.which("pg_config"):
+        bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True).stdout.strip()
+        if os.path.exists(os.path.join(bindir, "initdb")):
+            return bindir
+
+    candidates = sorted(glob("/usr/lib/postgresql/*/bin/initdb") + glob("/usr/local/pgsql/bin/initdb"))
+    return os.path.dirname(candidates[-1]) if candidates else None
+
+
+class LocalPostgres:
+    """ This Class runs a throwaway Postgres cluster in a temporary directory. It only listens on a unix socket in
+        that directory and runs without fsync - the data is removed when the cluster is stopped"""
+
+    # Initialize an object of the class
+    def __init__(self, bindir):
+        self.bindir = bindir
+        self.directory = None
+        self.port = None
+
+    def _run(self, *args):
+        subprocess.run([os.path.join(self.bindir, args[0])] + list(args[1:]), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def start(self):
+
+        """ Method to create and start the cluster - returns the connection parameters"""
+
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            raise RuntimeError("initdb does not run as root - run as another user or pass --dsn")
+
+        self.directory = tempfile.mkdtemp(prefix="stravadash-pg-")
+        data_dir = os.path.join(self.directory, "data")
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+
+        self._run("initdb", "-D", data_dir, "-U", "postgres", "-A", "trust", "-E", "UTF8", "-N")
+        self._run("pg_ctl", "-D", data_dir, "-l", os.path.join(self.directory, "postgres.log"), "-w",
+                  "-o", "-p {} -k {} -c listen_addresses='' -c fsync=off -c synchronous_commit=off "
+                        "-c full_page_writes=off".format(self.port, self.directory), "start")
+
+        return {'host': self.directory, 'port': self.port, 'user': 'postgres', 'dbname': 'postgres'}
+
+    def stop(self):
+
+        """ Method to stop the cluster and remove its data"""
+
+        if self.directory is None:
+            return
+
+        try:
+            self._run("pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "immediate", "-w", "stop")
+        except subprocess.CalledProcessError as error:
+            print(error.stderr.decode(errors="replace"))
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
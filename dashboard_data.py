@@ -0,0 +1,527 @@
+""" Data structures used by the Dash app to answer the callbacks without scanning the activities frame """
+
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+
+import Strava_functions
+import snapshot_store
+
+
+# Maximum number of figures held by the figure cache
+FIGURE_CACHE_SIZE = 256
+
+# Number of seconds between two background refreshes of the data of the dashboard
+REFRESH_INTERVAL_SECONDS = 15 * 60
+
+# Approximate number of bytes the snapshots of all the athletes may take in memory
+SNAPSHOT_CACHE_BYTES = 256 * 1024 ** 2
+
+# Number of seconds an answer on whether an athlete has connected the app is kept, and number of answers kept
+KNOWN_USERS_TTL_SECONDS = 5 * 60
+KNOWN_USERS_SIZE = 10000
+
+# Immutable view on the data of a user - the callbacks take one snapshot and only read from it
+DatasetSnapshot = namedtuple('DatasetSnapshot', ['user_id', 'version', 'grid', 'index', 'loaded_at'])
+
+
+def _read_only(values):
+
+    """ Function to make a numpy array which can not be changed - the index is shared by all callbacks"""
+
+    array = np.array(values)
+    array.flags.writeable = False
+    return array
+
+
+_NO_MONTHS = _read_only(np.array([], dtype='datetime64[ns]'))
+_NO_DISTANCE = _read_only(np.array([], dtype=np.float32))
+
+# Months in the compact grid are counted from January 1970 - the integer behind a numpy datetime64[M]
+_MONTH_EPOCH = np.datetime64('1970-01', 'M')
+
+
+def compact_grid(cart):
+
+    """ Function to convert the monthly grid returned by Strava_functions.get_strava_activities into the compact
+        frame kept in memory - a month ordinal (int32) instead of a timestamp, the sport type as a category and
+        only the distance in km as float32. The rows are sorted by sport type and month"""
+
+    months = cart.year_month.to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+
+    grid = pd.DataFrame({'month': (months - _MONTH_EPOCH).astype(np.int32),
+                         'type': pd.Categorical(cart['type'].astype(str)),
+                         'distance_in_km': cart.distance_in_km.to_numpy(dtype=np.float32)})
+
+    return grid.sort_values(['type', 'month'], ignore_index=True)
+
+
+def month_dates(months):
+
+    """ Function to convert month ordinals of the compact grid into the first day of the months"""
+
+    return (_MONTH_EPOCH + np.asarray(months, dtype=np.int64)).astype('datetime64[ns]')
+
+
+class ActivityIndex:
+    """ This Class is an immutable lookup structure built once per data load out of the compact monthly grid made
+        by compact_grid. The monthly distances and the yearly totals are indexed by (sport type, year) so every
+        callback is a dictionary lookup"""
+
+    # Initialize an object of the class
+    def __init__(self, grid):
+        years = grid.month // 12 + 1970
+        monthly = {}
+        totals = {}
+        totals_per_year = {}
+        ticks = {}
+
+        for year, months in grid.month.groupby(years):
+            ticks[int(year)] = _read_only(month_dates(np.unique(months.to_numpy())))
+
+        # Split the grid once per (sport type, year) - the grid is already in chronological order per sport type.
+        # The grid is padded, so the months of a sport type mostly are all the months of the year - they share the
+        # array of the ticks
+        for (sport_type, year), frame in grid.groupby([grid['type'], years], sort=True, observed=True):
+            months = month_dates(frame.month.to_numpy())
+            months = ticks[int(year)] if np.array_equal(months, ticks[int(year)]) else _read_only(months)
+
+            monthly[(sport_type, int(year))] = (months, _read_only(frame.distance_in_km.to_numpy()))
+            totals[(sport_type, int(year))] = float(frame.distance_in_km.to_numpy().sum(dtype=np.float64))
+            totals_per_year.setdefault(int(year), {})[sport_type] = totals[(sport_type, int(year))]
+
+        self._monthly = MappingProxyType(monthly)
+        self._totals = MappingProxyType(totals)
+        self._totals_per_year = MappingProxyType({year: MappingProxyType(year_totals)
+                                                  for year, year_totals in totals_per_year.items()})
+        self._ticks = MappingProxyType(ticks)
+        self.types = tuple(str(sport_type) for sport_type in grid['type'].unique())
+        self.years = tuple(sorted(ticks))
+        self.nbytes = sum(distance.nbytes for _, distance in monthly.values()) + \
+            sum(months.nbytes for months, _ in monthly.values() if not any(months is t for t in ticks.values())) + \
+            sum(months.nbytes for months in ticks.values())
+
+    def monthly_distance(self, sport_type, year):
+
+        """ Method to get the months and the distance in km of a sport type in a year"""
+
+        if year is None:
+            return _NO_MONTHS, _NO_DISTANCE
+
+        return self._monthly.get((sport_type, int(year)), (_NO_MONTHS, _NO_DISTANCE))
+
+    def yearly_total(self, sport_type, year):
+
+        """ Method to get the total distance in km of a sport type in a year - 0 when there is no data"""
+
+        if year is None:
+            return 0
+
+        return self._totals.get((sport_type, int(year)), 0)
+
+    def yearly_totals(self, year):
+
+        """ Method to get the total distance in km of every sport type in a year as a sport type -> km mapping"""
+
+        if year is None:
+            return MappingProxyType({})
+
+        return self._totals_per_year.get(int(year), MappingProxyType({}))
+
+    def month_ticks(self, year):
+
+        """ Method to get the months of a year which are in the data - used as ticks of the bar chart"""
+
+        if year is None:
+            return _NO_MONTHS
+
+        return self._ticks.get(int(year), _NO_MONTHS)
+
+
+class FigureCache:
+    """ This Class is a thread-safe LRU cache of serialized figures. The key of a figure is
+        (user_id, *arguments of the figure, dataset version) - when a sync bumps the dataset version of a user
+        the figures of the older versions are dropped. The cache holds the figure JSON and hands out a fresh copy
+        of the figure dict on every hit"""
+
+    # Initialize an object of the class
+    def __init__(self, max_entries=FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._figures = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+
+        """ Method to get the figure of a key out of the cache - build() is called to make the figure on a miss.
+            The user id is the first and the dataset version the last element of the key"""
+
+        user_id, version = key[0], key[-1]
+
+        with self._lock:
+            # A newer dataset version of the user makes the figures of the older versions useless
+            latest = self._versions.get(user_id)
+            if latest is None or version > latest:
+                if latest is not None:
+                    self._invalidate(user_id, version)
+                self._versions[user_id] = version
+
+            figure_json = self._figures.get(key)
+            if figure_json is not None:
+                self._figures.move_to_end(key)
+                self.hits += 1
+                return json.loads(figure_json)
+
+            self.misses += 1
+
+        # Build the figure outside of the lock - two threads may build the same figure, the last one is kept
+        figure_json = build().to_json()
+
+        with self._lock:
+            self._figures[key] = figure_json
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.max_entries:
+                self._figures.popitem(last=False)
+                self.evictions += 1
+
+        return json.loads(figure_json)
+
+    def invalidate(self, user_id, version=None):
+
+        """ Method to drop the figures of a user which are older than the given version - all of them without version"""
+
+        with self._lock:
+            self._invalidate(user_id, version)
+            if version is not None:
+                self._versions[user_id] = version
+            else:
+                self._versions.pop(user_id, None)
+
+    def _invalidate(self, user_id, version):
+        for key in [key for key in self._figures if key[0] == user_id and (version is None or key[-1] < version)]:
+            del self._figures[key]
+
+    def stats(self):
+
+        """ Method to get the hit and miss counters of the cache"""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._figures),
+                    'max_entries': self.max_entries,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+def load_snapshot(user_id):
+
+    """ Function to load the monthly grid of a user into a new snapshot. The grid is read from the local snapshot
+        store when it holds the current dataset version - otherwise out of the monthly_totals rollup of the postGRE
+        Strava database. A missing or stale snapshot is rebuilt by the sync, not by the dashboard"""
+
+    version = Strava_functions.get_dataset_version(user_id)
+
+    cart = snapshot_store.load_grid(user_id, version)
+    if cart is None:
+        cart = Strava_functions.get_strava_activities(user_id)
+
+    grid = compact_grid(cart)
+
+    return DatasetSnapshot(user_id, version, grid, ActivityIndex(grid), time.time())
+
+
+def snapshot_nbytes(snapshot):
+
+    """ Function to get the approximate number of bytes a snapshot takes in memory"""
+
+    return int(snapshot.grid.memory_usage(deep=True).sum()) + snapshot.index.nbytes
+
+
+def grid_payload(snapshot):
+
+    """ Function to get the compact grid of a snapshot in the columnar form sent to the browser - the months are
+        month ordinals, the sport types are codes into the list of types"""
+
+    grid = snapshot.grid
+
+    return {'user_id': snapshot.user_id,
+            'version': snapshot.version,
+            'types': [str(sport_type) for sport_type in grid['type'].cat.categories],
+            'month': grid.month.tolist(),
+            'type': grid['type'].cat.codes.tolist(),
+            'km': np.round(grid.distance_in_km.to_numpy(dtype=np.float64), 3).tolist()}
+
+
+def memory_report(snapshot):
+
+    """ Function to get the memory a snapshot takes, split up per column of its grid and for its index"""
+
+    columns = {column: int(nbytes) for column, nbytes in snapshot.grid.memory_usage(deep=True).items()}
+
+    return {'rows': len(snapshot.grid),
+            'types': len(snapshot.index.types),
+            'years': len(snapshot.index.years),
+            'columns_bytes': columns,
+            'grid_bytes': sum(columns.values()),
+            'index_bytes': snapshot.index.nbytes,
+            'total_bytes': sum(columns.values()) + snapshot.index.nbytes}
+
+
+class KnownUsers:
+    """ This Class answers whether an athlete has connected the app, so only the data of those athletes is loaded.
+        The answers are kept for ttl seconds - urls with unknown athletes do not reach the database on every
+        request"""
+
+    # Initialize an object of the class
+    def __init__(self, check=Strava_functions.user_exists, ttl=KNOWN_USERS_TTL_SECONDS, max_size=KNOWN_USERS_SIZE):
+        self.check = check
+        self.ttl = ttl
+        self.max_size = max_size
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, user_id):
+        now = time.time()
+
+        with self._lock:
+            answer = self._answers.get(user_id)
+        if answer is not None and now - answer[1] < self.ttl:
+            return answer[0]
+
+        known = bool(self.check(user_id))
+
+        with self._lock:
+            # Forget all the answers at once when there are too many - they are cheap to get again
+            if len(self._answers) >= self.max_size:
+                self._answers.clear()
+            self._answers[user_id] = (known, now)
+
+        return known
+
+
+class SnapshotCache:
+    """ This Class holds the snapshots of many athletes in memory. A snapshot is loaded on the first request for
+        its user, and the least recently used snapshots are evicted when the approximate size of all the snapshots
+        goes over max_bytes. Concurrent first requests for the same user wait for one single load"""
+
+    # Initialize an object of the class
+    def __init__(self, max_bytes=SNAPSHOT_CACHE_BYTES, loader=load_snapshot):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self._snapshots = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+
+        """ Method to get the snapshot of a user - loads it when it is not in memory yet"""
+
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None:
+                self._snapshots.move_to_end(user_id)
+                self.hits += 1
+                return snapshot
+
+            self.misses += 1
+
+            # Join a load which is already running for the user - or become the one who loads
+            load = self._loading.get(user_id)
+            leader = load is None
+            if leader:
+                load = {'done': threading.Event(), 'snapshot': None, 'error': None}
+                self._loading[user_id] = load
+
+        if not leader:
+            load['done'].wait()
+            if load['error'] is not None:
+                raise load['error']
+            return load['snapshot']
+
+        try:
+            load['snapshot'] = self.loader(user_id)
+            self.put(load['snapshot'])
+            return load['snapshot']
+
+        except Exception as error:
+            load['error'] = error
+            raise
+
+        finally:
+            with self._lock:
+                self.loads += 1
+                del self._loading[user_id]
+            load['done'].set()
+
+    def peek(self, user_id):
+
+        """ Method to get the snapshot of a user when it is in memory - without loading it"""
+
+        with self._lock:
+            return self._snapshots.get(user_id)
+
+    def put(self, snapshot):
+
+        """ Method to add or replace the snapshot of a user - the least recently used snapshots are evicted until
+            the cache fits in max_bytes again. The snapshot which has just been added is never evicted"""
+
+        size = snapshot_nbytes(snapshot)
+
+        with self._lock:
+            self._snapshots[snapshot.user_id] = snapshot
+            self._snapshots.move_to_end(snapshot.user_id)
+            self._sizes[snapshot.user_id] = size
+
+            while sum(self._sizes.values()) > self.max_bytes and len(self._snapshots) > 1:
+                evicted_user, _ = self._snapshots.popitem(last=False)
+                del self._sizes[evicted_user]
+                self.evictions += 1
+
+    def users(self):
+
+        """ Method to get the users of which a snapshot is in memory"""
+
+        with self._lock:
+            return list(self._snapshots)
+
+    def stats(self):
+
+        """ Method to get the counters and the memory use of the cache"""
+
+        with self._lock:
+            return {'users': len(self._snapshots),
+                    'bytes': sum(self._sizes.values()),
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'loads': self.loads,
+                    'evictions': self.evictions,
+                    'bytes_per_user': dict(self._sizes)}
+
+    def memory_report(self):
+
+        """ Method to get the memory report of every snapshot in memory and the average per user"""
+
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+
+        users = {snapshot.user_id: memory_report(snapshot) for snapshot in snapshots}
+        total = sum(report['total_bytes'] for report in users.values())
+
+        return {'users': users,
+                'total_bytes': total,
+                'average_bytes_per_user': total / len(users) if users else None,
+                'max_bytes': self.max_bytes}
+
+
+class DataRefresher:
+    """ This Class keeps the snapshots in a SnapshotCache up to date. A background thread periodically runs the
+        incremental sync of every user in the cache and reloads the monthly grid of a user when the dataset version
+        has changed. The new snapshot is swapped in with a single assignment, so a callback which already took the
+        old snapshot keeps reading it consistently"""
+
+    # Initialize an object of the class
+    def __init__(self, cache, interval=REFRESH_INTERVAL_SECONDS, sync=True, rate_limiter=None):
+        self.cache = cache
+        self.interval = interval
+        self.sync = sync
+        self.rate_limiter = rate_limiter or Strava_functions.RateLimiter()
+        self.last_checked_at = {}
+        self.last_refresh_duration = None
+        self.refresh_count = 0
+        self.failure_count = 0
+        self._stop_event = threading.Event()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def load(self, user_id):
+
+        """ Method to get the snapshot of a user - loaded without syncing when it is not in memory yet"""
+
+        snapshot = self.cache.get(user_id)
+        self.last_checked_at.setdefault(user_id, snapshot.loaded_at)
+
+        return snapshot
+
+    def refresh(self):
+
+        """ Method to run the incremental sync of the users in memory and swap in a new snapshot when their data
+            has changed"""
+
+        with self._refresh_lock:
+            start = time.perf_counter()
+
+            for user_id in self.cache.users():
+                try:
+                    if self.sync:
+                        snapshot_store.sync_user(user_id, rate_limiter=self.rate_limiter)
+
+                    # Only reload the grid when a write has bumped the dataset version
+                    current = self.cache.peek(user_id)
+                    version = Strava_functions.get_dataset_version(user_id)
+                    if current is None or version != current.version:
+                        self.cache.put(self.cache.loader(user_id))
+
+                    self.last_checked_at[user_id] = time.time()
+
+                except Exception as error:
+                    self.failure_count += 1
+                    print("Refresh of the data of user {} failed: {}".format(user_id, error))
+
+            self.refresh_count += 1
+            self.last_refresh_duration = time.perf_counter() - start
+
+    def start(self):
+
+        """ Method to start refreshing in a background thread"""
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="data-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+
+        """ Method to stop the background thread"""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.refresh()
+
+    def stats(self):
+
+        """ Method to get the duration of the last refresh and the staleness of the data of every user in seconds"""
+
+        now = time.time()
+        users = {}
+        for user_id in self.cache.users():
+            snapshot = self.cache.peek(user_id)
+            checked_at = self.last_checked_at.get(user_id)
+            users[user_id] = {'version': snapshot.version if snapshot is not None else None,
+                              'loaded_at': snapshot.loaded_at if snapshot is not None else None,
+                              'staleness_seconds': now - checked_at if checked_at else None}
+
+        return {'users': users,
+                'last_refresh_duration_seconds': self.last_refresh_duration,
+                'refresh_count': self.refresh_count,
+                'failure_count': self.failure_count,
+                'interval_seconds': self.interval}
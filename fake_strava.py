@@ -0,0 +1,358 @@
+""" Local stand-in for the parts of the Strava API which are used by Strava_functions.py. It serves synthetic
+    activities on /athlete/activities and /activities/<id>, hands out tokens on /oauth/token and reports (and
+    enforces) the X-RateLimit-* headers, so the sync and backfill code can be run without a real Strava account.
+
+    Start it with `python fake_strava.py --activities 3000` and point STRAVA_API_URL to the printed url - the tests
+    in tests/ run the sync against it.
+    `python fake_strava.py --record-events events.jsonl` writes webhook events of the synthetic athlete which can
+    be replayed with strava_webhooks.py."""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Default mix of sport types of a synthetic athlete
+SPORT_MIX = {"Run": 0.5, "Ride": 0.35, "Swim": 0.15}
+
+# Typical speed (m/s) and distance (m) per sport type
+SPORT_PROFILES = {"Run": (3.0, 10000), "Ride": (7.5, 45000), "Swim": (0.8, 2000),
+                  "Walk": (1.4, 5000), "VirtualRide": (8.0, 30000)}
+
+
+def make_activities(count, start=datetime(2015, 1, 1), end=datetime(2021, 1, 1), sport_mix=None,
+                    first_id=1000000000, seed=0):
+
+    """ Function to generate synthetic summary activities as returned by /athlete/activities -
+        the activities are sorted from new to old like the Strava API does"""
+
+    rnd = random.Random(seed)
+    sport_mix = sport_mix or SPORT_MIX
+    sports = list(sport_mix.keys())
+    weights = list(sport_mix.values())
+    span = (end - start).total_seconds()
+
+    start_times = sorted(start + timedelta(seconds=rnd.random() * span) for _ in range(count))
+    activities = []
+
+    for number, start_local in enumerate(start_times):
+        sport = rnd.choices(sports, weights)[0]
+        speed, distance = SPORT_PROFILES.get(sport, (3.0, 10000))
+        distance = round(distance * rnd.uniform(0.3, 2.0), 1)
+        moving_time = int(distance / speed)
+        has_heartrate = rnd.random() < 0.8
+        has_power = sport in ("Ride", "VirtualRide") and rnd.random() < 0.5
+
+        activity = {"id": first_id + number,
+                    "name": "{} {}".format(sport, number),
+                    "distance": distance,
+                    "moving_time": moving_time,
+                    "elapsed_time": moving_time + rnd.randint(0, 600),
+                    "total_elevation_gain": round(rnd.uniform(0, 800), 1),
+                    "type": sport,
+                    "start_date": (start_local - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "start_date_local": start_local.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "location_city": None,
+                    "location_state": None,
+                    "location_country": "Belgium",
+                    "achievement_count": rnd.randint(0, 5),
+                    "kudos_count": rnd.randint(0, 30),
+                    "comment_count": rnd.randint(0, 3),
+                    "athlete_count": rnd.randint(1, 4),
+                    "trainer": sport == "VirtualRide",
+                    "commute": rnd.random() < 0.1,
+                    "manual": False,
+                    "private": False,
+                    "gear_id": None,
+                    "average_speed": speed,
+                    "max_speed": round(speed * rnd.uniform(1.2, 2.0), 2),
+                    "has_heartrate": has_heartrate,
+                    "elev_high": round(rnd.uniform(0, 500), 1),
+                    "elev_low": round(rnd.uniform(0, 50), 1),
+                    "pr_count": rnd.randint(0, 3),
+                    "total_photo_count": rnd.randint(0, 2)}
+
+        # Optional fields are left out of the response when they are unknown - just like Strava does
+        if has_heartrate:
+            activity["average_heartrate"] = round(rnd.uniform(110, 160), 1)
+            activity["max_heartrate"] = round(rnd.uniform(160, 195), 1)
+        if has_power:
+            activity["average_watts"] = round(rnd.uniform(120, 260), 1)
+            activity["kilojoules"] = round(activity["average_watts"] * moving_time / 1000, 1)
+
+        activities.append(activity)
+
+    activities.reverse()
+    return activities
+
+
+def make_streams(activity, keys=None):
+
+    """ Function to generate the streams of a synthetic activity as returned by /activities/<id>/streams with
+        key_by_type=true - one sample per second of moving time. The streams only depend on the activity"""
+
+    rnd = random.Random(activity["id"])
+    samples = max(min(int(activity["moving_time"]), 20000), 2)
+    speed = activity["distance"] / max(activity["moving_time"], 1)
+
+    lat, lng = 51.05 + rnd.uniform(-0.05, 0.05), 3.72 + rnd.uniform(-0.05, 0.05)
+    heading = rnd.uniform(0, 2 * math.pi)
+    altitude = activity.get("elev_low") or 10.0
+    heartrate = activity.get("average_heartrate", 0) - 20
+    elapsed = distance = 0.0
+
+    streams = {key: [] for key in ("time", "distance", "latlng", "altitude", "heartrate", "watts")}
+
+    for _ in range(samples):
+        step = speed * rnd.uniform(0.7, 1.3)
+        heading += rnd.gauss(0, 0.05)
+        lat += step * math.cos(heading) / 111320
+        lng += step * math.sin(heading) / (111320 * math.cos(math.radians(lat)))
+        altitude = max(altitude + rnd.gauss(0, 0.3), 0)
+        heartrate = min(max(heartrate + rnd.gauss(0.02, 1), 90), 195)
+        elapsed += 1 if rnd.random() > 0.01 else rnd.randint(2, 60)
+        distance += step
+
+        streams["time"].append(int(elapsed))
+        streams["distance"].append(round(distance, 1))
+        streams["latlng"].append([round(lat, 6), round(lng, 6)])
+        streams["altitude"].append(round(altitude, 1))
+        streams["heartrate"].append(int(heartrate))
+        streams["watts"].append(int(max(rnd.gauss(activity.get("average_watts", 0), 40), 0))
+                                if rnd.random() > 0.02 else int(activity.get("average_watts", 0) * 3))
+
+    # Streams the activity has no sensor for are left out - just like Strava does
+    if not activity["has_heartrate"]:
+        del streams["heartrate"]
+    if "average_watts" not in activity:
+        del streams["watts"]
+
+    return {key: {"data": data, "series_type": "distance", "original_size": samples, "resolution": "high"}
+            for key, data in streams.items() if keys is None or key in keys}
+
+
+def _epoch(date_string):
+    return datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+class FakeStrava:
+    """ This Class runs a threaded HTTP server which stands in for the Strava API. Athletes are given as a
+        dict of user_id -> list of activities, every athlete gets the access token 'token-<user_id>'"""
+
+    # Initialize an object of the class
+    def __init__(self, athletes, short_limit=100, long_limit=1000, latency=0.0, host="127.0.0.1", port=0):
+        self.athletes = athletes
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.latency = latency
+        self.tokens = {"token-{}".format(user_id): user_id for user_id in athletes}
+        self.refresh_tokens = {"refresh-{}".format(user_id): user_id for user_id in athletes}
+        self.short_usage = 0
+        self.long_usage = 0
+        self.request_count = 0
+        self.window_start = time.time()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+
+        """ Method to start serving in a background thread"""
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        """ Method to stop the server"""
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self):
+
+        """ Method to count a request in the rate limit windows - returns False when the request is over the limit"""
+
+        with self.lock:
+            # The stand-in uses a rolling 15 minute window from its start time
+            if time.time() - self.window_start > 15 * 60:
+                self.window_start = time.time()
+                self.short_usage = 0
+
+            self.request_count += 1
+            self.short_usage += 1
+            self.long_usage += 1
+
+            return self.short_usage <= self.short_limit and self.long_usage <= self.long_limit
+
+    def rate_limit_headers(self):
+        return {"X-RateLimit-Limit": "{},{}".format(self.short_limit, self.long_limit),
+                "X-RateLimit-Usage": "{},{}".format(self.short_usage, self.long_usage)}
+
+    def list_activities(self, user_id, query):
+
+        """ Method to get a page of activities - with 'after' the activities are returned from old to new"""
+
+        activities = self.athletes[user_id]
+        page = int(query.get("page", ["1"])[0])
+        per_page = min(int(query.get("per_page", ["30"])[0]), 200)
+
+        if "before" in query:
+            before = float(query["before"][0])
+            activities = [a for a in activities if _epoch(a["start_date"]) < before]
+        if "after" in query:
+            after = float(query["after"][0])
+            activities = [a for a in reversed(activities) if _epoch(a["start_date"]) > after]
+
+        return activities[(page - 1) * per_page:page * per_page]
+
+    def revoke(self, user_id):
+
+        """ Method to act as if the athlete deauthorized the app - the tokens of the athlete are no longer accepted"""
+
+        with self.lock:
+            self.tokens = {token: owner for token, owner in self.tokens.items() if owner != user_id}
+            self.refresh_tokens = {token: owner for token, owner in self.refresh_tokens.items() if owner != user_id}
+
+    def get_activity(self, user_id, activity_id):
+
+        """ Method to get one activity of an athlete - None when the athlete has no activity with this id"""
+
+        for activity in self.athletes[user_id]:
+            if str(activity["id"]) == activity_id:
+                return activity
+        return None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for header, value in fake.rate_limit_headers().items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def authorized_user(self, query):
+                token = query.get("access_token", [None])[0]
+                header = self.headers.get("Authorization", "")
+                if header.startswith("Bearer "):
+                    token = header[len("Bearer "):]
+                return fake.tokens.get(token)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if not fake.count_request():
+                    return self.send_json(429, {"message": "Rate Limit Exceeded"})
+
+                user_id = self.authorized_user(query)
+                if user_id is None:
+                    return self.send_json(401, {"message": "Authorization Error"})
+
+                if url.path.endswith("/athlete/activities"):
+                    return self.send_json(200, fake.list_activities(user_id, query))
+
+                if url.path.endswith("/athlete"):
+                    return self.send_json(200, {"id": int(user_id)})
+
+                if url.path.endswith("/streams"):
+                    activity = fake.get_activity(user_id, url.path.rsplit("/", 2)[-2])
+                    if activity is not None and not activity["manual"]:
+                        keys = query.get("keys", [""])[0].split(",") if "keys" in query else None
+                        return self.send_json(200, make_streams(activity, keys))
+                    return self.send_json(404, {"message": "Record Not Found"})
+
+                if "/activities/" in url.path:
+                    activity = fake.get_activity(user_id, url.path.rsplit("/", 1)[-1])
+                    if activity is not None:
+                        return self.send_json(200, activity)
+
+                return self.send_json(404, {"message": "Record Not Found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+
+                if not fake.count_request():
+                    return self.send_json(429, {"message": "Rate Limit Exceeded"})
+
+                if url.path.endswith("/oauth/token"):
+                    user_id = fake.refresh_tokens.get(query.get("refresh_token", [None])[0])
+                    if user_id is None:
+                        return self.send_json(400, {"message": "Bad Request"})
+
+                    return self.send_json(200, {"access_token": "token-{}".format(user_id),
+                                                "refresh_token": "refresh-{}".format(user_id),
+                                                "expires_at": int(time.time()) + 6 * 3600})
+
+                return self.send_json(404, {"message": "Record Not Found"})
+
+        return Handler
+
+
+def make_events(activities, owner_id, updates=100, deletes=10, seed=0):
+
+    """ Function to generate the webhook events Strava would post for the activities of an athlete - a create for
+        every activity, followed by updates and deletes of random activities"""
+
+    rnd = random.Random(seed)
+    events = [{"object_type": "activity", "object_id": activity["id"], "aspect_type": "create",
+               "owner_id": int(owner_id), "subscription_id": 1, "event_time": int(_epoch(activity["start_date"])),
+               "updates": {}}
+              for activity in reversed(activities)]
+    event_time = events[-1]["event_time"] if events else int(time.time())
+
+    for aspect_type, count in (("update", updates), ("delete", deletes)):
+        for activity in rnd.sample(activities, min(count, len(activities))):
+            event_time += 60
+            events.append({"object_type": "activity", "object_id": activity["id"], "aspect_type": aspect_type,
+                           "owner_id": int(owner_id), "subscription_id": 1, "event_time": event_time,
+                           "updates": {"title": activity["name"] + " (edited)"} if aspect_type == "update" else {}})
+
+    return events
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Strava API")
+    parser.add_argument("--activities", type=int, default=3000, help="number of activities of the athlete")
+    parser.add_argument("--user-id", default="12210119")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay in seconds added to every request")
+    parser.add_argument("--record-events", metavar="PATH", help="write webhook events of the athlete to a file")
+    args = parser.parse_args()
+
+    if args.record_events:
+        with open(args.record_events, 'w') as events_file:
+            for event in make_events(make_activities(args.activities), args.user_id):
+                events_file.write(json.dumps(event) + "\n")
+    else:
+        server = FakeStrava({args.user_id: make_activities(args.activities)}, latency=args.latency,
+                            port=args.port).start()
+        print("Fake Strava API running on {} - access token: token-{}".format(server.url, args.user_id))
+        server.thread.join()
@@ -0,0 +1,206 @@
+""" Sync of all the users in the postGRE Strava database on a pool of workers. The application-wide Strava rate
+    limits are shared by every athlete we serve, so all the workers draw their requests from one token bucket which
+    is corrected with the X-RateLimit-* headers of the responses.
+
+    Run with `python fleet_sync.py [--workers 8] [user_id ...]`"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import Strava_functions
+import snapshot_store
+
+
+# Number of users synced at the same time
+FLEET_WORKERS = 8
+
+# Strava defaults - corrected by the headers of the first response
+DEFAULT_SHORT_LIMIT = 100
+DEFAULT_LONG_LIMIT = 1000
+
+# Requests which can be made in a burst - the bucket refills at the pace of the 15-minute limit
+BUCKET_CAPACITY = 10
+
+
+class TokenBucketRateLimiter(Strava_functions.RateLimiter):
+    """ This Class is a rate limiter which can be shared by many threads. Every request takes a token out of a bucket
+        which refills at short limit / 15 minutes, so the requests are spread over the window instead of being spent
+        in one burst. Next to the bucket the requests are counted per 15-minute window and per day - these counts
+        are corrected with the usage Strava reports, which also covers requests made by other processes"""
+
+    # Initialize an object of the class
+    def __init__(self, short_limit=DEFAULT_SHORT_LIMIT, long_limit=DEFAULT_LONG_LIMIT, capacity=BUCKET_CAPACITY,
+                 safety_margin=2):
+        super().__init__(safety_margin=safety_margin)
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.capacity = capacity
+        self.tokens = capacity
+        self.requests_made = 0
+        self.wait_seconds = 0.0
+        self._refilled_at = time.monotonic()
+        self._window = self._current_windows()
+
+    @staticmethod
+    def _current_windows(now=None):
+        now = now or datetime.now(timezone.utc)
+        return now.date(), now.hour * 4 + now.minute // 15
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.short_limit / (15 * 60)
+        self.tokens = min(self.capacity, self.tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+
+        # A new 15-minute window or a new day resets the counts
+        window = self._current_windows()
+        if window != self._window:
+            if window[0] != self._window[0]:
+                self.long_usage = 0
+            self.short_usage = 0
+            self._window = window
+
+    def update(self, headers):
+
+        """ Method to correct the counts with the headers of a Strava response - the local counts already hold
+            the requests which are still in flight, so the highest of both is kept"""
+
+        limit = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+
+        if not limit or not usage:
+            return
+
+        try:
+            short_limit, long_limit = [int(x) for x in limit.split(",")[:2]]
+            short_usage, long_usage = [int(x) for x in usage.split(",")[:2]]
+        except ValueError:
+            return
+
+        with self.lock:
+            self.short_limit, self.long_limit = short_limit, long_limit
+            self.short_usage = max(self.short_usage, short_usage)
+            self.long_usage = max(self.long_usage, long_usage)
+
+    def wait(self):
+
+        """ Method to block until a token is available and the request fits in the limits - the token and the
+            request are taken right away, so concurrent threads can not overshoot the limits"""
+
+        while True:
+            with self.lock:
+                self._refill()
+
+                if self.long_usage >= self.long_limit - self.safety_margin or \
+                        self.short_usage >= self.short_limit - self.safety_margin:
+                    seconds = None
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.short_usage += 1
+                    self.long_usage += 1
+                    self.requests_made += 1
+                    return
+                else:
+                    seconds = (1 - self.tokens) * (15 * 60) / self.short_limit
+
+            # Out of the window limits - wait for the next window
+            if seconds is None:
+                seconds = max(self.seconds_to_wait(), 1)
+
+            with self.lock:
+                self.wait_seconds += seconds
+            time.sleep(seconds)
+
+
+def get_users_by_activity():
+
+    """ Function to get all the users in the postGRE Strava database - the users with the most recent activities
+        come first"""
+
+    query = """SELECT auth_info.user_id
+               FROM auth_info
+               LEFT JOIN sync_state ON sync_state.user_id = auth_info.user_id
+               ORDER BY sync_state.last_start_epoch DESC NULLS LAST, auth_info.user_id"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the query
+    conn_obj.query_data(query, None)
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return [str(t[0]) for t in conn_obj.query_result or []]
+
+
+def sync_fleet(user_ids=None, max_workers=FLEET_WORKERS, rate_limiter=None, sync_user=None):
+
+    """ Function to run the incremental sync of many users on a pool of workers which share one rate limiter -
+        the new activities are added to the local snapshots of the users. The users are synced in the given order,
+        by default all the users with the most recently active first. Returns a report with the throughput of the run"""
+
+    user_ids = get_users_by_activity() if user_ids is None else list(user_ids)
+    rate_limiter = rate_limiter or TokenBucketRateLimiter()
+    sync_user = sync_user or snapshot_store.sync_user
+
+    results = {'succeeded': 0, 'failed': 0, 'activities': 0}
+    results_lock = threading.Lock()
+
+    def sync(user_id):
+        try:
+            synced = sync_user(user_id, rate_limiter=rate_limiter)
+            with results_lock:
+                results['succeeded'] += 1
+                results['activities'] += len(synced) if synced is not None else 0
+
+        except Exception as error:
+            print("Sync of user {} failed: {}".format(user_id, error))
+            with results_lock:
+                results['failed'] += 1
+
+    start = time.perf_counter()
+
+    # The executor starts the users in the order they are submitted - the most recently active first
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(sync, user_ids))
+
+    duration = time.perf_counter() - start
+
+    return {'users': len(user_ids),
+            'succeeded': results['succeeded'],
+            'failed': results['failed'],
+            'activities': results['activities'],
+            'duration_seconds': duration,
+            'users_per_minute': len(user_ids) / duration * 60 if duration > 0 else None,
+            'requests_used': rate_limiter.requests_made,
+            'rate_limit_wait_seconds': rate_limiter.wait_seconds,
+            'rate_limit_usage': {'short': [rate_limiter.short_usage, rate_limiter.short_limit],
+                                 'long': [rate_limiter.long_usage, rate_limiter.long_limit]}}
+
+
+def print_report(report):
+
+    """ Function to print the report of a fleet sync"""
+
+    print("Synced {succeeded}/{users} users ({failed} failed) and {activities} activities in "
+          "{duration_seconds:.1f} seconds".format(**report))
+    print("{:.1f} users/min - {} requests used, {:.0f} seconds waited for the rate limits".format(
+        report['users_per_minute'] or 0, report['requests_used'], report['rate_limit_wait_seconds']))
+    print("Rate limit usage: {}/{} (15 min) - {}/{} (day)".format(*report['rate_limit_usage']['short'],
+                                                                  *report['rate_limit_usage']['long']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync the activities of all the users")
+    parser.add_argument("user_ids", nargs="*", help="users to sync - all the users when none are given")
+    parser.add_argument("--workers", type=int, default=FLEET_WORKERS)
+    args = parser.parse_args()
+
+    print_report(sync_fleet(args.user_ids or None, max_workers=args.workers))
@@ -0,0 +1,32 @@
+# Gunicorn configuration of the Strava Dashboard - start with: gunicorn "main:create_server()"
+import multiprocessing
+import os
+
+import Strava_functions
+
+bind = os.environ.get("STRAVADASH_BIND", "0.0.0.0:8050")
+workers = int(os.environ.get("STRAVADASH_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("STRAVADASH_THREADS", 4))
+
+# Load the app and its data once in the master - the forked workers share it copy-on-write
+preload_app = True
+
+# The workers only reload the data when its version changes - the sync itself is run by update_activities.py
+os.environ.setdefault("STRAVADASH_SYNC_IN_APP", "0")
+
+
+def pre_fork(server, worker):
+    # The master does not use the database after loading - do not hand its connections down to the workers
+    Strava_functions.close_connection_pool()
+
+
+def post_fork(server, worker):
+    Strava_functions.reset_after_fork()
+
+
+def post_worker_init(worker):
+    # Warm up before the worker accepts traffic - threads do not survive the fork, so the refresher starts here
+    import main
+
+    if main.app is not None:
+        main.warm_up(main.app)
@@ -3,188 +3,444 @@
 # Press Shift+F10 to execute it or replace it with your code.
 # Press Double Shift to search everywhere for classes, files, tool windows, actions, and settings.
 
-import Strava_functions
+import os
+import activity_streams
+import dashboard_data
+import metrics
+import strava_webhooks
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import plotly.express as px
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import plotly.graph_objects as go
 
-# Get the data to plot out of the postGRE Strava database
-cart = Strava_functions.get_strava_activities("12210119")
-
-# Define the Dash app
-app = dash.Dash(__name__)
-
-# Start making the layout of the app
-app.layout = html.Div([
-
-    # Title Row
-    html.Div([
-            html.Div(className='col-md-2'),
-            html.Div(children=[
-                html.H1(children='Strava Dashboard')],
-                className='col-md-8',
-                style={'textAlign': 'center', 'color': 'white'}),
-            html.Div(className='col-md-2')
-        ],
-        className='row-eq-height',
-        style={'background-color': '#385448'}
-    ),
-
-    # Row containing the Dropdown
-    html.Div([
-            html.Div(className='col-md-2'),
-            html.Div(children=[
-                dcc.Dropdown(id='graph-type',
-                             options=[{'label': i, 'value': i} for i in cart['type'].unique()],
-                             value='Run')],
-                style={'width': '48%', 'display': 'inline-block', 'color': '#ffffff'}),
-            html.Div(className='col-md-1'),
-            html.Div(children=[
-                dcc.Dropdown(id='year-select',
-                             options=[{'label': i, 'value': i} for i in cart.year_month.dt.year.unique()],
-                             value=2020)],
-                style={'width': '48%', 'display': 'inline-block', 'color': '#ffffff'}),
-            html.Div(className='col-md-2'),
-        ],
-        className='row-eq-height',
-        style={'background-color': '#385448', 'color': 'white'}),
-
-    # Row containing the indicators
-    html.Div([
-            html.Div(children=[dcc.Graph(id='run_indicator')], className="col-md-4"),
-            html.Div(children=[dcc.Graph(id='bike_indicator')], className="col-md-4"),
-            html.Div(children=[dcc.Graph(id='swim_indicator')], className="col-md-4")
-        ],
-        className='row-eq-height',
-        style={'background-color': '#385448'}),
-
-    # Row containing the Bar Chart
-    html.Div([
-            html.Div(className='col-md-1'),
-            html.Div(children=[dcc.Graph(id='distance-barchart')], className="col-md-10"),
-            html.Div(className='col-md-1')
-        ],
-        className='row-eq-height',
-        style={'background-color': '#385448'}),
-
-    # Row containing link to Github and Twitter
-
-    html.Div([
-           html.Div(className='col-md-2'),
-           html.Div(children=
-                    [html.A([
-                              html.Img(
-                               src='/assets/twitter.png',
-                               style={
-                                'height' : '100%',
-                                'width' : '10%',
-                                'float' : 'right',
-                                'position' : 'relative',
-                                'padding-top' : 0,
-                                'padding-right' : 0
-                               }
-                        )
-                    ], href='https://twitter.com/AndriesDraux')], className="col-md-4"),
-           html.Div(children=
-                    [html.A([
-                              html.Img(
-                               src='/assets/github2.png',
-                               style={
-                                'height' : '100%',
-                                'width' : '10%',
-                                'float' : 'left',
-                                'position' : 'relative',
-                                'padding-top' : 0,
-                                'padding-right' : 0
-                               }
-                        )
-                    ], href='https://github.com/AndriesDraux')],className='col-md-4'),
-           html.Div(className='col-md-2')
-        ],
-        className='row-eq-height',
-        style={'background-color': '#385448'})
-
-    ])
-
-# Start defining the callback functions for making the graphs interactive
-
-# Callback for the Barchart
-@app.callback(
-    Output('distance-barchart', 'figure'),
-    Input('graph-type', 'value'),
-    Input('year-select', 'value'))
-def update_barchart(sport_type, year):
-    type_data = cart.loc[(cart['type'] == sport_type) & (cart.year_month.dt.year == year)]
-    months_ticks = cart.year_month.loc[cart.year_month.dt.year == year]
-
-    fig = px.bar(type_data, x='year_month', y='distance_in_km')
-    fig.update_yaxes(ticksuffix=" km", title_text="", color='white')
-    fig.update_xaxes(tickvals=months_ticks, tickformat="%b", title_text="", color='white')
-    fig.update_layout(xaxis_range=['{}-12-01'.format(int(year)-1), '{}-12-31'.format(year)] ,
-                      plot_bgcolor= '#385448', paper_bgcolor= '#385448')
+# Athlete shown on the dashboard when no athlete is given in the url (/athlete/<user_id>)
+USER_ID = "12210119"
 
-    return fig
+# Run the incremental sync in the background refresher of the app - switched off when the sync is done elsewhere,
+# e.g. by update_activities.py next to a multi-worker deployment
+SYNC_IN_APP = os.environ.get("STRAVADASH_SYNC_IN_APP", "1") == "1"
 
-# Callback for the Run Indicator
-@app.callback(
-    Output('run_indicator', 'figure'),
-    Input('year-select', 'value'))
+# Filter the data of an athlete in the browser - the monthly grid is sent once into a dcc.Store and the dropdowns
+# are handled by the clientside callbacks in assets/clientside.js. Switched off the callbacks run on the server
+CLIENTSIDE_FILTERING = os.environ.get("STRAVADASH_CLIENTSIDE", "1") == "1"
 
-def update_run_indicator(year):
-    cart['year'] = cart.year_month.dt.year
-    run_data = cart.loc[(cart['type'] == "Run") & (cart.year_month.dt.year == year)]. \
-        groupby('year', as_index=False).agg({'distance_in_km': 'sum', 'distance': 'sum'})
+# Sports shown in the row of indicators - the sport type and the title of its indicator
+INDICATOR_SPORTS = [("Run", "Total km Run in {}"),
+                    ("Ride", "Total km Biked in {}"),
+                    ("Swim", "Total km Swum in {}")]
 
-    fig = go.Figure(go.Indicator(
-        mode="number",
-        value= run_data.distance_in_km[0],
-        title=dict(text = "Total km Run in {}".format(year)),
-        number={"font": {"size": 56}}
-    ))
-    fig.update_layout(height=200, font=dict(color = "white"), paper_bgcolor='#385448')
-    return fig
 
-# Callback for the Bike indicator
-@app.callback(
-    Output('bike_indicator', 'figure'),
-    Input('year-select', 'value'))
+# Id of the graph of the indicator of a sport type
+def indicator_id(sport_type):
+    return '{}_indicator'.format(sport_type.lower())
 
-def update_bike_indicator(year):
-    cart['year'] = cart.year_month.dt.year
-    bike_data = cart.loc[(cart['type'] == "Ride") & (cart.year_month.dt.year == year)]. \
-        groupby('year', as_index=False).agg({'distance_in_km': 'sum', 'distance': 'sum'})
 
+# Make the figure of an indicator showing the total km of a sport type
+def make_indicator(total_km, title):
     fig = go.Figure(go.Indicator(
         mode="number",
-        value=bike_data.distance_in_km[0],
-        title="Total km Biked in {}".format(year),
+        value=total_km,
+        title=dict(text=title),
         number={"font": {"size": 56}}
     ))
     fig.update_layout(height=200, font=dict(color = "white"), paper_bgcolor='#385448')
     return fig
 
-# Callback for the Swim indicator
-@app.callback(
-    Output('swim_indicator', 'figure'),
-    Input('year-select', 'value'))
 
-def update_swim_indicator(year):
-    cart['year'] = cart.year_month.dt.year
-    swim_data = cart.loc[(cart['type'] == "Swim") & (cart.year_month.dt.year == year)]. \
-        groupby('year', as_index=False).agg({'distance_in_km': 'sum', 'distance': 'sum'})
+# Get the athlete of a page out of its url - /athlete/<user_id>. Athletes who have not connected the app get the
+# default athlete
+def user_from_path(pathname, default_user_id, known_users=None):
+    parts = (pathname or '').strip('/').split('/')
+    if len(parts) == 2 and parts[0] == 'athlete' and parts[1].isdigit():
+        if known_users is None or known_users(parts[1]):
+            return parts[1]
+    return default_user_id
+
+
+# Start making the layout of the app - the options of the dropdowns are filled in for the athlete of the url
+def make_layout():
+    return html.Div([
+
+        # Url of the page - holds the athlete to show
+        dcc.Location(id='url', refresh=False),
+
+        # Monthly grid of the athlete and its version for the clientside callbacks - kept in the session storage of
+        # the tab, so it is only sent again when the data has changed. The local storage is shared by all the tabs,
+        # a tab showing another athlete would overwrite the grid under the feet of this one
+        dcc.Store(id='grid-store', storage_type='session'),
+        dcc.Store(id='grid-version', storage_type='session'),
+        dcc.Store(id='indicator-sports', data=[list(sport) for sport in INDICATOR_SPORTS]),
+
+        # Title Row
+        html.Div([
+                html.Div(className='col-md-2'),
+                html.Div(children=[
+                    html.H1(children='Strava Dashboard')],
+                    className='col-md-8',
+                    style={'textAlign': 'center', 'color': 'white'}),
+                html.Div(className='col-md-2')
+            ],
+            className='row-eq-height',
+            style={'background-color': '#385448'}
+        ),
+
+        # Row containing the Dropdown
+        html.Div([
+                html.Div(className='col-md-2'),
+                html.Div(children=[
+                    dcc.Dropdown(id='graph-type',
+                                 options=[],
+                                 value='Run')],
+                    style={'width': '48%', 'display': 'inline-block', 'color': '#ffffff'}),
+                html.Div(className='col-md-1'),
+                html.Div(children=[
+                    dcc.Dropdown(id='year-select',
+                                 options=[],
+                                 value=2020)],
+                    style={'width': '48%', 'display': 'inline-block', 'color': '#ffffff'}),
+                html.Div(className='col-md-2'),
+            ],
+            className='row-eq-height',
+            style={'background-color': '#385448', 'color': 'white'}),
+
+        # Row containing the indicators
+        html.Div([
+                html.Div(children=[dcc.Graph(id=indicator_id(sport_type))],
+                         className="col-md-{}".format(max(12 // len(INDICATOR_SPORTS), 1)))
+                for sport_type, _ in INDICATOR_SPORTS
+            ],
+            className='row-eq-height',
+            style={'background-color': '#385448'}),
+
+        # Row containing the Bar Chart
+        html.Div([
+                html.Div(className='col-md-1'),
+                html.Div(children=[dcc.Graph(id='distance-barchart')], className="col-md-10"),
+                html.Div(className='col-md-1')
+            ],
+            className='row-eq-height',
+            style={'background-color': '#385448'}),
+
+        # Row containing link to Github and Twitter
+
+        html.Div([
+               html.Div(className='col-md-2'),
+               html.Div(children=
+                        [html.A([
+                                  html.Img(
+                                   src='/assets/twitter.png',
+                                   style={
+                                    'height' : '100%',
+                                    'width' : '10%',
+                                    'float' : 'right',
+                                    'position' : 'relative',
+                                    'padding-top' : 0,
+                                    'padding-right' : 0
+                                   }
+                            )
+                        ], href='https://twitter.com/AndriesDraux')], className="col-md-4"),
+               html.Div(children=
+                        [html.A([
+                                  html.Img(
+                                   src='/assets/github2.png',
+                                   style={
+                                    'height' : '100%',
+                                    'width' : '10%',
+                                    'float' : 'left',
+                                    'position' : 'relative',
+                                    'padding-top' : 0,
+                                    'padding-right' : 0
+                                   }
+                            )
+                        ], href='https://github.com/AndriesDraux')],className='col-md-4'),
+               html.Div(className='col-md-2')
+            ],
+            className='row-eq-height',
+            style={'background-color': '#385448'})
+
+        ])
+
+
+# Make the bar chart of the monthly distance of a sport type in a year
+def make_barchart(index, sport_type, year):
+    fig = go.Figure()
+    fig.update_layout(plot_bgcolor='#385448', paper_bgcolor='#385448')
+
+    # No year selected yet - an athlete without activities has no years to choose from
+    if year is None:
+        return fig
+
+    months, distance_in_km = index.monthly_distance(sport_type, year)
+    months_ticks = index.month_ticks(year)
+
+    # A sport without activities in the year gives an empty chart
+    fig.add_trace(go.Bar(x=months, y=distance_in_km))
+    fig.update_yaxes(ticksuffix=" km", title_text="", color='white')
+    fig.update_xaxes(tickvals=months_ticks, tickformat="%b", title_text="", color='white')
+    fig.update_layout(xaxis_range=['{}-12-01'.format(int(year)-1), '{}-12-31'.format(year)])
 
-    fig = go.Figure(go.Indicator(
-        mode="number",
-        value=swim_data.distance_in_km[0],
-        title="Total km Swum in {}".format(year),
-        number={"font": {"size": 56}}
-    ))
-    fig.update_layout(height=200, font=dict(color = "white"), paper_bgcolor='#385448')
     return fig
 
+
+def create_app(default_user_id=USER_ID, preload=False, clientside=CLIENTSIDE_FILTERING,
+               loader=dashboard_data.load_snapshot, known_users=None):
+
+    """ Function to create the Dash app. Creating the app does not touch the database - the data of an athlete is
+        loaded by the first request for the athlete, by warm_up, or with preload=True. With clientside the
+        dropdowns are handled in the browser, otherwise by callbacks on the server. known_users tells which athletes
+        of the urls may be loaded - by default the athletes with tokens in the database"""
+
+    # Define the Dash app
+    app = dash.Dash(__name__)
+
+    # Snapshots of the athletes in memory - the refresher keeps them up to date in the background
+    snapshot_cache = dashboard_data.SnapshotCache(loader=loader)
+    refresher = dashboard_data.DataRefresher(snapshot_cache, sync=SYNC_IN_APP)
+
+    # Cache of the bar chart figures - keyed on the dataset version so a sync invalidates it
+    figure_cache = dashboard_data.FigureCache()
+
+    # Workers applying the events of the Strava push subscription - run elsewhere when the sync is not done in the
+    # app, the endpoint then only stores the events
+    webhook_processor = strava_webhooks.WebhookProcessor() if SYNC_IN_APP else None
+
+    app.default_user_id = default_user_id
+    app.known_users = known_users or dashboard_data.KnownUsers()
+    app.snapshot_cache = snapshot_cache
+    app.refresher = refresher
+    app.figure_cache = figure_cache
+    app.webhook_processor = webhook_processor
+
+    app.layout = make_layout()
+
+    if clientside:
+        register_clientside_callbacks(app)
+    else:
+        register_server_callbacks(app)
+
+    # Endpoint of the Strava push subscription
+    strava_webhooks.register_routes(app.server, on_event=webhook_processor.wake if webhook_processor else None)
+
+    # Liveness - the process is up and serving
+    @app.server.route('/healthz')
+    def liveness():
+        return flask.jsonify({'status': 'alive'})
+
+    # Readiness - the data of the default athlete has been loaded, the load balancer can route traffic to this worker
+    @app.server.route('/readyz')
+    def readiness():
+        snapshot = snapshot_cache.peek(default_user_id)
+        if snapshot is None:
+            return flask.jsonify({'status': 'warming up'}), 503
+        return flask.jsonify({'status': 'ready', 'version': snapshot.version})
+
+    # Hit and miss counters of the figure cache
+    @app.server.route('/stats/figure-cache')
+    def figure_cache_stats():
+        return flask.jsonify(figure_cache.stats())
+
+    # Athletes in memory and the memory they take
+    @app.server.route('/stats/snapshots')
+    def snapshot_cache_stats():
+        return flask.jsonify(snapshot_cache.stats())
+
+    # Memory taken by the data of every athlete in memory, per column
+    @app.server.route('/stats/memory')
+    def memory_stats():
+        return flask.jsonify(snapshot_cache.memory_report())
+
+    # Counters of the webhook workers of this process
+    @app.server.route('/stats/webhooks')
+    def webhook_stats():
+        return flask.jsonify(webhook_processor.stats() if webhook_processor else {'workers': 0})
+
+    # Duration of the last refresh and staleness of the data
+    @app.server.route('/stats/refresh')
+    def refresh_stats():
+        return flask.jsonify(refresher.stats())
+
+    # Streams of an activity at the resolution a chart asks for - ?kind=route|series&points=<number of points>.
+    # Only the public activities of athletes who connected the app are served, and the activity has to belong to
+    # the athlete of the url
+    @app.server.route('/streams/<int:user_id>/<int:activity_id>')
+    def activity_stream(user_id, activity_id):
+        kind = flask.request.args.get('kind', 'series')
+        points = flask.request.args.get('points', type=int)
+
+        if kind not in ('route', 'series', 'full'):
+            return flask.jsonify({'error': 'unknown kind {}'.format(kind)}), 400
+
+        if not app.known_users(str(user_id)):
+            return flask.jsonify({'error': 'unknown athlete {}'.format(user_id)}), 404
+
+        level = activity_streams.load_streams(user_id, activity_id, kind, points)
+        if level is None:
+            return flask.jsonify({'error': 'no streams for activity {}'.format(activity_id)}), 404
+
+        return flask.jsonify(activity_streams.streams_payload(activity_id, level))
+
+    # Metrics of the database, the Strava API, the sync and the callbacks in the Prometheus text format
+    @app.server.route('/metrics')
+    def prometheus_metrics():
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    if preload:
+        refresher.load(default_user_id)
+
+    return app
+
+
+def register_server_callbacks(app):
+
+    """ Function to add the callbacks which filter the data of an athlete on the server - every change of a
+        dropdown is a request to the server which returns the figures"""
+
+    refresher = app.refresher
+    figure_cache = app.figure_cache
+    default_user_id = app.default_user_id
+    known_users = app.known_users
+
+    # Callback for the Dropdowns - fill in the sport types and years of the athlete
+    @app.callback(
+        Output('graph-type', 'options'),
+        Output('graph-type', 'value'),
+        Output('year-select', 'options'),
+        Output('year-select', 'value'),
+        Input('url', 'pathname'),
+        State('graph-type', 'value'),
+        State('year-select', 'value'))
+    @metrics.instrument_callback
+    def update_dropdowns(pathname, sport_type, year):
+        index = refresher.load(user_from_path(pathname, default_user_id, known_users)).index
+
+        # Keep the selection when the athlete has data for it
+        if sport_type not in index.types:
+            sport_type = 'Run' if 'Run' in index.types else next(iter(index.types), None)
+        if year not in index.years:
+            year = index.years[-1] if index.years else None
+
+        return [{'label': i, 'value': i} for i in index.types], sport_type, \
+               [{'label': i, 'value': i} for i in index.years], year
+
+    # Callback for the Barchart
+    @app.callback(
+        Output('distance-barchart', 'figure'),
+        Input('url', 'pathname'),
+        Input('graph-type', 'value'),
+        Input('year-select', 'value'))
+    @metrics.instrument_callback
+    def update_barchart(pathname, sport_type, year):
+        user_id = user_from_path(pathname, default_user_id, known_users)
+        snapshot = refresher.load(user_id)
+
+        return figure_cache.get_or_build((user_id, sport_type, year, snapshot.version),
+                                         lambda: make_barchart(snapshot.index, sport_type, year))
+
+    # Callback for the indicators - all the sports in one go
+    @app.callback(
+        [Output(indicator_id(sport_type), 'figure') for sport_type, _ in INDICATOR_SPORTS],
+        Input('url', 'pathname'),
+        Input('year-select', 'value'))
+    @metrics.instrument_callback
+    def update_indicators(pathname, year):
+        totals = refresher.load(user_from_path(pathname, default_user_id, known_users)).index.yearly_totals(year)
+
+        return [make_indicator(totals.get(sport_type, 0), title.format(year))
+                for sport_type, title in INDICATOR_SPORTS]
+
+
+def register_clientside_callbacks(app):
+
+    """ Function to add the callbacks which filter the data of an athlete in the browser - the server only sends the
+        monthly grid of the athlete when the page is opened and its version has changed"""
+
+    refresher = app.refresher
+    default_user_id = app.default_user_id
+    known_users = app.known_users
+
+    # Callback for the grid of the athlete - nothing is sent when the browser already has this version
+    @app.callback(
+        Output('grid-store', 'data'),
+        Output('grid-version', 'data'),
+        Input('url', 'pathname'),
+        State('grid-version', 'data'))
+    @metrics.instrument_callback
+    def update_grid_store(pathname, cached_version):
+        user_id = user_from_path(pathname, default_user_id, known_users)
+        snapshot = refresher.load(user_id)
+        version = {'user_id': user_id, 'version': snapshot.version}
+
+        if cached_version == version:
+            return dash.no_update, dash.no_update
+
+        return dashboard_data.grid_payload(snapshot), version
+
+    # Callbacks for the Dropdowns, the Barchart and the indicators - run in the browser out of the grid
+    app.clientside_callback(
+        ClientsideFunction(namespace='stravadash', function_name='dropdowns'),
+        Output('graph-type', 'options'),
+        Output('graph-type', 'value'),
+        Output('year-select', 'options'),
+        Output('year-select', 'value'),
+        Input('grid-store', 'data'),
+        State('graph-type', 'value'),
+        State('year-select', 'value'))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='stravadash', function_name='barchart'),
+        Output('distance-barchart', 'figure'),
+        Input('grid-store', 'data'),
+        Input('graph-type', 'value'),
+        Input('year-select', 'value'))
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='stravadash', function_name='indicators'),
+        [Output(indicator_id(sport_type), 'figure') for sport_type, _ in INDICATOR_SPORTS],
+        Input('grid-store', 'data'),
+        Input('year-select', 'value'),
+        State('indicator-sports', 'data'))
+
+
+def warm_up(app):
+
+    """ Function to load the data of the app and start the background refresher and the webhook workers - called
+        once per worker before it accepts traffic"""
+
+    app.refresher.load(app.default_user_id)
+    app.refresher.start()
+
+    if app.webhook_processor is not None:
+        app.webhook_processor.start()
+
+
+# App served by a WSGI server - created by create_server
+app = None
+
+
+def create_server(preload=True):
+
+    """ Function used as WSGI entry point, e.g. gunicorn "main:create_server()". With preload the data is loaded
+        right away - together with preload_app in gunicorn this happens once in the master before the workers are
+        forked, so the workers share the data copy-on-write"""
+
+    global app
+
+    app = create_app(preload=preload)
+
+    return app.server
+
+
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    debug = True
+
+    # In debug mode the reloader runs the app again in a child process which serves the requests - the process
+    # watching the files does not load the data nor start the workers, they would run twice
+    serving = not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+    app = create_app(preload=serving)
+    if serving:
+        warm_up(app)
+    app.run_server(debug=debug)
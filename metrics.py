@@ -0,0 +1,245 @@
+""" Lightweight instrumentation of the hot paths - counters, gauges and histograms which are kept in memory and
+    rendered in the Prometheus text format on the /metrics route of the app. Every process has its own metrics;
+    with several gunicorn workers a scrape shows the worker which answered it, the pid is in the process label.
+
+    Slow Dash callbacks can be profiled: with STRAVADASH_PROFILE_SLOW_SECONDS set, every callback runs under cProfile
+    and the profile of a callback which took longer than that number of seconds is written to
+    STRAVADASH_PROFILE_DIR (default: profiles) - read it with `python -m pstats <file>`."""
+
+import cProfile
+import functools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds of the buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Profiling of slow callbacks - switched off when no threshold is given
+PROFILE_SLOW_SECONDS = float(os.environ["STRAVADASH_PROFILE_SLOW_SECONDS"]) \
+    if os.environ.get("STRAVADASH_PROFILE_SLOW_SECONDS") else None
+PROFILE_DIR = os.environ.get("STRAVADASH_PROFILE_DIR", "profiles")
+
+_registry = []
+_registry_lock = threading.Lock()
+
+# Only one profiler can be active at a time - concurrent slow callbacks are timed without a profile
+_profile_lock = threading.Lock()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+class _Metric:
+
+    kind = None
+
+    # Initialize an object of the class
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, _format_labels(labels), repr(float(value))))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """ This Class counts events - e.g. requests or errors - per combination of labels"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ This Class holds the last value set per combination of labels - e.g. the headroom of a rate limit"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """ This Class counts observed durations in cumulative buckets, with their sum and count, per combination of
+        labels"""
+
+    kind = "histogram"
+
+    # Initialize an object of the class
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for number, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[number] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+
+        """ Method to observe the duration of a block of code - can also be used as a decorator of a function"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        samples = []
+        for key, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", key + (("le", repr(bound)),), count))
+            samples.append((self.name + "_bucket", key + (("le", "+Inf"),), counts[-2]))
+            samples.append((self.name + "_count", key, counts[-2]))
+            samples.append((self.name + "_sum", key, counts[-1]))
+        return samples
+
+
+def render():
+
+    """ Function to render all the metrics of this process in the Prometheus text format"""
+
+    PROCESS_INFO.set(1, process=os.getpid())
+
+    with _registry_lock:
+        metrics = list(_registry)
+
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# Metrics of the hot paths
+PROCESS_INFO = Gauge("stravadash_process_info", "Process which rendered the metrics", ["process"])
+
+DB_SECONDS = Histogram("stravadash_db_operation_seconds",
+                       "Duration of the operations on the postGRE Strava database", ["operation"])
+DB_ERRORS = Counter("stravadash_db_errors_total", "Failed operations on the postGRE Strava database", ["operation"])
+DB_ROWS = Counter("stravadash_db_rows_total", "Rows read or written by the operations on the database",
+                  ["operation"])
+
+STRAVA_SECONDS = Histogram("stravadash_strava_request_seconds", "Duration of the requests to the Strava API",
+                           ["endpoint", "status"])
+STRAVA_RATE_HEADROOM = Gauge("stravadash_strava_rate_limit_headroom",
+                             "Requests left in the Strava rate limit windows", ["window"])
+
+SYNC_STAGE_SECONDS = Histogram("stravadash_sync_stage_seconds", "Duration of the stages of the sync of a user",
+                               ["sync", "stage"])
+SYNC_ACTIVITIES = Counter("stravadash_sync_activities_total", "Activities written by the sync", ["sync"])
+
+CALLBACK_SECONDS = Histogram("stravadash_callback_seconds", "Duration of the Dash callbacks", ["callback"])
+CALLBACK_ERRORS = Counter("stravadash_callback_errors_total", "Dash callbacks which raised an error", ["callback"])
+CALLBACK_PROFILES = Counter("stravadash_callback_profiles_total", "Profiles written of slow Dash callbacks",
+                            ["callback"])
+
+
+def strava_endpoint(url):
+
+    """ Function to get the endpoint of a Strava url - the ids are replaced so the number of label values stays
+        small, e.g. /activities/{id}"""
+
+    path = re.sub(r"^[a-z]+://[^/]+", "", url)
+    path = re.sub(r"^/api/v3", "", path)
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+def record_rate_limit(headers):
+
+    """ Function to record the requests left in the 15-minute and the daily window out of the X-RateLimit headers"""
+
+    limit = headers.get("X-RateLimit-Limit")
+    usage = headers.get("X-RateLimit-Usage")
+
+    if not limit or not usage:
+        return
+
+    try:
+        limits = [int(x) for x in limit.split(",")[:2]]
+        usages = [int(x) for x in usage.split(",")[:2]]
+    except ValueError:
+        return
+
+    for window, window_limit, window_usage in zip(("15min", "daily"), limits, usages):
+        STRAVA_RATE_HEADROOM.set(window_limit - window_usage, window=window)
+
+
+def _write_profile(profiler, name, duration):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, "{}-{}-{:.0f}ms.prof".format(name, time.strftime("%Y%m%d-%H%M%S"),
+                                                                  duration * 1000))
+    profiler.dump_stats(path)
+    CALLBACK_PROFILES.inc(callback=name)
+
+
+def instrument_callback(function):
+
+    """ Decorator to time a Dash callback - with profiling switched on the callback runs under cProfile and the
+        profile is written when it was slow"""
+
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = None
+        if PROFILE_SLOW_SECONDS is not None and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+
+        start = time.perf_counter()
+
+        try:
+            if profiler is None:
+                return function(*args, **kwargs)
+            return profiler.runcall(function, *args, **kwargs)
+
+        except Exception:
+            CALLBACK_ERRORS.inc(callback=name)
+            raise
+
+        finally:
+            duration = time.perf_counter() - start
+            CALLBACK_SECONDS.observe(duration, callback=name)
+
+            if profiler is not None:
+                _profile_lock.release()
+                if duration >= PROFILE_SLOW_SECONDS:
+                    _write_profile(profiler, name, duration)
+
+    return wrapper
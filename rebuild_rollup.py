@@ -0,0 +1,24 @@
+import sys
+
+import Strava_functions as stf
+
+# Verify the monthly_totals rollup against the activities table - for the given user ids or for all users.
+# The rollup is rebuilt when it does not match, or always with --force
+force = "--force" in sys.argv
+user_ids = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or [None]
+
+for user_id in user_ids:
+    label = user_id or "all users"
+    mismatches = stf.verify_monthly_totals(user_id)
+
+    if len(mismatches) == 0 and not force:
+        print("The monthly totals of {} match the activities".format(label))
+        continue
+
+    print("{} monthly totals of {} do not match the activities".format(len(mismatches), label))
+    if len(mismatches) > 0:
+        print(mismatches.to_string(index=False))
+
+    if stf.rebuild_monthly_totals(user_id):
+        print("Rebuilt the monthly totals of {} - {} mismatches left".format(
+            label, len(stf.verify_monthly_totals(user_id))))
@@ -0,0 +1,375 @@
+""" Schema of the postGRE Strava database, kept as a list of numbered migrations. The applied migrations are recorded
+    in the schema_migrations table, so `python schema.py migrate` only runs the migrations a database is missing.
+    Every migration runs in its own transaction under an advisory lock and only creates what does not exist yet,
+    so it can also be run against a database which was created by hand.
+
+    The activities table can be hash partitioned on user_id with --partitions (or STRAVADASH_ACTIVITY_PARTITIONS) -
+    this is decided when the table is created, an existing table is left as it is. Its key is (user_id, id), the
+    conflict target of the upserts in Strava_functions.py, as every unique key of a partitioned table has to contain
+    the partition key.
+
+    `python schema.py check --rows 5000000` fills the tables with synthetic rows in a transaction which is rolled
+    back, and checks with EXPLAIN that the hot queries of the sync and the dashboard use the indexes"""
+
+import argparse
+import json
+import os
+
+import Strava_functions
+
+
+# Number of hash partitions of a new activities table - 0 creates a plain table
+ACTIVITY_PARTITIONS = int(os.environ.get("STRAVADASH_ACTIVITY_PARTITIONS", "0"))
+
+# Types of the columns of the activities table, after the dtypes of Strava_functions.ACTIVITY_SCHEMA
+SQL_TYPES = {'int64': 'BIGINT', 'float64': 'DOUBLE PRECISION', 'bool': 'BOOLEAN', 'object': 'TEXT',
+             'datetime64[ns]': 'DATE'}
+
+# Only one process migrates the database at a time
+LOCK_QUERY = "SELECT pg_advisory_xact_lock(hashtext('stravadash:schema'))"
+
+MIGRATIONS_TABLE = """CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY,
+                                                                    description TEXT,
+                                                                    applied_at TIMESTAMPTZ DEFAULT now())"""
+
+
+def _activities_table(partitions):
+
+    """ Function to get the statements which create the activities table - hash partitioned on user_id when
+        partitions is above 0"""
+
+    columns = ", ".join("{} {}".format(column, 'BIGINT' if column == 'user_id' else SQL_TYPES[dtype])
+                        for column, dtype, _ in Strava_functions.ACTIVITY_SCHEMA)
+
+    # The primary key is named like the unique index of migration 7, which adds the key to a table created by hand
+    create = "CREATE TABLE IF NOT EXISTS activities ({}, CONSTRAINT activities_user_id_id_key " \
+             "PRIMARY KEY (user_id, id))".format(columns)
+
+    if partitions <= 0:
+        return [create]
+
+    return [create + " PARTITION BY HASH (user_id)"] + \
+           ["""CREATE TABLE IF NOT EXISTS activities_p{0} PARTITION OF activities
+               FOR VALUES WITH (MODULUS {1}, REMAINDER {0})""".format(remainder, partitions)
+            for remainder in range(partitions)]
+
+
+def _activities_and_tokens(partitions):
+    return _activities_table(partitions) + \
+        ["""CREATE TABLE IF NOT EXISTS auth_info (user_id BIGINT PRIMARY KEY,
+                                                  auth_key TEXT,
+                                                  recovery_key TEXT,
+                                                  expiration_date BIGINT)"""]
+
+
+def _sync_watermark(partitions):
+    return ["""CREATE TABLE IF NOT EXISTS sync_state (user_id BIGINT PRIMARY KEY,
+                                                     last_start_epoch BIGINT,
+                                                     last_activity_id BIGINT,
+                                                     updated_at TIMESTAMPTZ)"""]
+
+
+def _backfill_progress(partitions):
+    return ["ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS backfill_completed BOOLEAN"]
+
+
+def _monthly_rollup(partitions):
+    return ["""CREATE TABLE IF NOT EXISTS monthly_totals (user_id BIGINT,
+                                                         type TEXT,
+                                                         year_month DATE,
+                                                         distance DOUBLE PRECISION,
+                                                         distance_in_km DOUBLE PRECISION,
+                                                         activity_count INTEGER,
+                                                         moving_time BIGINT,
+                                                         total_elevation_gain DOUBLE PRECISION,
+                                                         PRIMARY KEY (user_id, year_month, type))"""]
+
+
+def _dataset_version(partitions):
+    return ["ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS data_version BIGINT"]
+
+
+def _webhook_queue(partitions):
+    return ["""CREATE TABLE IF NOT EXISTS webhook_events (event_id BIGSERIAL PRIMARY KEY,
+                                                         object_type TEXT,
+                                                         object_id BIGINT,
+                                                         aspect_type TEXT,
+                                                         owner_id BIGINT,
+                                                         event_time BIGINT,
+                                                         updates JSONB,
+                                                         received_at TIMESTAMPTZ DEFAULT now(),
+                                                         claimed_at TIMESTAMPTZ,
+                                                         processed_at TIMESTAMPTZ,
+                                                         attempts INTEGER DEFAULT 0,
+                                                         error TEXT)""",
+
+            # The workers only look at the events which still have to be processed
+            """CREATE INDEX IF NOT EXISTS webhook_events_pending_idx ON webhook_events (event_id)
+               WHERE processed_at IS NULL"""]
+
+
+def _hot_query_indexes(partitions):
+    return [
+        # Conflict target of the upserts - already there when the table was created by the first migration
+        "CREATE UNIQUE INDEX IF NOT EXISTS activities_user_id_id_key ON activities (user_id, id)",
+
+        # Writes and deletes of single activities out of webhook events only know the id of the activity
+        "CREATE INDEX IF NOT EXISTS activities_id_idx ON activities (id)",
+
+        # High-water mark of the incremental sync
+        "CREATE INDEX IF NOT EXISTS activities_user_id_start_epoch_idx ON activities (user_id, start_epoch)",
+
+        # Recomputation of the rollup of a month - the index holds every column the rollup sums
+        """CREATE INDEX IF NOT EXISTS activities_user_id_year_month_type_idx
+           ON activities (user_id, year_month, type)
+           INCLUDE (distance, distance_in_km, moving_time, total_elevation_gain)"""]
+
+
+def _activity_streams(partitions):
+    return [
+        # Levels of detail of the streams of an activity, see activity_streams.py - removed with their activity
+        """CREATE TABLE IF NOT EXISTS activity_streams (user_id BIGINT,
+                                                       activity_id BIGINT,
+                                                       kind TEXT,
+                                                       max_points INTEGER,
+                                                       points INTEGER,
+                                                       data BYTEA,
+                                                       fetched_at TIMESTAMPTZ DEFAULT now(),
+                                                       PRIMARY KEY (user_id, activity_id, kind, max_points),
+                                                       FOREIGN KEY (user_id, activity_id)
+                                                           REFERENCES activities (user_id, id) ON DELETE CASCADE)""",
+
+        # The blocks are compressed already - store them out of line without compressing them again
+        "ALTER TABLE activity_streams ALTER COLUMN data SET STORAGE EXTERNAL"]
+
+
+def _backfill_by_start(partitions):
+    # An interrupted backfill resumes before the oldest committed activity
+    return ["ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS backfill_before BIGINT"]
+
+
+# Migrations of the database - (version, description, function returning the statements). Every table and column
+# is added by the migration of the feature which started to use it. Add new migrations at the end and never change
+# one which has been released
+MIGRATIONS = [(1, "activities and tokens of the athletes", _activities_and_tokens),
+              (2, "high-water mark of the incremental sync", _sync_watermark),
+              (3, "progress of an interrupted backfill", _backfill_progress),
+              (4, "monthly_totals rollup", _monthly_rollup),
+              (5, "dataset version of the caches of the dashboard", _dataset_version),
+              (6, "queue of the Strava webhook events", _webhook_queue),
+              (7, "indexes of the hot queries of the sync and the dashboard", _hot_query_indexes),
+              (8, "levels of detail of the streams of the activities", _activity_streams),
+              (9, "backfill resumed by the start of the oldest committed activity", _backfill_by_start)]
+
+
+def get_schema_version():
+
+    """ Function to get the version of the schema of the postGRE Strava database - 0 for a database which has
+        never been migrated"""
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # The migrations table does not exist before the first migration
+    conn_obj.query_data("SELECT to_regclass('schema_migrations') IS NOT NULL", None)
+    version = 0
+
+    if conn_obj.query_result and conn_obj.query_result[0][0]:
+        conn_obj.query_data("SELECT COALESCE(MAX(version), 0) FROM schema_migrations", None)
+        version = conn_obj.query_result[0][0] if conn_obj.query_result else 0
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return version
+
+
+def migrate(target=None, partitions=ACTIVITY_PARTITIONS):
+
+    """ Function to apply the migrations which are missing in the postGRE Strava database, up to the target
+        version or all of them. Returns the versions which have been applied"""
+
+    applied = []
+    current = get_schema_version()
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    try:
+        for version, description, statements in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+
+            # Another process may have applied the migration while this one waited for the lock - the statements
+            # only create what is missing, and the version is recorded once
+            transaction = [('execute', LOCK_QUERY, None), ('execute', MIGRATIONS_TABLE, None)] + \
+                          [('execute', statement, None) for statement in statements(partitions)] + \
+                          [('execute', """INSERT INTO schema_migrations (version, description) VALUES (%s, %s)
+                                          ON CONFLICT (version) DO NOTHING""", (version, description))]
+
+            if not conn_obj.execute_transaction(transaction):
+                print("Migration {} ({}) failed".format(version, description))
+                break
+
+            applied.append(version)
+            print("Applied migration {}: {}".format(version, description))
+
+    finally:
+        # Close the connection
+        conn_obj.close_connection()
+
+    return applied
+
+
+# Queries of the sync and the dashboard which are run for every user - checked with EXPLAIN
+HOT_QUERIES = {'activities of a user': "SELECT * FROM activities WHERE user_id = %(user_id)s",
+               'sync watermark': "SELECT MAX(start_epoch), MAX(id) FROM activities WHERE user_id = %(user_id)s",
+               'months of written activities': """SELECT DISTINCT user_id, year_month FROM activities
+                                                  WHERE id = ANY(%(ids)s)""",
+               'delete of activities': "DELETE FROM activities WHERE id = ANY(%(ids)s)",
+               'rollup of a month': """SELECT user_id, type, year_month, SUM(distance), SUM(distance_in_km), COUNT(*),
+                                              SUM(moving_time), SUM(total_elevation_gain)
+                                       FROM activities
+                                       WHERE user_id = %(user_id)s AND year_month = %(year_month)s
+                                       GROUP BY user_id, type, year_month""",
+               'monthly totals of a user': """SELECT year_month, type, distance, distance_in_km
+                                              FROM monthly_totals WHERE user_id = %(user_id)s""",
+               'activities without streams': """SELECT a.id FROM activities a
+                                                WHERE a.user_id = %(user_id)s AND NOT a.manual
+                                                  AND NOT EXISTS (SELECT 1 FROM activity_streams s
+                                                                  WHERE s.user_id = a.user_id
+                                                                    AND s.activity_id = a.id)
+                                                ORDER BY a.start_epoch DESC LIMIT 50"""}
+
+# Tables which must never be read with a sequential scan by the hot queries
+INDEXED_TABLES = ('activities', 'monthly_totals')
+
+# Synthetic rows for the check at scale - ids far above the ids Strava hands out
+POPULATE_QUERIES = ["""INSERT INTO activities (id, user_id, name, distance, moving_time, total_elevation_gain, type,
+                                               start_date_local, start_epoch, year_month, distance_in_km)
+                       SELECT 9000000000000 + g, 9000000000 + g %% %(users)s, 'Synthetic', d, d / 3,
+                              (g %% 500)::double precision, (ARRAY['Run', 'Ride', 'Swim'])[1 + g %% 3],
+                              to_char(to_timestamp(e), 'YYYY-MM-DD"T"HH24:MI:SS"Z"'), e,
+                              date_trunc('month', to_timestamp(e) AT TIME ZONE 'UTC')::date, d / 1000.0
+                       FROM generate_series(1, %(rows)s::bigint) g,
+                            LATERAL (SELECT 1400000000 + (g / %(users)s) * 43200 AS e,
+                                            1000 + (g * 7919) %% 50000 AS d) v""",
+                    """INSERT INTO monthly_totals (user_id, type, year_month, distance, distance_in_km,
+                                                   activity_count, moving_time, total_elevation_gain)
+                       SELECT user_id, type, year_month, SUM(distance), SUM(distance_in_km), COUNT(*),
+                              SUM(moving_time), SUM(total_elevation_gain)
+                       FROM activities WHERE id > 9000000000000
+                       GROUP BY user_id, type, year_month
+                       ON CONFLICT DO NOTHING""",
+                    "ANALYZE activities",
+                    "ANALYZE monthly_totals"]
+
+
+def _plan_nodes(plan):
+
+    """ Function to list the nodes of an EXPLAIN plan in JSON format - (node type, table) tuples"""
+
+    nodes = [(plan['Node Type'], plan.get('Relation Name'))]
+    for child in plan.get('Plans', []):
+        nodes.extend(_plan_nodes(child))
+    return nodes
+
+
+def _is_indexed_table(relation):
+    return relation is not None and any(relation == table or relation.startswith(table + "_p")
+                                        for table in INDEXED_TABLES)
+
+
+def check_query_plans(rows=0, users=1000):
+
+    """ Function to check with EXPLAIN that the hot queries read the activities and the rollup through an index.
+        With rows above 0 the tables are first filled with that number of synthetic activities spread over the
+        given number of users, in a transaction which is rolled back - the database is left untouched.
+        Returns a dict of query name -> (ok, plan nodes)"""
+
+    results = {}
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    try:
+        with conn_obj.conn.cursor() as cur:
+            if rows > 0:
+                for query in POPULATE_QUERIES:
+                    cur.execute(query, {'rows': rows, 'users': users})
+
+            # A user with activities and a few of its activities as sample parameters
+            cur.execute("""SELECT user_id, year_month FROM activities
+                           WHERE user_id = (SELECT user_id FROM activities LIMIT 1) LIMIT 1""")
+            sample = cur.fetchone()
+            if sample is None:
+                print("There are no activities to check the queries with - use --rows")
+                return results
+
+            cur.execute("SELECT id FROM activities WHERE user_id = %s LIMIT 50", (sample[0],))
+            parameters = {'user_id': sample[0], 'year_month': sample[1], 'ids': [row[0] for row in cur.fetchall()]}
+
+            for name, query in HOT_QUERIES.items():
+                cur.execute("EXPLAIN (FORMAT JSON) " + query, parameters)
+                plan = cur.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                nodes = _plan_nodes(plan[0]['Plan'])
+
+                # A sequential scan of a hot table reads every row of every user
+                ok = not any(node == 'Seq Scan' and _is_indexed_table(relation) for node, relation in nodes)
+                results[name] = (ok, nodes)
+
+    finally:
+        # Nothing of the check is kept
+        conn_obj.conn.rollback()
+
+        # Close the connection
+        conn_obj.close_connection()
+
+    return results
+
+
+def print_plan_check(results):
+    for name, (ok, nodes) in results.items():
+        scans = ", ".join("{} on {}".format(node, relation) for node, relation in nodes if relation is not None)
+        print("{:4s} {:30s} {}".format("ok" if ok else "SLOW", name, scans))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Schema of the postGRE Strava database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply the missing migrations")
+    migrate_parser.add_argument("--target", type=int, help="version to migrate up to - all migrations by default")
+    migrate_parser.add_argument("--partitions", type=int, default=ACTIVITY_PARTITIONS,
+                                help="hash partitions of a new activities table - 0 for a plain table")
+
+    subparsers.add_parser("status", help="print the version of the schema")
+
+    check_parser = subparsers.add_parser("check", help="check the plans of the hot queries with EXPLAIN")
+    check_parser.add_argument("--rows", type=int, default=0, help="synthetic activities added for the check")
+    check_parser.add_argument("--users", type=int, default=1000, help="users the synthetic activities belong to")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.target, args.partitions)
+        print("Schema version {} of {}".format(get_schema_version(), MIGRATIONS[-1][0]))
+
+    elif args.command == "status":
+        print("Schema version {} of {}".format(get_schema_version(), MIGRATIONS[-1][0]))
+
+    else:
+        check_results = check_query_plans(args.rows, args.users)
+        print_plan_check(check_results)
+        if not all(ok for ok, _ in check_results.values()):
+            raise SystemExit(1)
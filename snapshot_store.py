@@ -0,0 +1,342 @@
+""" Local on-disk snapshots of the activities of the users, so a dashboard process can start without reading the
+    full history of a user from the postGRE Strava database. Every user has a directory with
+
+    * base-<version>.arrow: the activities of the user
+    * delta-<version>.arrow: activities upserted by a sync after the base was written
+    * grid-<version>.arrow: the monthly grid shown on the dashboard
+    * manifest.json: the dataset version of the files and the files in use
+
+    The files are written in the Arrow IPC file format, which can be memory-mapped without decoding. A snapshot is
+    only used when its version is not older than the dataset version in the database. pyarrow is optional - without
+    it the store is disabled and the dashboard reads from the database."""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+
+import Strava_functions
+import activity_streams
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Directory holding the snapshots of the users
+SNAPSHOT_DIR = os.environ.get("STRAVADASH_SNAPSHOT_DIR", "snapshots")
+
+# Number of delta files after which the deltas are merged into a new base file
+COMPACT_AFTER_DELTAS = 8
+
+# Columns of the activities kept in the snapshots
+SNAPSHOT_COLUMNS = ['id', 'start_epoch', 'year_month', 'type', 'distance', 'distance_in_km', 'moving_time',
+                    'total_elevation_gain']
+
+AVAILABLE = pa is not None
+
+if AVAILABLE:
+    SNAPSHOT_SCHEMA = pa.schema([('id', pa.int64()),
+                                 ('start_epoch', pa.int64()),
+                                 ('year_month', pa.timestamp('ns')),
+                                 ('type', pa.string()),
+                                 ('distance', pa.float64()),
+                                 ('distance_in_km', pa.float64()),
+                                 ('moving_time', pa.int64()),
+                                 ('total_elevation_gain', pa.float64())])
+
+# Number of seconds after which a temporary file left behind by a crashed writer is removed
+STALE_TMP_SECONDS = 60 * 60
+
+# Writes of the snapshots in this process are done one at a time
+_write_lock = threading.Lock()
+
+
+def _user_dir(user_id):
+    return os.path.join(SNAPSHOT_DIR, str(user_id))
+
+
+def _tmp_path(path):
+
+    """ Function to get a temporary file next to a destination - unique per process and per write, so writers in
+        other processes never write into the same file"""
+
+    return "{}.{}-{}.tmp".format(path, os.getpid(), uuid.uuid4().hex)
+
+
+@contextmanager
+def _user_write_lock(user_id):
+
+    """ Context manager holding the write lock of the snapshot of a user - the lock of this process and an exclusive
+        lock on the lock file of the user, so the workers of a WSGI server and the sync process take turns"""
+
+    user_dir = _user_dir(user_id)
+
+    with _write_lock:
+        os.makedirs(user_dir, exist_ok=True)
+
+        with open(os.path.join(user_dir, "write.lock"), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield user_dir
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _to_table(activities):
+
+    """ Function to convert activities - a dataframe with at least the snapshot columns - into an Arrow table"""
+
+    data = activities[SNAPSHOT_COLUMNS].copy()
+    data['year_month'] = pd.to_datetime(data.year_month)
+
+    return pa.Table.from_pandas(data, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+
+
+def _write_table(path, table):
+
+    """ Function to write a table to an Arrow file - the file is written next to its destination and moved in
+        place, so a reader never sees a half written file"""
+
+    tmp_path = _tmp_path(path)
+
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(tmp_path, path)
+
+
+def _read_table(path):
+
+    """ Function to read an Arrow file with a memory-mapped read - the columns point into the page cache"""
+
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def read_manifest(user_id):
+
+    """ Function to read the manifest of the snapshot of a user - returns None when there is no snapshot"""
+
+    try:
+        with open(os.path.join(_user_dir(user_id), "manifest.json"), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(user_id, manifest):
+
+    """ Function to write the manifest of a user and remove the files which are no longer in use"""
+
+    user_dir = _user_dir(user_id)
+    path = os.path.join(user_dir, "manifest.json")
+
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, path)
+
+    # Temporary files are only removed when they are old - a writer without the lock may still be writing them
+    in_use = {manifest['base'], manifest['grid'], "manifest.json"} | set(manifest['deltas'])
+    now = time.time()
+    for file_name in os.listdir(user_dir):
+        file_path = os.path.join(user_dir, file_name)
+        try:
+            if file_name.endswith(".arrow") and file_name not in in_use:
+                os.remove(file_path)
+            elif file_name.endswith(".tmp") and now - os.path.getmtime(file_path) > STALE_TMP_SECONDS:
+                os.remove(file_path)
+        except OSError:
+            pass
+
+
+def read_activities(user_id, manifest=None):
+
+    """ Function to read the activities in the snapshot of a user - the base file with the deltas applied"""
+
+    manifest = manifest or read_manifest(user_id)
+    user_dir = _user_dir(user_id)
+
+    tables = [_read_table(os.path.join(user_dir, manifest['base']))] + \
+             [_read_table(os.path.join(user_dir, delta)) for delta in manifest['deltas']]
+
+    if len(tables) == 1:
+        return tables[0]
+
+    # A delta holds the latest version of the activities it contains - keep the last version of every activity
+    data = pa.concat_tables(tables).to_pandas()
+    data = data.drop_duplicates(subset='id', keep='last')
+
+    return pa.Table.from_pandas(data, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+
+
+def _grid_table(activities):
+
+    """ Function to build the monthly grid of the dashboard out of the activities of a user"""
+
+    data = activities.select(['year_month', 'type', 'distance', 'distance_in_km']).to_pandas()
+    data_grouped = data.groupby(['year_month', 'type'], as_index=False).agg({'distance': 'sum',
+                                                                            'distance_in_km': 'sum'})
+    cart = Strava_functions.build_monthly_grid(data_grouped)
+
+    return pa.Table.from_pandas(cart[['year_month', 'type', 'distance', 'distance_in_km']], preserve_index=False)
+
+
+def load_grid(user_id, version):
+
+    """ Function to load the monthly grid of a user out of its snapshot. Returns None when the store is disabled,
+        there is no snapshot or the snapshot is older than the given dataset version"""
+
+    if not AVAILABLE:
+        return None
+
+    manifest = read_manifest(user_id)
+    if manifest is None or manifest['version'] < version:
+        return None
+
+    try:
+        return _read_table(os.path.join(_user_dir(user_id), manifest['grid'])).to_pandas()
+
+    # The files can be replaced by a compaction in another process - the caller falls back to the database
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+
+def rebuild(user_id, version):
+
+    """ Function to write a new snapshot of a user out of the postGRE Strava database. The activities are streamed
+        chunk by chunk into the base file. The version must be read before the activities, so the snapshot is never
+        marked newer than its data. Nothing is published when the stream fails. Returns the monthly grid, or None
+        when the user has no activities or the snapshot could not be written"""
+
+    if not AVAILABLE:
+        return None
+
+    base = "base-{}.arrow".format(version)
+    rows_written = 0
+
+    with _user_write_lock(user_id) as user_dir:
+        path = os.path.join(user_dir, base)
+        tmp_path = _tmp_path(path)
+
+        # Make an object from the ConnectToDB class
+        conn_obj = Strava_functions.ConnectToDB()
+
+        # Initialize the connection to the database
+        conn_obj.initialize_connection()
+
+        try:
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, SNAPSHOT_SCHEMA) as writer:
+                    for rows in conn_obj.stream_query("SELECT * FROM activities WHERE user_id = %s", (user_id,),
+                                                      columns=SNAPSHOT_COLUMNS):
+                        writer.write_table(_to_table(pd.DataFrame.from_records(rows, columns=SNAPSHOT_COLUMNS)))
+                        rows_written += len(rows)
+
+        # A broken stream leaves a truncated file - keep the snapshot which is there
+        except Exception as error:
+            print("Snapshot of user {} not rebuilt: {}".format(user_id, error))
+            rows_written = 0
+
+        finally:
+            # Close the connection
+            conn_obj.close_connection()
+
+        if rows_written == 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        os.replace(tmp_path, path)
+
+        activities = _read_table(path)
+        grid = _grid_table(activities)
+        _write_table(os.path.join(user_dir, "grid-{}.arrow".format(version)), grid)
+
+        _write_manifest(user_id, {'version': version,
+                                  'base': base,
+                                  'deltas': [],
+                                  'grid': "grid-{}.arrow".format(version),
+                                  'written_at': time.time()})
+
+    return grid.to_pandas()
+
+
+def append_delta(user_id, activities, version):
+
+    """ Function to add the activities upserted by a sync to the snapshot of a user as a small delta file, and
+        rebuild its grid. The delta is only applied when the snapshot is exactly one write behind the new dataset
+        version - otherwise other writes are missing and the snapshot is left for a rebuild. Returns True when
+        the snapshot is at the new version"""
+
+    if not AVAILABLE or activities is None or len(activities) == 0:
+        return False
+
+    # Users without a snapshot get no directory - they are left for a rebuild
+    if read_manifest(user_id) is None:
+        return False
+
+    with _user_write_lock(user_id) as user_dir:
+        manifest = read_manifest(user_id)
+        if manifest is None or manifest['version'] != version - 1:
+            return False
+
+        delta = "delta-{}.arrow".format(version)
+        _write_table(os.path.join(user_dir, delta), _to_table(activities))
+
+        manifest = dict(manifest, version=version, deltas=manifest['deltas'] + [delta],
+                        grid="grid-{}.arrow".format(version), written_at=time.time())
+
+        all_activities = read_activities(user_id, manifest)
+
+        # Merge the deltas into a new base file once there are enough of them
+        if len(manifest['deltas']) >= COMPACT_AFTER_DELTAS:
+            base = "base-{}.arrow".format(version)
+            _write_table(os.path.join(user_dir, base), all_activities)
+            manifest.update(base=base, deltas=[])
+
+        _write_table(os.path.join(user_dir, manifest['grid']), _grid_table(all_activities))
+        _write_manifest(user_id, manifest)
+
+    return True
+
+
+def sync_user(user_id, rate_limiter=None):
+
+    """ Function to run the incremental sync of a user and add the new activities to its snapshot - used in place
+        of Strava_functions.update_strava_activity by the refresher of the dashboard and the fleet sync. A snapshot
+        which is missing or behind the dataset version is rebuilt here, the dashboard never reads the full history.
+        The streams of the newest activities without streams are fetched afterwards, with what the sync left of the
+        share of the rate limits of the streams"""
+
+    # The streams are fetched with the usage left by the sync - both have to share one limiter
+    rate_limiter = rate_limiter or Strava_functions.RateLimiter()
+
+    synced = Strava_functions.update_strava_activity(user_id, rate_limiter=rate_limiter)
+
+    if AVAILABLE:
+        version = Strava_functions.get_dataset_version(user_id)
+        appended = synced is not None and len(synced) > 0 and append_delta(user_id, synced, version)
+
+        manifest = read_manifest(user_id)
+        if not appended and (manifest is None or manifest['version'] < version):
+            rebuild(user_id, version)
+
+    if activity_streams.STREAMS_PER_SYNC > 0:
+        activity_streams.sync_streams(user_id, rate_limiter=rate_limiter)
+
+    return synced
@@ -0,0 +1,491 @@
+""" Receiver of the Strava push subscription (webhooks). Strava posts an event for every created, updated or deleted
+    activity and for every athlete who deauthorizes the app. The events are stored in the webhook_events table,
+    which is the durable queue, and processed by workers which fetch and upsert only the affected activities.
+    Anybody can post to the endpoint, so an event is only a hint - the state of the activity or the athlete is
+    always confirmed with the Strava API before anything is written or removed:
+
+        webhook_events (event_id BIGSERIAL PRIMARY KEY, object_type TEXT, object_id BIGINT, aspect_type TEXT,
+                        owner_id BIGINT, event_time BIGINT, updates JSONB, received_at TIMESTAMPTZ DEFAULT now(),
+                        claimed_at TIMESTAMPTZ, processed_at TIMESTAMPTZ, attempts INTEGER DEFAULT 0, error TEXT)
+
+    Run the workers with `python strava_webhooks.py work` and replay recorded events - one JSON event per line -
+    against a running app with `python strava_webhooks.py replay events.jsonl --url http://127.0.0.1:8050`"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import flask
+import requests
+
+import Strava_functions
+import snapshot_store
+
+
+# Path of the callback url registered with the Strava push subscription
+WEBHOOK_PATH = "/webhooks/strava"
+
+# Token sent by Strava during the validation handshake - the one given when the subscription was created
+WEBHOOK_VERIFY_TOKEN = os.environ.get("STRAVA_WEBHOOK_VERIFY_TOKEN")
+
+# Id of the subscription - events of other subscriptions are refused, and all events are refused when it is not set
+WEBHOOK_SUBSCRIPTION_ID = os.environ.get("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+
+# Processing of the queue - number of workers, events claimed at once, seconds between two polls of an idle
+# worker, seconds after which a claim of a worker which died is taken over and attempts before an event is left
+WEBHOOK_WORKERS = 2
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_POLL_SECONDS = 5
+WEBHOOK_CLAIM_TIMEOUT_SECONDS = 5 * 60
+WEBHOOK_MAX_ATTEMPTS = 5
+
+EVENT_FIELDS = ('object_type', 'object_id', 'aspect_type', 'owner_id', 'event_time', 'updates')
+
+# Values of the object_type and aspect_type of the events Strava sends
+OBJECT_TYPES = ('activity', 'athlete')
+ASPECT_TYPES = ('create', 'update', 'delete')
+
+
+def validate_subscription(args):
+
+    """ Function to answer the validation handshake Strava makes when a subscription is created - returns the
+        challenge to echo back, or None when the verify token does not match"""
+
+    if args.get("hub.mode") != "subscribe" or WEBHOOK_VERIFY_TOKEN is None or \
+            args.get("hub.verify_token") != WEBHOOK_VERIFY_TOKEN:
+        return None
+
+    return args.get("hub.challenge")
+
+
+def parse_event(event):
+
+    """ Function to check the fields of a posted event - returns the event with the fields of the webhook_events
+        table, or None when it is not an event of Strava"""
+
+    if not isinstance(event, dict):
+        return None
+
+    if event.get('object_type') not in OBJECT_TYPES or event.get('aspect_type') not in ASPECT_TYPES:
+        return None
+
+    updates = event.get('updates') or {}
+    if not isinstance(updates, dict):
+        return None
+
+    try:
+        parsed = {'object_type': event['object_type'],
+                  'object_id': int(event['object_id']),
+                  'aspect_type': event['aspect_type'],
+                  'owner_id': int(event['owner_id']),
+                  'event_time': int(event.get('event_time') or time.time()),
+                  'updates': updates}
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    # The ids are stored as BIGINT
+    if not all(0 < parsed[field] < 2 ** 63 for field in ('object_id', 'owner_id')):
+        return None
+
+    return parsed
+
+
+def enqueue_event(event):
+
+    """ Function to store an event of Strava, as returned by parse_event, in the webhook_events table. Returns True
+        when it has been stored"""
+
+    query = """INSERT INTO webhook_events (object_type, object_id, aspect_type, owner_id, event_time, updates)
+               VALUES (%s, %s, %s, %s, %s, %s)"""
+
+    parameters = (event['object_type'], event['object_id'], event['aspect_type'], event['owner_id'],
+                  event['event_time'], json.dumps(event['updates']))
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the insert in the database
+    stored = conn_obj.execute_transaction([('execute', query, parameters)])
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    return stored
+
+
+def register_routes(server, on_event=None):
+
+    """ Function to add the webhook endpoint to the Flask server of the app - on_event is called after an event
+        has been stored, e.g. to wake up the workers"""
+
+    @server.route(WEBHOOK_PATH, methods=['GET'])
+    def webhook_validation():
+        challenge = validate_subscription(flask.request.args)
+        if challenge is None:
+            return flask.jsonify({'message': 'Forbidden'}), 403
+        return flask.jsonify({'hub.challenge': challenge})
+
+    @server.route(WEBHOOK_PATH, methods=['POST'])
+    def webhook_event():
+        posted = flask.request.get_json(silent=True)
+        event = parse_event(posted)
+
+        if event is None:
+            return flask.jsonify({'message': 'Bad Request'}), 400
+
+        if WEBHOOK_SUBSCRIPTION_ID is None or str(posted.get('subscription_id')) != WEBHOOK_SUBSCRIPTION_ID:
+            return flask.jsonify({'message': 'Unknown subscription'}), 403
+
+        # Strava expects an answer within 2 seconds - the event is only stored here, the workers process it.
+        # A 500 makes Strava retry the event
+        if not enqueue_event(event):
+            return flask.jsonify({'message': 'Not stored'}), 500
+
+        if on_event is not None:
+            on_event()
+
+        return flask.jsonify({'status': 'queued'})
+
+
+def claim_events(partition=0, partitions=1, batch_size=WEBHOOK_BATCH_SIZE):
+
+    """ Function to claim a batch of events which have not been processed yet. The objects are split over the
+        partitions on their id, which spreads the work over the workers of a processor - the processors of other
+        processes claim from the same partitions, so the order of the events is not guaranteed. It does not have to
+        be: the processing fetches the current state of an object from Strava. Claims of a worker which died are
+        taken over after WEBHOOK_CLAIM_TIMEOUT_SECONDS"""
+
+    query = """WITH claimable AS (
+                   SELECT event_id FROM webhook_events
+                   WHERE processed_at IS NULL
+                     AND attempts < %(max_attempts)s
+                     AND object_id %% %(partitions)s = %(partition)s
+                     AND (claimed_at IS NULL OR claimed_at < now() - %(timeout)s * INTERVAL '1 second')
+                   ORDER BY event_id
+                   LIMIT %(batch_size)s
+                   FOR UPDATE SKIP LOCKED)
+               UPDATE webhook_events e
+               SET claimed_at = now(), attempts = e.attempts + 1
+               FROM claimable
+               WHERE e.event_id = claimable.event_id
+               RETURNING e.event_id, e.object_type, e.object_id, e.aspect_type, e.owner_id, e.event_time, e.updates"""
+
+    parameters = {'max_attempts': WEBHOOK_MAX_ATTEMPTS, 'partitions': partitions, 'partition': partition,
+                  'timeout': WEBHOOK_CLAIM_TIMEOUT_SECONDS, 'batch_size': batch_size}
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the claim - it is committed right away, so other workers skip the claimed events
+    try:
+        with conn_obj.conn.cursor() as cur:
+            cur.execute(query, parameters)
+            rows = cur.fetchall()
+        conn_obj.conn.commit()
+
+    except Exception as error:
+        conn_obj._rollback()
+        print(error)
+        rows = []
+
+    # Close the connection
+    conn_obj.close_connection()
+
+    events = [dict(zip(('event_id',) + EVENT_FIELDS, row)) for row in rows]
+
+    return sorted(events, key=lambda event: event['event_id'])
+
+
+def finish_events(event_ids, error=None):
+
+    """ Function to mark events as processed - or release them for a new attempt when the processing failed"""
+
+    if error is None:
+        query = "UPDATE webhook_events SET processed_at = now(), error = NULL WHERE event_id = ANY(%s)"
+        parameters = (list(event_ids),)
+    else:
+        query = "UPDATE webhook_events SET claimed_at = NULL, error = %s WHERE event_id = ANY(%s)"
+        parameters = (str(error)[:1000], list(event_ids))
+
+    # Make an object from the ConnectToDB class
+    conn_obj = Strava_functions.ConnectToDB()
+
+    # Initialize the connection to the database
+    conn_obj.initialize_connection()
+
+    # Perform the update in the database
+    conn_obj.update_data(query, parameters)
+
+    # Close the connection
+    conn_obj.close_connection()
+
+
+def coalesce_events(events):
+
+    """ Function to reduce a batch of events to the work which has to be done. Only the last event of an activity
+        matters: a create or an update means the activity has to be fetched again, a delete that it may have to be
+        removed. Returns the activities to fetch per owner, the activities which may have been deleted per owner
+        and the owners who may have deauthorized the app"""
+
+    last_events = {}
+    deauthorized = set()
+
+    for event in sorted(events, key=lambda event: event['event_id']):
+        owner_id = str(event['owner_id'])
+
+        if event['object_type'] == 'athlete':
+            updates = event.get('updates') or {}
+            if isinstance(updates, str):
+                updates = json.loads(updates)
+            if str(updates.get('authorized', '')).lower() == 'false':
+                deauthorized.add(owner_id)
+
+        elif event['object_type'] == 'activity':
+            last_events[int(event['object_id'])] = (owner_id, event['aspect_type'])
+
+    fetch = {}
+    delete = {}
+
+    for activity_id, (owner_id, aspect_type) in last_events.items():
+        if aspect_type == 'delete':
+            delete.setdefault(owner_id, []).append(activity_id)
+        else:
+            fetch.setdefault(owner_id, []).append(activity_id)
+
+    return fetch, delete, sorted(deauthorized)
+
+
+def fetch_activities(owner_id, activity_ids, rate_limiter=None, access_token=None):
+
+    """ Function to get activities of an owner from the Strava API - returns the activities which were found and
+        the ids of the activities which no longer exist or are no longer visible to the app"""
+
+    access_token = access_token or Strava_functions.get_access_token(owner_id)
+    activities = []
+    missing = []
+
+    for activity_id in activity_ids:
+        url = "{}/activities/{}".format(Strava_functions.STRAVA_API_URL, activity_id)
+
+        try:
+            activities.append(Strava_functions.strava_get(url, {"access_token": access_token}, rate_limiter).json())
+
+        except requests.exceptions.HTTPError as err:
+            status = err.response.status_code if err.response is not None else None
+            if status == 404:
+                missing.append(activity_id)
+                continue
+            if status == 401:
+                Strava_functions.token_provider.invalidate(owner_id)
+            raise
+
+    return activities, missing
+
+
+def is_deauthorized(owner_id, rate_limiter=None):
+
+    """ Function to confirm with the Strava API that an athlete has deauthorized the app - Strava no longer accepts
+        the tokens of the athlete. Athletes without tokens in the postGRE Strava database have nothing to remove"""
+
+    if not Strava_functions.user_exists(owner_id):
+        return False
+
+    # Do not trust a token in memory - get the stored one, refreshed when it has expired
+    Strava_functions.token_provider.invalidate(owner_id)
+
+    try:
+        access_token = Strava_functions.get_access_token(owner_id)
+        Strava_functions.strava_get(Strava_functions.STRAVA_API_URL + "/athlete", {"access_token": access_token},
+                                    rate_limiter)
+
+    except requests.exceptions.HTTPError as err:
+        # A refused recovery token (400 invalid_grant) or a refused access token which has not expired
+        status = err.response.status_code if err.response is not None else None
+        if status in (400, 401):
+            return True
+        raise
+
+    return False
+
+
+def process_events(events, rate_limiter=None):
+
+    """ Function to apply a batch of events to the postGRE Strava database. Every event is checked with the Strava
+        API: the activities of an owner are fetched and upserted in one statement, an activity is only removed when
+        Strava answers 404 for it, and the data of an athlete is only removed when Strava no longer accepts the
+        tokens of the athlete. Returns a summary"""
+
+    fetch, delete, deauthorized = coalesce_events(events)
+    deauthorized = [owner_id for owner_id in deauthorized if is_deauthorized(owner_id, rate_limiter)]
+    fetched = deleted = 0
+
+    for owner_id in set(fetch) | set(delete):
+        # The activities of a deauthorized owner are removed with the owner
+        if owner_id in deauthorized or not Strava_functions.user_exists(owner_id):
+            continue
+
+        activities, missing = fetch_activities(owner_id, fetch.get(owner_id, []) + delete.get(owner_id, []),
+                                               rate_limiter)
+        fetched += len(activities)
+
+        if len(activities) > 0:
+            data = Strava_functions.normalize_activities(activities, owner_id)
+            if not Strava_functions.insert_activities(data, upsert=True):
+                raise RuntimeError("Upsert of the activities of user {} failed".format(owner_id))
+
+            snapshot_store.append_delta(owner_id, data, Strava_functions.get_dataset_version(owner_id))
+
+        if not Strava_functions.delete_activities(owner_id, missing):
+            raise RuntimeError("Delete of {} activities of user {} failed".format(len(missing), owner_id))
+        deleted += len(missing)
+
+    for owner_id in deauthorized:
+        if not Strava_functions.delete_user_data(owner_id):
+            raise RuntimeError("Removal of user {} failed".format(owner_id))
+
+    return {'events': len(events), 'fetched': fetched, 'deleted': deleted, 'deauthorized': len(deauthorized)}
+
+
+class WebhookProcessor:
+    """ This Class runs the workers which process the webhook_events queue in background threads. Every worker
+        handles its own partition of the objects. The workers poll the queue and can be woken up right away when
+        an event has been received by this process"""
+
+    # Initialize an object of the class
+    def __init__(self, workers=WEBHOOK_WORKERS, poll_interval=WEBHOOK_POLL_SECONDS, rate_limiter=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.rate_limiter = rate_limiter or Strava_functions.RateLimiter()
+        self.processed = 0
+        self.failed = 0
+        self.fetched = 0
+        self._wake_events = [threading.Event() for _ in range(workers)]
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._threads = []
+
+    def process_once(self, partition=0):
+
+        """ Method to claim and process one batch of events of a partition - returns the number of events"""
+
+        events = claim_events(partition, self.workers)
+        if len(events) == 0:
+            return 0
+
+        event_ids = [event['event_id'] for event in events]
+
+        try:
+            summary = process_events(events, self.rate_limiter)
+            finish_events(event_ids)
+
+            with self._stats_lock:
+                self.processed += len(events)
+                self.fetched += summary['fetched']
+
+        except Exception as error:
+            print("Processing of {} webhook events failed: {}".format(len(events), error))
+            finish_events(event_ids, error)
+
+            with self._stats_lock:
+                self.failed += len(events)
+
+        return len(events)
+
+    def wake(self):
+
+        """ Method to let the workers poll the queue right away"""
+
+        for event in self._wake_events:
+            event.set()
+
+    def start(self):
+
+        """ Method to start the workers in background threads"""
+
+        if any(thread.is_alive() for thread in self._threads):
+            return
+
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=self._run, args=(partition,), daemon=True,
+                                          name="webhook-worker-{}".format(partition))
+                         for partition in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+
+        """ Method to stop the workers"""
+
+        self._stop_event.set()
+        self.wake()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, partition):
+        while not self._stop_event.is_set():
+            try:
+                # Keep going while there is a backlog - only wait when the queue is empty
+                if self.process_once(partition) > 0:
+                    continue
+            except Exception as error:
+                print("Webhook worker {} failed: {}".format(partition, error))
+
+            self._wake_events[partition].wait(self.poll_interval)
+            self._wake_events[partition].clear()
+
+    def stats(self):
+
+        """ Method to get the counters of the processor"""
+
+        with self._stats_lock:
+            return {'workers': self.workers, 'processed': self.processed, 'failed': self.failed,
+                    'fetched': self.fetched}
+
+
+def replay_events(path, url):
+
+    """ Function to post recorded events - one JSON event per line - to the webhook endpoint of a running app"""
+
+    with open(path, 'r') as events_file:
+        events = [json.loads(line) for line in events_file if line.strip()]
+
+    accepted = 0
+    for event in events:
+        response = requests.post(url.rstrip('/') + WEBHOOK_PATH, json=event, timeout=10)
+        if response.ok:
+            accepted += 1
+        else:
+            print("Event {} was refused: {} {}".format(event.get('object_id'), response.status_code, response.text))
+
+    print("Replayed {} events - {} accepted".format(len(events), accepted))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process the Strava webhook events")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    work = subparsers.add_parser("work", help="process the queued events until interrupted")
+    work.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    replay = subparsers.add_parser("replay", help="post recorded events to the webhook endpoint")
+    replay.add_argument("path", help="file with one JSON event per line")
+    replay.add_argument("--url", default="http://127.0.0.1:8050")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        replay_events(args.path, args.url)
+    else:
+        processor = WebhookProcessor(workers=args.workers)
+        processor.start()
+        try:
+            while True:
+                time.sleep(60)
+                print(processor.stats())
+        except KeyboardInterrupt:
+            processor.stop()
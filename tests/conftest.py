@@ -0,0 +1,71 @@
+""" Shared fixtures of the tests - the modules of the app live in the root of the repository """
+
+import os
+import sys
+
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import Strava_functions  # noqa: E402
+import schema  # noqa: E402
+from fake_strava import FakeStrava  # noqa: E402
+
+
+@pytest.fixture
+def fake_strava(monkeypatch):
+
+    """ Fixture to start the Strava stand-in for the given athletes and point the sync to it - the servers are
+        stopped after the test"""
+
+    servers = []
+
+    def start(athletes, **kwargs):
+        fake = FakeStrava(athletes, **kwargs).start()
+        servers.append(fake)
+        monkeypatch.setattr(Strava_functions, "STRAVA_API_URL", fake.url)
+        return fake
+
+    yield start
+
+    for fake in servers:
+        fake.stop()
+
+
+@pytest.fixture(scope="session")
+def postgres():
+
+    """ Fixture to point Strava_functions to a migrated throwaway database - the one of STRAVADASH_TEST_DSN, or a
+        local cluster started like the benchmark suite does. The tests are skipped when there is neither"""
+
+    dsn = os.environ.get("STRAVADASH_TEST_DSN")
+    cluster = None
+
+    if dsn:
+        db_config = {'dsn': dsn}
+    else:
+        sys.path.insert(0, os.path.join(REPOSITORY, "benchmarks"))
+        from local_postgres import LocalPostgres, find_postgres_bindir
+
+        bindir = find_postgres_bindir()
+        if bindir is None:
+            pytest.skip("no throwaway database: Postgres is not installed - set STRAVADASH_TEST_DSN")
+
+        cluster = LocalPostgres(bindir)
+        try:
+            db_config = cluster.start()
+        except Exception as error:
+            cluster.stop()
+            pytest.skip("no throwaway database: {}".format(error))
+
+    Strava_functions.close_connection_pool()
+    Strava_functions._db_config = db_config
+    schema.migrate()
+
+    yield db_config
+
+    Strava_functions.close_connection_pool()
+    Strava_functions._db_config = None
+    if cluster is not None:
+        cluster.stop()
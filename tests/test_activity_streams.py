@@ -0,0 +1,61 @@
+""" Tests of the levels of detail of the activity streams of activity_streams.py against the Strava stand-in -
+    without a database """
+
+import json
+
+import numpy as np
+
+import Strava_functions
+import activity_streams
+from fake_strava import make_activities, make_streams
+
+
+def test_levels_of_detail_decode_and_keep_the_ends(fake_strava):
+    activities = make_activities(20)
+    fake_strava({"1": activities}, short_limit=10 ** 6, long_limit=10 ** 7)
+    json_bytes = full_bytes = 0
+
+    for activity in activities:
+        streams = activity_streams.fetch_streams("token-1", activity["id"])
+        levels = activity_streams.build_levels(streams)
+        blocks = [activity_streams.encode_streams(level_streams) for _, _, level_streams in levels]
+
+        # The full resolution decodes to the quantized streams
+        decoded = activity_streams.decode_streams(blocks[0])
+        for name, values in streams.items():
+            scale = activity_streams.STREAM_ENCODINGS[name][1]
+            assert np.allclose(decoded[name], np.rint(values * scale) / scale, atol=1e-9), \
+                "stream {} of activity {} does not decode".format(name, activity["id"])
+
+        # Every level fits its number of points and keeps the first and the last sample
+        for kind, max_points, level_streams in levels[1:]:
+            time_stream = level_streams["time"]
+            assert len(time_stream) <= max_points, "{} level {} is too large".format(kind, max_points)
+            assert time_stream[0] == streams["time"][0] and time_stream[-1] == streams["time"][-1], \
+                "{} level {} misses the first or last sample".format(kind, max_points)
+
+        json_bytes += len(json.dumps(make_streams(activity)))
+        full_bytes += len(blocks[0])
+
+    assert full_bytes < json_bytes / 4
+
+
+def test_stream_fetches_stop_at_their_share_of_the_rate_limit(fake_strava, monkeypatch):
+    activities = [activity for activity in make_activities(40) if not activity["manual"]]
+    fake = fake_strava({"1": activities}, short_limit=20, long_limit=1000)
+    stored = []
+
+    monkeypatch.setattr(Strava_functions, "get_access_token", lambda user_id: "token-1")
+    monkeypatch.setattr(activity_streams, "get_activities_without_streams",
+                        lambda user_id, limit: [activity["id"] for activity in activities[:limit]])
+    monkeypatch.setattr(activity_streams, "store_streams",
+                        lambda user_id, activity_id, levels: stored.append(activity_id) or True)
+
+    # The sync has made a request with the shared limiter before the streams are fetched
+    limiter = Strava_functions.RateLimiter(safety_margin=1)
+    Strava_functions.strava_get(fake.url + "/athlete/activities", {"access_token": "token-1"}, limiter)
+
+    activity_streams.sync_streams("1", limiter, limit=len(activities))
+
+    assert len(stored) > 0
+    assert fake.short_usage <= fake.short_limit * activity_streams.STREAMS_RATE_SHARE
@@ -0,0 +1,34 @@
+""" Tests of the parallel backfill of Strava_functions against the Strava stand-in """
+
+import Strava_functions
+from fake_strava import make_activities
+
+
+def test_backfill_retrieves_every_activity_once(fake_strava):
+    activity_count = 3000
+    fake_strava({"1": make_activities(activity_count)}, short_limit=600, long_limit=30000, latency=0.01)
+
+    pages = list(Strava_functions.fetch_activity_pages("token-1"))
+
+    ids = [activity["id"] for _, page in pages for activity in page]
+    assert [page for page, _ in pages] == list(range(1, len(pages) + 1)), "pages are not yielded in order"
+    assert len(ids) == len(set(ids)) == activity_count
+
+
+def test_backfill_resumes_before_the_oldest_committed_activity(fake_strava):
+    activities = make_activities(1000)
+    fake_strava({"1": activities}, short_limit=600, long_limit=30000)
+
+    committed = []
+    for page, page_activities in Strava_functions.fetch_activity_pages("token-1"):
+        committed.extend(page_activities)
+        if page == 2:
+            break
+
+    # The backfill resumes one second after the oldest committed start - that activity is fetched again
+    before = min(Strava_functions._start_date_epoch(activity) for activity in committed) + 1
+    resumed = [activity for _, page_activities in Strava_functions.fetch_activity_pages("token-1", before=before)
+               for activity in page_activities]
+
+    assert {activity["id"] for activity in committed + resumed} == {activity["id"] for activity in activities}
+    assert len(committed) + len(resumed) - len(activities) <= 1
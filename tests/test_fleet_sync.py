@@ -0,0 +1,38 @@
+""" Tests of the fleet sync of fleet_sync.py against the Strava stand-in - without a database """
+
+import Strava_functions
+import fleet_sync
+from fake_strava import make_activities
+
+
+def test_fleet_sync_stays_within_the_rate_limit(fake_strava):
+    athlete_count, activity_count, short_limit = 20, 300, 100
+    athletes = {str(user_id): make_activities(activity_count, first_id=user_id * 10 ** 6, seed=user_id)
+                for user_id in range(1, athlete_count + 1)}
+    fake = fake_strava(athletes, short_limit=short_limit, long_limit=short_limit * 10, latency=0.01)
+    retrieved = {}
+
+    # Every worker pages through the activities of its athlete with the shared rate limiter
+    def sync_user(user_id, rate_limiter=None):
+        activities = []
+        page = 1
+        while True:
+            page_activities = Strava_functions.strava_get(fake.url + "/athlete/activities",
+                                                          {"access_token": "token-{}".format(user_id),
+                                                           "after": 0, "page": page, "per_page": 200},
+                                                          rate_limiter).json()
+            activities.extend(page_activities)
+            if len(page_activities) < 200:
+                break
+            page += 1
+
+        retrieved[user_id] = activities
+        return activities
+
+    # A bucket as big as the limit - the test runs in one 15-minute window
+    limiter = fleet_sync.TokenBucketRateLimiter(capacity=short_limit)
+    report = fleet_sync.sync_fleet(list(athletes), rate_limiter=limiter, sync_user=sync_user)
+
+    assert report['failed'] == 0
+    assert all(len(retrieved[user_id]) == activity_count for user_id in athletes), "activities are missing"
+    assert fake.short_usage <= fake.short_limit, "the rate limit of the stand-in was exceeded"
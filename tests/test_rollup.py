@@ -0,0 +1,95 @@
+""" Tests of the monthly_totals rollup kept up to date by the writes of Strava_functions - they need a throwaway
+    database, see the postgres fixture """
+
+import threading
+import time
+
+import pytest
+from psycopg2.extras import execute_values
+
+import Strava_functions
+from fake_strava import make_activities
+
+USER_ID = "900000001"
+
+
+@pytest.fixture
+def empty_user(postgres):
+
+    """ Fixture to remove the data of the test athlete before and after a test"""
+
+    def clean():
+        Strava_functions.delete_user_data(USER_ID)
+        Strava_functions.rebuild_monthly_totals(USER_ID)
+
+    clean()
+    yield USER_ID
+    clean()
+
+
+def test_concurrent_writers_of_one_month_keep_the_rollup_exact(empty_user):
+    activities = make_activities(10, seed=1)
+
+    # Every activity starts in the same month
+    for activity in activities:
+        activity["start_date"] = activity["start_date_local"] = "2020-05-10T08:00:00Z"
+        activity["type"] = "Run"
+
+    first = Strava_functions.normalize_activities(activities[:5], empty_user)
+    second = Strava_functions.normalize_activities(activities[5:], empty_user)
+
+    # The first writer runs all its statements but does not commit yet
+    conn_obj = Strava_functions.ConnectToDB()
+    conn_obj.initialize_connection()
+    statements = Strava_functions._with_rollup_refresh([empty_user], [int(x) for x in first.id],
+                                                       Strava_functions._insert_activities_statements(first, True))
+    with conn_obj.conn.cursor() as cur:
+        for method, query, parameters in statements:
+            if method == 'execute_values':
+                execute_values(cur, query, parameters)
+            else:
+                cur.execute(query, parameters)
+
+    # The second writer of the same month runs while the first one is still open
+    results = []
+    writer = threading.Thread(target=lambda: results.append(Strava_functions.insert_activities(second, upsert=True)))
+    writer.start()
+    time.sleep(1)
+
+    conn_obj.conn.commit()
+    conn_obj.close_connection()
+    writer.join()
+
+    assert results == [True]
+    assert Strava_functions.verify_monthly_totals(empty_user).empty, "the rollup lost the writes of a writer"
+
+
+def test_upsert_only_writes_changed_activities(empty_user):
+    data = Strava_functions.normalize_activities(make_activities(5, seed=2), empty_user)
+
+    assert sorted(Strava_functions._write_activities(data, upsert=True)) == sorted(int(x) for x in data.id)
+
+    # The overlap of an incremental sync sends the same activities again
+    assert Strava_functions._write_activities(data, upsert=True) == []
+    assert Strava_functions._write_activities(data, upsert=True, bulk=True) == []
+
+    changed = data.copy()
+    changed.loc[changed.index[0], 'distance'] += 1000
+    assert Strava_functions._write_activities(changed, upsert=True) == [int(changed.id.iloc[0])]
+    assert Strava_functions.verify_monthly_totals(empty_user).empty
+
+
+def test_dataset_version_is_only_bumped_by_changes(empty_user):
+    data = Strava_functions.normalize_activities(make_activities(5, seed=3), empty_user)
+
+    assert Strava_functions.insert_activities(data, upsert=True)
+    version = Strava_functions.get_dataset_version(empty_user)
+
+    # Writes which change nothing keep the version - and the caches keyed on it
+    assert Strava_functions.insert_activities(data, upsert=True)
+    assert Strava_functions.delete_activities(empty_user, [1])
+    assert Strava_functions.get_dataset_version(empty_user) == version
+
+    assert Strava_functions.delete_activities(empty_user, [data.id.iloc[0]])
+    assert Strava_functions.get_dataset_version(empty_user) == version + 1
+    assert Strava_functions.verify_monthly_totals(empty_user).empty
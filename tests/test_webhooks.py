@@ -0,0 +1,114 @@
+""" Tests of the Strava webhook receiver and the processing of the events against the Strava stand-in - the
+    database functions are replaced by recorders """
+
+import flask
+import pytest
+
+import Strava_functions
+import snapshot_store
+import strava_webhooks
+from fake_strava import make_activities, make_events
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+
+    """ Fixture to record the writes of the processing instead of sending them to a database - athletes 1 and 2
+        have connected the app"""
+
+    writes = {'upserted': [], 'deleted': [], 'removed_users': []}
+
+    def insert_activities(data, upsert=False, bulk=None):
+        writes['upserted'].extend(data.id.tolist())
+        return True
+
+    def delete_activities(user_id, activity_ids):
+        writes['deleted'].extend((user_id, activity_id) for activity_id in activity_ids)
+        return True
+
+    def delete_user_data(user_id):
+        writes['removed_users'].append(user_id)
+        return True
+
+    monkeypatch.setattr(snapshot_store, "SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(Strava_functions, "user_exists", lambda user_id: str(user_id) in ("1", "2"))
+    monkeypatch.setattr(Strava_functions, "get_access_token", lambda user_id: "token-{}".format(user_id))
+    monkeypatch.setattr(Strava_functions, "get_dataset_version", lambda user_id: 0)
+    monkeypatch.setattr(Strava_functions, "insert_activities", insert_activities)
+    monkeypatch.setattr(Strava_functions, "delete_activities", delete_activities)
+    monkeypatch.setattr(Strava_functions, "delete_user_data", delete_user_data)
+
+    return writes
+
+
+def test_events_are_coalesced_and_deletes_confirmed(fake_strava):
+    activity_count = 500
+    activities = make_activities(activity_count)
+    events = [dict(event, event_id=number) for number, event in enumerate(make_events(activities, "1"))]
+
+    # Deleted activities no longer exist on Strava
+    deleted = {event["object_id"] for event in events if event["aspect_type"] == "delete"}
+    fake_strava({"1": [a for a in activities if a["id"] not in deleted]}, short_limit=10000, long_limit=100000)
+
+    fetch, delete, _ = strava_webhooks.coalesce_events(events)
+    fetched, missing = strava_webhooks.fetch_activities("1", fetch["1"] + delete["1"], access_token="token-1")
+
+    assert set(delete["1"]) == deleted
+    assert set(missing) == deleted, "only the activities Strava no longer has are deleted"
+    assert len(fetched) == activity_count - len(deleted)
+
+
+def test_forged_delete_of_an_existing_activity_is_not_applied(fake_strava, database):
+    activities = make_activities(5)
+    fake_strava({"1": activities, "2": make_activities(5, first_id=10 ** 6)})
+
+    # A delete of an activity which still exists, and a delete of the activity of another athlete
+    events = [{"event_id": 1, "object_type": "activity", "object_id": activities[0]["id"], "aspect_type": "delete",
+               "owner_id": 1, "updates": {}},
+              {"event_id": 2, "object_type": "activity", "object_id": activities[1]["id"], "aspect_type": "delete",
+               "owner_id": 2, "updates": {}}]
+
+    summary = strava_webhooks.process_events(events)
+
+    assert database['upserted'] == [activities[0]["id"]]
+    assert database['deleted'] == [("2", activities[1]["id"])], "deletes are scoped to the owner of the event"
+    assert summary['deleted'] == 1
+
+
+def test_deauthorization_is_confirmed_with_strava(fake_strava, database):
+    fake = fake_strava({"1": make_activities(5), "2": make_activities(5, first_id=10 ** 6)})
+    fake.revoke("2")
+
+    events = [{"event_id": number, "object_type": "athlete", "object_id": owner_id, "aspect_type": "update",
+               "owner_id": owner_id, "updates": {"authorized": "false"}}
+              for number, owner_id in enumerate((1, 2, 3))]
+
+    summary = strava_webhooks.process_events(events)
+
+    assert database['removed_users'] == ["2"], "only the athlete Strava no longer accepts is removed"
+    assert summary['deauthorized'] == 1
+
+
+@pytest.mark.parametrize("event", [None, [1], {"object_type": "activity"},
+                                   {"object_type": "activity", "object_id": "x", "aspect_type": "create",
+                                    "owner_id": 1},
+                                   {"object_type": "route", "object_id": 1, "aspect_type": "create", "owner_id": 1},
+                                   {"object_type": "activity", "object_id": 1, "aspect_type": "create",
+                                    "owner_id": 1, "updates": "title"}])
+def test_malformed_events_are_refused(event):
+    assert strava_webhooks.parse_event(event) is None
+
+
+def test_events_of_an_unknown_subscription_are_refused(monkeypatch):
+    server = flask.Flask(__name__)
+    strava_webhooks.register_routes(server)
+    client = server.test_client()
+    event = {"object_type": "activity", "object_id": 1, "aspect_type": "create", "owner_id": 1, "subscription_id": 7}
+
+    monkeypatch.setattr(strava_webhooks, "WEBHOOK_SUBSCRIPTION_ID", None)
+    assert client.post(strava_webhooks.WEBHOOK_PATH, json=event).status_code == 403
+
+    monkeypatch.setattr(strava_webhooks, "WEBHOOK_SUBSCRIPTION_ID", "8")
+    assert client.post(strava_webhooks.WEBHOOK_PATH, json=event).status_code == 403
+
+    assert client.post(strava_webhooks.WEBHOOK_PATH, json={"object_id": "x"}).status_code == 400
@@ -1,3 +1,7 @@
-import Strava_functions as stf
+import sys
 
-stf.update_strava_activity("12210119")
\ No newline at end of file
+import fleet_sync
+
+# Sync the latest activities of the users given on the command line - of all the users when none are given.
+# The users are synced in parallel under one shared Strava rate budget
+fleet_sync.print_report(fleet_sync.sync_fleet(sys.argv[1:] or None))